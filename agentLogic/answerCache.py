@@ -0,0 +1,110 @@
+#Questo file implementa una cache semantica delle risposte, separata per documento: se per lo stesso file
+#è già stata posta una domanda (riscritta) molto simile, restituisco la risposta salvata senza rieseguire la pipeline
+
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#Le voci di un documento sono legate alla versione del suo contenuto (content_version del Document, scritta dalla
+#pipeline di ingestione nella stessa transazione dei chunk): quando la versione cambia le risposte salvate vengono scartate,
+#anche nei processi che non hanno eseguito l'indicizzazione. invalidate le elimina subito nel processo che ha indicizzato
+#e comunque le voci scadono dopo ttl_seconds
+class SemanticAnswerCache:
+    def __init__(self, threshold: Optional[float] = None, max_entries_per_document: Optional[int] = None, ttl_seconds: Optional[float] = None):
+        #Similarità coseno minima tra le query per considerare valida una risposta salvata
+        self.threshold = threshold if threshold is not None else float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+        self.max_entries_per_document = max_entries_per_document or int(os.getenv("ANSWER_CACHE_MAX_PER_DOCUMENT", "256"))
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+        self.enabled = os.getenv("ANSWER_CACHE_ENABLED", "1") == "1"
+
+        #filename -> {"version": versione del contenuto, "entries": risposte salvate per quella versione}
+        self._documents: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    #Cerca una risposta salvata per la versione data del documento la cui query sia abbastanza simile a quella data
+    def lookup(self, filename: str, version: str, query_embedding: List[float]) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        query_vector = self._normalize(query_embedding)
+        with self._lock:
+            document = self._documents.get(filename)
+            if document is not None and document["version"] != version:
+                # Il documento è stato reindicizzato (anche da un altro processo): le risposte salvate non valgono più
+                del self._documents[filename]
+                self.invalidations += 1
+                document = None
+            entries = document["entries"] if document is not None else []
+            now = time.time()
+            entries[:] = [entry for entry in entries if not self._is_expired(entry, now)]
+            if not entries:
+                self.misses += 1
+                return None
+
+            similarities = np.stack([entry["vector"] for entry in entries]) @ query_vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            entry = entries[best]
+            return {"answer": entry["answer"], "query": entry["query"], "similarity": float(similarities[best])}
+
+    def store(self, filename: str, version: str, query: str, query_embedding: List[float], answer: str):
+        if not self.enabled or not query_embedding:
+            return
+        with self._lock:
+            document = self._documents.get(filename)
+            if document is None or document["version"] != version:
+                document = self._documents[filename] = {"version": version, "entries": []}
+            entries = document["entries"]
+            entries.append({
+                "query": query,
+                "vector": self._normalize(query_embedding),
+                "answer": answer,
+                "created_at": time.time(),
+            })
+            if len(entries) > self.max_entries_per_document:
+                del entries[:len(entries) - self.max_entries_per_document]
+
+    #Elimina tutte le risposte salvate per un documento (da chiamare quando viene reindicizzato)
+    def invalidate(self, filename: str):
+        with self._lock:
+            if self._documents.pop(filename, None) is not None:
+                self.invalidations += 1
+                logger.info(f"Cache delle risposte invalidata per il file '{filename}'.")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "documents": len(self._documents),
+                "entries": sum(len(document["entries"]) for document in self._documents.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "invalidations": self.invalidations,
+            }
+
+    def _is_expired(self, entry: Dict[str, Any], now: float) -> bool:
+        return self.ttl_seconds > 0 and now - entry["created_at"] > self.ttl_seconds
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+
+#Istanza condivisa dal processo
+answer_cache = SemanticAnswerCache()
@@ -0,0 +1,119 @@
+#Questo file prepara il contesto per il generatore rispettando un budget di token: i chunk consecutivi della stessa
+#sezione vengono uniti in un unico frammento senza ripetere la sovrapposizione del Chunker, poi i frammenti
+#vengono inseriti in ordine di rank finché il budget lo consente
+
+import math
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from agentLogic.state import RetrievedChunk
+
+#Budget di token del contesto e stima dei token (circa 4 caratteri per token, senza caricare un tokenizer)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CHARS_PER_TOKEN = 4
+#La sovrapposizione tra chunk vicini è di 100 caratteri (Chunker): la cerco fino a questa lunghezza,
+#ignorando le coincidenze troppo corte per essere una vera sovrapposizione
+MAX_OVERLAP_CHARS = int(os.getenv("CONTEXT_MAX_OVERLAP_CHARS", "200"))
+MIN_OVERLAP_CHARS = 20
+
+_CHUNK_INDEX = re.compile(r"^(.*)_(\d+)$")
+
+
+def estimate_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN) if text else 0
+
+
+#Ricava dal chunk_id ({filename}_{sezione}_{i}) la sezione e la posizione del chunk al suo interno
+def chunk_position(chunk: RetrievedChunk) -> Optional[Tuple[str, int]]:
+    match = _CHUNK_INDEX.match(chunk.get("chunk_id") or "")
+    if not match:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+#Unisce due chunk consecutivi eliminando la parte finale del primo ripetuta all'inizio del secondo.
+#Restituisce il testo unito e il numero di caratteri di sovrapposizione rimossi
+def merge_overlapping(first: str, second: str) -> Tuple[str, int]:
+    longest = min(len(first), len(second), MAX_OVERLAP_CHARS)
+    for size in range(longest, MIN_OVERLAP_CHARS - 1, -1):
+        if first.endswith(second[:size]):
+            return first + second[size:], size
+    return f"{first} {second}", 0
+
+
+#Raggruppa i chunk in sequenze di indici consecutivi della stessa sezione dello stesso file.
+#Ogni gruppo prende il rank del suo chunk migliore, così l'ordine di pertinenza viene rispettato
+def _group_runs(chunks: List[RetrievedChunk]) -> List[List[Tuple[int, RetrievedChunk]]]:
+    positioned = []
+    runs = []
+    for rank, chunk in enumerate(chunks):
+        position = chunk_position(chunk)
+        if position is None:
+            runs.append([(rank, chunk)])
+        else:
+            positioned.append(((chunk.get("filename"), position[0]), position[1], rank, chunk))
+
+    positioned.sort(key=lambda item: (str(item[0]), item[1]))
+    current = []
+    for key, index, rank, chunk in positioned:
+        if current and current[-1][0] == key and current[-1][1] + 1 == index:
+            current.append((key, index, rank, chunk))
+        elif current and current[-1][0] == key and current[-1][1] == index:
+            continue  # stesso chunk arrivato da due rami
+        else:
+            if current:
+                runs.append([(r, c) for _, _, r, c in current])
+            current = [(key, index, rank, chunk)]
+    if current:
+        runs.append([(r, c) for _, _, r, c in current])
+
+    runs.sort(key=lambda run: min(rank for rank, _ in run))
+    return runs
+
+
+#Costruisce i frammenti del contesto. Ogni frammento è un RetrievedChunk (con metadati e score del chunk migliore
+#del gruppo) più chunk_ids con gli id uniti. Restituisce anche le statistiche del packing, tra cui i token risparmiati
+def pack_context(chunks: List[RetrievedChunk], token_budget: Optional[int] = None) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+    token_budget = token_budget or CONTEXT_TOKEN_BUDGET
+    tokens_before = sum(estimate_tokens(c["content"]) for c in chunks)
+
+    packed = []
+    used_tokens = 0
+    overlap_removed = 0
+    merged = 0
+    dropped = 0
+    for run in _group_runs(chunks):
+        content = run[0][1]["content"]
+        run_overlap = 0
+        for _, chunk in run[1:]:
+            content, removed = merge_overlapping(content, chunk["content"])
+            run_overlap += removed
+
+        tokens = estimate_tokens(content)
+        if used_tokens + tokens > token_budget:
+            if packed:
+                dropped += len(run)
+                continue
+            # Il frammento migliore entra sempre, eventualmente troncato al budget
+            content = content[:token_budget * CHARS_PER_TOKEN]
+            tokens = estimate_tokens(content)
+
+        best = min(run, key=lambda item: item[0])[1]
+        packed.append({**best, "content": content, "chunk_ids": [c["chunk_id"] for _, c in run]})
+        used_tokens += tokens
+        overlap_removed += run_overlap
+        merged += len(run) - 1
+
+    stats = {
+        "chunks_in": len(chunks),
+        "fragments_out": len(packed),
+        "chunks_merged": merged,
+        "chunks_dropped": dropped,
+        "overlap_chars_removed": overlap_removed,
+        "token_budget": token_budget,
+        "tokens_before": tokens_before,
+        "tokens_after": used_tokens,
+        "tokens_saved": tokens_before - used_tokens,
+    }
+    return packed, stats
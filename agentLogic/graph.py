@@ -1,11 +1,12 @@
 from langgraph.graph import StateGraph, END
 from agentLogic.state import AgentState
-from agentLogic.nodes import node_router, node_retriever, node_generator, node_reranker, node_rewriter
+from agentLogic.nodes import node_router, node_retriever, node_generator, node_reranker, node_rewriter, node_cache_lookup
 
 workflow = StateGraph(AgentState)
 
 #Aggiunta Nodi
 workflow.add_node("rewriter", node_rewriter)
+workflow.add_node("cache_lookup", node_cache_lookup)
 workflow.add_node("router", node_router)
 workflow.add_node("retriever", node_retriever)
 workflow.add_node("reranker", node_reranker)
@@ -13,7 +14,13 @@ workflow.add_node("generator", node_generator)
 
 #Definizione Percorso
 workflow.set_entry_point("rewriter")
-workflow.add_edge("rewriter", "router")
+workflow.add_edge("rewriter", "cache_lookup")
+#Se la cache semantica ha già una risposta per una domanda simile sullo stesso documento, termino subito
+workflow.add_conditional_edges(
+    "cache_lookup",
+    lambda state: "hit" if state.get("cache_hit") else "miss",
+    {"hit": END, "miss": "router"}
+)
 workflow.add_edge("router", "retriever")
 workflow.add_edge("retriever", "reranker")
 workflow.add_edge("reranker", "generator") 
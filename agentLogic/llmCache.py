@@ -0,0 +1,176 @@
+#Questo file implementa una cache delle risposte LLM per le chiamate deterministiche (rewriter e router):
+#la chiave combina modello, versione del template del prompt e input, quindi cambiare il prompt invalida le voci
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+#Backend in memoria con espulsione LRU oltre max_entries
+class MemoryCacheBackend:
+    name = "memory"
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+#Backend su disco (SQLite) condivisibile tra processi e persistente tra i riavvii.
+#L'espulsione rimuove le voci con l'accesso meno recente quando si supera max_entries
+class SQLiteCacheBackend:
+    name = "sqlite"
+
+    def __init__(self, path: str, max_entries: int = 50000):
+        self.path = path
+        self.max_entries = max_entries
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache (last_access)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row[0]
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            overflow = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                    (overflow,)
+                )
+            self._conn.commit()
+
+    def size(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+#Cache delle risposte LLM con contatori di hit/miss per versione del template
+class LLMResponseCache:
+    def __init__(self, backend=None):
+        self.backend = backend
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    @staticmethod
+    def make_key(model: str, template_version: str, prompt_input: str) -> str:
+        payload = json.dumps([model, template_version, prompt_input], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, model: str, template_version: str, prompt_input: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        try:
+            value = self.backend.get(self.make_key(model, template_version, prompt_input))
+        except Exception as e:
+            logger.warning(f"Errore nella lettura della cache LLM: {e}")
+            value = None
+        self._count(template_version, "hits" if value is not None else "misses")
+        return value
+
+    def set(self, model: str, template_version: str, prompt_input: str, value: str):
+        if not self.enabled:
+            return
+        try:
+            self.backend.set(self.make_key(model, template_version, prompt_input), value)
+        except Exception as e:
+            logger.warning(f"Errore nella scrittura della cache LLM: {e}")
+
+    #Varianti async: il backend SQLite fa I/O su disco, quindi lo eseguo fuori dal loop di eventi
+    async def aget(self, model: str, template_version: str, prompt_input: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        return await asyncio.to_thread(self.get, model, template_version, prompt_input)
+
+    async def aset(self, model: str, template_version: str, prompt_input: str, value: str):
+        if not self.enabled:
+            return
+        await asyncio.to_thread(self.set, model, template_version, prompt_input, value)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            by_template = {}
+            for version, counters in self._stats.items():
+                lookups = counters["hits"] + counters["misses"]
+                by_template[version] = {**counters, "hit_rate": round(counters["hits"] / lookups, 3) if lookups else 0.0}
+        hits = sum(c["hits"] for c in by_template.values())
+        lookups = hits + sum(c["misses"] for c in by_template.values())
+        return {
+            "backend": self.backend.name if self.enabled else "none",
+            "entries": self.backend.size() if self.enabled else 0,
+            "hits": hits,
+            "misses": lookups - hits,
+            "hit_rate": round(hits / lookups, 3) if lookups else 0.0,
+            "by_template": by_template,
+        }
+
+    def _count(self, template_version: str, counter: str):
+        with self._lock:
+            counters = self._stats.setdefault(template_version, {"hits": 0, "misses": 0})
+            counters[counter] += 1
+
+
+#Costruisce la cache dalle variabili d'ambiente:
+#LLM_CACHE_BACKEND = memory (default) | sqlite | none, LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES
+def build_llm_cache_from_env() -> LLMResponseCache:
+    backend_name = os.getenv("LLM_CACHE_BACKEND", "memory").lower()
+    max_entries = os.getenv("LLM_CACHE_MAX_ENTRIES")
+
+    if backend_name == "none":
+        return LLMResponseCache(None)
+    if backend_name == "sqlite":
+        path = os.getenv("LLM_CACHE_PATH", "cache/llm_cache.sqlite3")
+        return LLMResponseCache(SQLiteCacheBackend(path, int(max_entries or 50000)))
+    return LLMResponseCache(MemoryCacheBackend(int(max_entries or 4096)))
+
+
+#Istanza condivisa dal processo
+llm_cache = build_llm_cache_from_env()
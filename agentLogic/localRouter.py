@@ -0,0 +1,99 @@
+#Questo file implementa il router locale: ricava route, entità e keyword senza chiamate di rete,
+#usando GLiNER sulla domanda e verificando sul grafo quali entità esistono davvero nel documento corrente
+
+import asyncio
+import logging
+import os
+import re
+from typing import Any, Dict, List, Tuple
+
+from db.graph_db import GraphDB
+from processingPdf.extractor import EntityExtractor
+from processingPdf.modelRegistry import run_inference
+
+logger = logging.getLogger(__name__)
+
+#Modalità del router: "llm" (solo Mistral), "auto" (router locale con escalation a Mistral
+#se la confidenza è bassa) oppure "local" (completamente offline)
+ROUTER_MODE = os.getenv("ROUTER_MODE", "llm").lower()
+ROUTER_CONFIDENCE_THRESHOLD = float(os.getenv("ROUTER_CONFIDENCE_THRESHOLD", "0.7"))
+
+#Espressioni che indicano una domanda descrittiva/concettuale (spiegazioni, relazioni, procedure)
+DESCRIPTIVE_MARKERS = (
+    "come", "perché", "perche", "spiega", "spiegami", "descrivi", "illustra", "significa",
+    "differenza", "differenze", "relazione", "rapporto", "in che modo", "quali sono", "cosa comporta",
+    "esempi", "esempio", "confronta", "influisce", "funziona",
+)
+
+#Stopword italiane escluse dalle keyword della ricerca vettoriale
+STOPWORDS = {
+    "il", "lo", "la", "i", "gli", "le", "un", "uno", "una", "di", "a", "da", "in", "con", "su", "per", "tra", "fra",
+    "del", "dello", "della", "dei", "degli", "delle", "al", "allo", "alla", "ai", "agli", "alle", "dal", "dallo",
+    "dalla", "dai", "dagli", "dalle", "nel", "nello", "nella", "nei", "negli", "nelle", "sul", "sullo", "sulla",
+    "sui", "sugli", "sulle", "e", "ed", "o", "od", "ma", "che", "chi", "cui", "non", "si", "ci", "mi", "ti", "vi",
+    "è", "e'", "sono", "sia", "essere", "ha", "hanno", "ho", "c'è", "cos'è", "cosa", "cos", "quale", "quali",
+    "quanto", "quanti", "quanta", "quante", "dove", "quando", "come", "perché", "perche", "puoi", "può",
+    "dimmi", "spiegami", "spiega", "descrivi", "questo", "questa", "questi", "queste", "quello", "quella",
+    "documento", "file", "pdf", "secondo", "viene", "vengono", "fa", "fanno", "l'", "un'", "dell'", "all'",
+}
+
+MAX_KEYWORDS = 5
+
+
+#Estrae fino a MAX_KEYWORDS keyword: prima le entità, poi i termini significativi della domanda
+def extract_keywords(query: str, entity_names: List[str]) -> List[str]:
+    keywords = []
+    for name in entity_names:
+        if name not in keywords:
+            keywords.append(name)
+
+    tokens = re.findall(r"[\w][\w\-']*", query.lower())
+    for token in tokens:
+        token = token.split("'")[-1]
+        if len(token) > 2 and token not in STOPWORDS and not any(token in k.split() for k in keywords):
+            keywords.append(token)
+        if len(keywords) >= MAX_KEYWORDS:
+            break
+    return keywords[:MAX_KEYWORDS]
+
+
+#Decide la route e una confidenza euristica a partire dalle entità estratte e da quelle confermate nel grafo
+def classify_route(query: str, extracted: List[str], confirmed: List[str]) -> Tuple[str, float]:
+    normalized = " " + " ".join(re.findall(r"[\w']+", query.lower())) + " "
+    descriptive = any(f" {marker} " in normalized for marker in DESCRIPTIVE_MARKERS)
+    token_count = len(query.split())
+
+    if confirmed:
+        if descriptive:
+            return "hybrid", 0.75
+        if token_count <= 8:
+            return "cypher", 0.8
+        return "hybrid", 0.6
+    if extracted:
+        # GLiNER vede entità che il grafo del documento non conosce: caso ambiguo, l'LLM può fare meglio
+        return "vector", 0.4
+    return "vector", 0.8 if descriptive else 0.65
+
+
+#Produce un intent con la stessa forma di quello di Mistral (route, entities, keywords) più la confidenza
+async def route_locally(query: str, filename: str) -> Tuple[Dict[str, Any], float]:
+    entities = await run_inference(EntityExtractor.extract_ne, query)
+    extracted = [ent["text"] for ent in entities]
+
+    confirmed = []
+    if extracted:
+        try:
+            db = await asyncio.to_thread(GraphDB)
+            confirmed = await asyncio.to_thread(db.find_document_entities, extracted, filename)
+        except Exception as e:
+            logger.warning(f"Router locale: verifica delle entità sul grafo non riuscita: {e}")
+
+    route, confidence = classify_route(query, extracted, confirmed)
+    intent = {
+        "route": route,
+        "entities": confirmed,
+        "keywords": extract_keywords(query, confirmed or extracted),
+        "router": "local",
+        "confidence": confidence,
+    }
+    return intent, confidence
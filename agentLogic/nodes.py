@@ -3,17 +3,29 @@
 import os
 import json
 import re
+import asyncio
 import logging
-from groq import Groq
+import numpy as np
+from typing import Optional
+from groq import AsyncGroq
 from mistralai import Mistral
-from agentLogic.state import AgentState
+from langgraph.types import StreamWriter
+from agentLogic.state import AgentState, RetrievedChunk
 from db.graph_db import GraphDB
 from processingPdf.reranker import Reranker
 from processingPdf.indexer import Indexer
+from processingPdf.modelRegistry import run_inference
+from agentLogic.answerCache import answer_cache
+from agentLogic.contextPacker import pack_context
+from processingPdf.vectorStore import local_vector_store
+from processingPdf.embeddingCodec import EMBEDDING_GRAPH_STORAGE, decode_vector
+from agentLogic.llmCache import llm_cache
+from agentLogic.localRouter import route_locally, ROUTER_MODE, ROUTER_CONFIDENCE_THRESHOLD
 
 logger = logging.getLogger(__name__)
 
-groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+# Client asincroni: le chiamate HTTP agli LLM non bloccano il loop di FastAPI
+groq_client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"))
 mistral_client = Mistral(api_key=os.getenv("MISTRAL_API_KEY"))
 
 # Inizializziamo i modelli pesanti fuori dai nodi per caricarli una sola volta all'avvio
@@ -21,8 +33,19 @@ mistral_client = Mistral(api_key=os.getenv("MISTRAL_API_KEY"))
 indexer_instance = Indexer() 
 reranker_model = Reranker()
 
-#Estrae e pulisce il JSON dall'output dell'LLM
-def extract_json(text):
+# Se attiva, la ricerca vettoriale globale parte insieme a quella locale invece che dopo. È disattivata di default:
+# il risultato serve solo quando la pertinenza locale è bassa, quindi lanciarla sempre raddoppierebbe il carico vettoriale su Neo4j
+SPECULATIVE_GLOBAL_SEARCH = os.getenv("SPECULATIVE_GLOBAL_SEARCH", "0") == "1"
+
+# Modelli e versioni dei template dei prompt deterministici: sono parte della chiave della cache LLM,
+# quindi vanno incrementate a ogni modifica del prompt corrispondente
+REWRITER_MODEL = "llama-3.1-8b-instant"
+REWRITER_PROMPT_VERSION = "rewriter-v1"
+ROUTER_MODEL = "labs-devstral-small-2512"
+ROUTER_PROMPT_VERSION = "router-v1"
+
+#Estrae il JSON dall'output dell'LLM, restituendo None se non è parsabile
+def parse_json_block(text):
     try:
         #Cerca il blocco tra parentesi graffe
         match = re.search(r'\{.*\}', text, re.DOTALL)
@@ -31,13 +54,28 @@ def extract_json(text):
         return json.loads(text)
     except Exception as e:
         logger.error(f"Errore nel parsare il JSON: {e}")
-        return {"route": "vector", "entities": [], "keywords": []}
+        return None
+
+#Intent di ripiego quando l'output del router non è un JSON valido
+def default_intent():
+    return {"route": "vector", "entities": [], "keywords": []}
+
+#Estrae e pulisce il JSON dall'output dell'LLM
+def extract_json(text):
+    parsed = parse_json_block(text)
+    return parsed if parsed is not None else default_intent()
 
 #Nodo rewriter: Pulisce la query, corregge errori e agisce da Guardrail. precedentemente aveva anche una funzione di
 # ampliamento contestuale ma ho deciso di eliminare l'espansione semantica forzata per evitare di compromettere il contesto del RAG come successo in fase di testing
-def node_rewriter(state: AgentState):
+async def node_rewriter(state: AgentState):
     user_query = state["query"]
 
+    # Con temperature=0 il rewriter è deterministico: riuso la correzione già calcolata per lo stesso input
+    cached_query = await llm_cache.aget(REWRITER_MODEL, REWRITER_PROMPT_VERSION, user_query)
+    if cached_query is not None:
+        print(f"DEBUG - Query Rewriting (cache): '{user_query}' -> '{cached_query}'")
+        return {"query": cached_query}
+
     prompt = f"""
     ### ROLE
     Sei un correttore ortografico e/o grammaticale e sintattico. Il tuo unico output deve essere la query corretta.
@@ -55,8 +93,8 @@ def node_rewriter(state: AgentState):
     OUTPUT:
     """
 
-    completion = groq_client.chat.completions.create(
-        model="llama-3.1-8b-instant",
+    completion = await groq_client.chat.completions.create(
+        model=REWRITER_MODEL,
         messages=[
             {"role": "system", "content": "Sei un correttore di testo puro. Non salutare. Non spiegare. Restituisci SOLO il risultato."},
             {"role": "user", "content": prompt}
@@ -69,15 +107,56 @@ def node_rewriter(state: AgentState):
     rewritten_query = rewritten_query.replace('Output:', '').replace('"', '').strip()
 
     print(f"DEBUG - Query Rewriting: '{user_query}' -> '{rewritten_query}'")
+    await llm_cache.aset(REWRITER_MODEL, REWRITER_PROMPT_VERSION, user_query, rewritten_query)
     
     return {"query": rewritten_query}
 
+# Versione del contenuto del documento letta da Neo4j, o None se non è disponibile (in quel caso la cache non viene usata)
+def fetch_document_version(filename: str) -> Optional[str]:
+    try:
+        return GraphDB().get_document_version(filename)
+    except Exception as e:
+        logger.warning(f"Versione del documento '{filename}' non disponibile, salto la cache delle risposte: {e}")
+        return None
+
+#Nodo cache: calcolo l'embedding della query riscritta e cerco nella cache semantica del documento una domanda
+#abbastanza simile già risolta. La cache è legata alla versione del contenuto del documento, letta in parallelo all'embedding.
+#In caso di hit la risposta salvata chiude il grafo senza router, retrieval e generazione
+async def node_cache_lookup(state: AgentState):
+    query_embedding, document_version = await asyncio.gather(
+        run_inference(indexer_instance.embed_query, state["query"]),
+        asyncio.to_thread(fetch_document_version, state["filename"]),
+    )
+    hit = answer_cache.lookup(state["filename"], document_version, query_embedding) if document_version is not None else None
+
+    if hit:
+        print(f"DEBUG - Cache semantica: hit per '{state['query']}' (simile a '{hit['query']}', sim={hit['similarity']:.3f})")
+        return {"query_embedding": query_embedding, "document_version": document_version, "final_answer": hit["answer"], "cache_hit": True}
+
+    return {"query_embedding": query_embedding, "document_version": document_version, "cache_hit": False}
+
 #Nodo 1: utilizzo mistral per decidere la strategia di ricerca"
-def node_router(state: AgentState):
+async def node_router(state: AgentState):
     """
     Nodo 1: Utilizza Mistral per decidere la strategia di ricerca.
     Implementa Role Prompting, Few-Shot, Constraint Enforcement e Output Structuring.
+    Un intent già in cache per la stessa domanda viene riusato subito. Altrimenti, con ROUTER_MODE="auto"
+    prova il router locale e passa a Mistral solo se la confidenza è bassa; con ROUTER_MODE="local" non chiama Mistral.
     """
+
+    # Il prompt è fisso: per la stessa domanda riuso l'intent già calcolato, prima ancora del router locale
+    # (che richiede embedding ed estrazione delle entità)
+    cached_intent = await llm_cache.aget(ROUTER_MODEL, ROUTER_PROMPT_VERSION, state["query"])
+    if cached_intent is not None:
+        return {"intent_data": json.loads(cached_intent)}
+
+    local_intent = None
+    if ROUTER_MODE in ("local", "auto"):
+        local_intent, confidence = await route_locally(state["query"], state["filename"])
+        if ROUTER_MODE == "local" or confidence >= ROUTER_CONFIDENCE_THRESHOLD:
+            print(f"DEBUG - Router locale (confidenza {confidence:.2f}): {local_intent['route']}")
+            return {"intent_data": local_intent}
+        print(f"DEBUG - Router locale poco sicuro (confidenza {confidence:.2f}), escalation a Mistral")
     
     # Nota: Usiamo le doppie parentesi graffe {{ }} per includere JSON letterali nelle f-strings.
     prompt = f"""
@@ -123,128 +202,242 @@ def node_router(state: AgentState):
     "{state['query']}"
     """
 
-    response = mistral_client.chat.complete(
-        model="labs-devstral-small-2512",
-        messages=[{"role": "user", "content": prompt}]
-    )
+    try:
+        response = await mistral_client.chat.complete_async(
+            model=ROUTER_MODEL,
+            messages=[{"role": "user", "content": prompt}]
+        )
+    except Exception as e:
+        # In modalità auto, se il router remoto non risponde uso comunque l'intent locale
+        if local_intent is None:
+            raise
+        logger.warning(f"Router Mistral non disponibile, uso l'intent locale: {e}")
+        return {"intent_data": local_intent}
 
     # Estrazione e parsing del JSON dalla risposta del modello
     content = response.choices[0].message.content
-    intent_json = extract_json(content)
+    intent_json = parse_json_block(content)
+
+    # Salvo in cache solo gli intent parsati correttamente, non il fallback di default
+    if intent_json is not None:
+        await llm_cache.aset(ROUTER_MODEL, ROUTER_PROMPT_VERSION, state["query"], json.dumps(intent_json, ensure_ascii=False))
+    else:
+        intent_json = default_intent()
     
     # Fondamentale: restituiamo il dizionario parsato per i nodi successivi
     return {"intent_data": intent_json}
 
-# Esegue la ricerca ibrida su neo4j basandosi sull'intent
-def node_retriever(state: AgentState):
+# Ultima risorsa quando il documento non ha né la matrice locale né embedding float32 nell'indice: top-k esatto sugli
+# embedding salvati nel grafo (compatti o, per i chunk non ancora riscritti, lista float32), senza indice.
+# Lo score si calcola con la query in float32 sui vettori decodificati (stessa scala dell'indice Neo4j)
+def compact_document_vector_search(db: GraphDB, embedding, filename: str, k: int):
+    records = db.get_document_compact_embeddings(filename)
+    if not records:
+        return []
+    matrix = np.stack([
+        decode_vector(r["embedding_q"], r["embedding_scale"], r["embedding_dtype"]) if r.get("embedding_q") is not None
+        else np.asarray(r["embedding"], dtype=np.float32)
+        for r in records
+    ])
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    query = np.asarray(embedding, dtype=np.float32)
+    query /= max(float(np.linalg.norm(query)), 1e-12)
+    scores = matrix.dot(query)
+    top = np.argsort(-scores)[:k]
+    return [(records[i]["chunk_id"], float((1.0 + scores[i]) / 2.0)) for i in top]
+
+# Ricerca vettoriale sul solo documento. I candidati arrivano da una struttura indicizzata:
+# 1. la matrice locale memory-mapped del file (top-k con NumPy, ricalcolato a precisione piena se la matrice è compatta),
+#    poi vado su Neo4j solo per il contenuto dei chunk;
+# 2. l'indice vettoriale di Neo4j, con gli embedding float32 o per i documenti indicizzati in float32 prima del cambio di modalità;
+# 3. solo se mancano entrambi, un top-k esatto sugli embedding compatti letti dal grafo
+def search_document_vectors(db: GraphDB, embedding, filename: str, k: int, stats: dict):
+    hits = local_vector_store.search(filename, embedding, k)
+    strategy = "local_mmap"
+    if hits is None:
+        if EMBEDDING_GRAPH_STORAGE == "float32" or db.document_has_vector_index_embeddings(filename):
+            return db.query_document_vector_index("chunk_embeddings_index", embedding, filename, k=k, stats=stats)
+        if EMBEDDING_GRAPH_STORAGE == "none":
+            logger.warning(f"Nessuna matrice locale per '{filename}' e nessun embedding nel grafo: ricerca vettoriale vuota.")
+            stats.update({"strategy": "unavailable", "results": 0})
+            return []
+        logger.warning(f"Nessuna matrice locale per '{filename}': ripiego sugli embedding compatti del grafo senza indice (reindicizzare il documento).")
+        hits = compact_document_vector_search(db, embedding, filename, k)
+        strategy = f"graph_{EMBEDDING_GRAPH_STORAGE}"
+
+    scores = dict(hits)
+    results = []
+    for record in db.get_chunks_by_ids([chunk_id for chunk_id, _ in hits]):
+        results.append({**record, "score": scores[record["chunk_id"]]})
+    stats.update({"strategy": strategy, "results": len(results)})
+    return results
+
+# Ricerca vettoriale su tutti i documenti: l'indice di Neo4j copre i chunk con embedding float32; con gli embedding
+# compatti nel grafo aggiungo il top-k approssimato delle matrici locali (solo le partizioni più vicine alla query,
+# vedi VECTOR_GLOBAL_PROBES) e tengo i k migliori complessivi
+def search_global_vectors(db: GraphDB, embedding, k: int):
+    results = db.query_vector_index("chunk_embeddings_index", embedding, k=k, filename=None)
+    if EMBEDDING_GRAPH_STORAGE != "float32":
+        hits = local_vector_store.search_all(embedding, k)
+        scores = {chunk_id: score for _, chunk_id, score in hits}
+        records = db.get_chunks_by_ids([chunk_id for chunk_id in scores if chunk_id not in {r["chunk_id"] for r in results}])
+        results += [{**record, "score": scores[record["chunk_id"]]} for record in records]
+        results = sorted(results, key=lambda r: r["score"], reverse=True)[:k]
+    return results
+
+# Converte un risultato di Neo4j (entità o vettoriale) nel record strutturato che viaggia nello stato
+def to_retrieved_chunk(res: dict, source: str) -> RetrievedChunk:
+    return {
+        "chunk_id": res["chunk_id"],
+        "content": res.get("node_content") or "",
+        "filename": res.get("filename"),
+        "section": res.get("section") or "N/A",
+        "source": source,
+        "entity": res.get("entity"),
+        "retrieval_score": res.get("score"),
+        "rerank_score": None,
+    }
+
+# Etichette del metodo di recupero mostrate all'LLM nel contesto
+SOURCE_TAGS = {
+    "vector": "Vector Match",
+    "global_vector": "Global Vector Match",
+    "fallback": "Fallback Match",
+}
+
+# Costruisce il testo di un chunk per il prompt: per i match vettoriali includo file e sezione,
+# così il generatore può citare la fonte (mi interessa sapere da che file è tratta l'informazione)
+def render_chunk(chunk: RetrievedChunk) -> str:
+    if chunk["source"] == "entity":
+        return f"[Entity Match: {chunk.get('entity')}] {chunk['content']}"
+    source_info = f"[Fonte: {chunk['filename']} | Sezione: {chunk['section']}]"
+    return f"{source_info} [{SOURCE_TAGS[chunk['source']]}] {chunk['content']}"
+
+# Esegue la ricerca ibrida su neo4j basandosi sull'intent.
+# I rami di ricerca (entità, vettoriale locale e, se SPECULATIVE_GLOBAL_SEARCH=1, vettoriale globale) sono round trip
+# indipendenti: li lancio in parallelo così la latenza è quella del ramo più lento e non la somma.
+# Le query Neo4j (driver sincrono) girano in un thread e gli embedding sull'executor di inferenza
+async def node_retriever(state: AgentState):
     intent = state["intent_data"]
     target_file = state["filename"] 
-    db = GraphDB()
+    db = await asyncio.to_thread(GraphDB)
     collected_chunks = []
     seen_ids = set()
+    # Contatori per ramo (es. quanto sovracampionamento è servito alla ricerca vettoriale sul documento)
+    retrieval_stats = {}
 
     # Stampo l'intent per monitorare le decisioni del Router in tempo reale
     print(f"DEBUG - Intent ricevuto: {intent}")
 
-    # 1. RICERCA PER ENTITÀ (STRATEGIA CYPHER)
+    use_entity_search = intent.get("route") in ["cypher", "hybrid"]
+    use_vector_search = intent.get("route") in ["vector", "hybrid"]
+
+    # 1. RAMO ENTITÀ (STRATEGIA CYPHER)
     # Se il router ha scelto 'cypher' o 'hybrid', interrogo il grafo tramite le entità estratte
-    if intent.get("route") in ["cypher", "hybrid"]:
-        entities = intent.get("entities", [])
-        for entity in entities:
-            entity_name = entity["value"] if isinstance(entity, dict) else entity
-            
-            # Nota: Al momento entity_search esegue una ricerca globale. 
-            results = db.entity_search(entity_name)
-            for res in results:
-                # Aggiungo un controllo di sicurezza per assicurarmi di prendere solo i chunk del documento corrente
-                if res["chunk_id"] not in seen_ids and res.get("filename") == target_file:
-                    content_text = res.get("node_content", "")
-                    collected_chunks.append(f"[Entity Match: {entity_name}] {content_text}")
-                    seen_ids.add(res["chunk_id"])
-    
-    # 2. RICERCA VETTORIALE (STRATEGIA SEMANTICA)
+    async def entity_branch():
+        entity_names = [entity["value"] if isinstance(entity, dict) else entity for entity in intent.get("entities", [])]
+        # Un'unica query per tutte le entità, già filtrata sul documento corrente
+        return await asyncio.to_thread(db.entity_search_bulk, entity_names, target_file)
+
+    entity_task = asyncio.create_task(entity_branch()) if use_entity_search else None
+
+    # 2. RAMI VETTORIALI (STRATEGIA SEMANTICA)
     # Se il router ha scelto 'vector' o 'hybrid', utilizzo gli embeddings per la similarità
-    if intent.get("route") in ["vector", "hybrid"]:
+    local_task = None
+    global_task = None
+    if use_vector_search:
         keywords = intent.get("keywords", [])
         search_query = " ".join(keywords) if keywords else state["query"]
         
-        # Uso l'istanza caricata all'avvio del server
-        embedding = indexer_instance.generate_embeddings(search_query)
+        # Uso l'istanza caricata all'avvio del server (l'embedding si sovrappone al ramo entità già avviato)
+        embedding = await run_inference(indexer_instance.embed_query, search_query)
         
         # Ho deciso di passare 'target_file' come parametro 'filename' per attivare il filtro Cypher 
         # interno alla query vettoriale e isolare il documento
-        vector_results = db.query_vector_index(
-            "chunk_embeddings_index", 
+        # La ricerca è garantita sul documento: sovracampiona l'indice globale (o passa alla ricerca esatta)
+        # finché non ottiene fino a k chunk del file
+        local_task = asyncio.create_task(asyncio.to_thread(
+            search_document_vectors,
+            db,
             embedding, 
+            target_file,
             k=15, 
-            filename=target_file
-        )
+            stats=retrieval_stats.setdefault("local_vector", {})
+        ))
+
+        #Se richiesto, la ricerca globale viene lanciata in modo speculativo insieme a quella locale; il risultato
+        #viene usato solo se la pertinenza locale risulta bassa (SPECULATIVE_GLOBAL_SEARCH=1 per attivarla)
+        if SPECULATIVE_GLOBAL_SEARCH:
+            global_task = asyncio.create_task(asyncio.to_thread(search_global_vectors, db, embedding, k=5))
+
+    # 3. MERGE: stesso ordine e deduplicazione per chunk_id del flusso sequenziale
+    if entity_task:
+        for res in await entity_task:
+            # Aggiungo un controllo di sicurezza per assicurarmi di prendere solo i chunk del documento corrente
+            if res["chunk_id"] not in seen_ids and res.get("filename") == target_file:
+                collected_chunks.append(to_retrieved_chunk(res, "entity"))
+                seen_ids.add(res["chunk_id"])
+
+    if local_task:
+        vector_results = await local_task
         
-        # Estraggo lo score del miglior risultato locale per decidere se attivare la ricerca globale
+        # Estraggo lo score del miglior risultato locale per decidere se usare la ricerca globale
         max_local_score = vector_results[0]["score"] if vector_results else 0
         print(f"DEBUG - Risultati vettoriali trovati per {target_file}: {len(vector_results)} (Max Score: {max_local_score})")
         
         for res in vector_results:
             if res["chunk_id"] not in seen_ids:
-                #includo metadati nel testo del chunk per permettere al generatore di citare la fonte
-                #mi interessa sapere, nella risposta finale, da che file è stata tratta l'informazione
-                source_info = f"[Fonte: {res.get('filename')} | Sezione: {res.get('section', 'N/A')}]"
-                content_text = res.get("node_content", "")
-                collected_chunks.append(f"{source_info} [Vector Match] {content_text}")
+                #file e sezione restano nel record, il generatore li usa per permettere all'LLM di citare la fonte
+                collected_chunks.append(to_retrieved_chunk(res, "vector"))
                 seen_ids.add(res["chunk_id"])
 
-        #attivo la GLOBAL VECTOR SEARCH se la pertinenza locale è bassa (< 0.7)
+        #uso la GLOBAL VECTOR SEARCH se la pertinenza locale è bassa (< 0.7)
         if max_local_score < 0.7:
-            print(f"DEBUG - Score locale basso ({max_local_score}), attivo Global Vector Search...")
+            print(f"DEBUG - Score locale basso ({max_local_score}), uso la Global Vector Search...")
             
             #eseguo semplicemente la query senza passare il filename per cercare in tutto il database
-            global_results = db.query_vector_index(
-                "chunk_embeddings_index", 
-                embedding, 
-                k=5, 
-                filename=None 
-            )
+            if global_task is None:
+                global_task = asyncio.create_task(asyncio.to_thread(search_global_vectors, db, embedding, k=5))
+            global_results = await global_task
             
             for res in global_results:
                 #evito duplicati se per caso la ricerca globale ripesca chunk già visti nel locale
                 if res["chunk_id"] not in seen_ids:
-                    source_info = f"[Fonte: {res.get('filename')} | Sezione: {res.get('section', 'N/A')}]"
-                    content_text = res.get("node_content", "")
-                    collected_chunks.append(f"{source_info} [Global Vector Match] {content_text}")
+                    collected_chunks.append(to_retrieved_chunk(res, "global_vector"))
                     seen_ids.add(res["chunk_id"])
+        elif global_task is not None:
+            # Il risultato speculativo non serve: lo attendo comunque per non lasciare task pendenti
+            await global_task
 
     # se i metodi precedenti non producono risultati,
     # forzo una ricerca vettoriale sull'intera query originale filtrata per il file corrente
     if not collected_chunks:
         print(f"DEBUG - Fallback: nessuna informazione con keyword in {target_file}, procedo con query completa.")
-        embedding_fallback = indexer_instance.generate_embeddings(state["query"])
+        # Riuso l'embedding della query già calcolato dal nodo cache, se disponibile
+        embedding_fallback = state.get("query_embedding") or await run_inference(indexer_instance.embed_query, state["query"])
         
         # Anche nel fallback, forzo il filtro sul filename per evitare contaminazioni
-        fallback_results = db.query_vector_index(
-            "chunk_embeddings_index", 
+        fallback_results = await asyncio.to_thread(
+            search_document_vectors,
+            db,
             embedding_fallback, 
+            target_file,
             k=3, 
-            filename=target_file
+            stats=retrieval_stats.setdefault("fallback_vector", {})
         )
         for res in fallback_results:
             if res["chunk_id"] not in seen_ids:
-                source_info = f"[Fonte: {res.get('filename')} | Sezione: {res.get('section', 'N/A')}]"
-                content_text = res.get("node_content", "")
-                collected_chunks.append(f"{source_info} [Fallback Match] {content_text}")
+                collected_chunks.append(to_retrieved_chunk(res, "fallback"))
                 seen_ids.add(res["chunk_id"])
 
-    # gestisco esplicitamente il caso di assenza totale di dati per evitare errori nel Generator
-    if not collected_chunks:
-        collected_chunks = [f"Nessuna informazione specifica trovata nel database per il file {target_file}."]
-
     db.close()
     # stampo quanti chunk sto effettivamente restituendo allo stato
-    print(f"DEBUG - RETRIEVER sta inviando allo stato {len(collected_chunks)} chunk")
+    print(f"DEBUG - RETRIEVER sta inviando allo stato {len(collected_chunks)} chunk (statistiche: {retrieval_stats})")
     
-    return {"context_chunks": collected_chunks}
+    return {"context_chunks": collected_chunks, "retrieval_stats": retrieval_stats}
 
 #Nodo reranker, ottiene i 15 chunks più pertinenti dal retriever e si occupa di prendere i 5 veramente più pertinenti rispetto alla domanda dell'utente
-def node_reranker(state: AgentState):
+async def node_reranker(state: AgentState):
     query = state["query"]
     chunks = state.get("context_chunks", [])
     intent = state.get("intent_data", {})
@@ -256,24 +449,32 @@ def node_reranker(state: AgentState):
     
     print(f"DEBUG Reranker: Analizzo {len(chunks)} chunk...")
 
-    #eseguo il reranking tramite il modello BGE-Reranker-v2-m3
-    refined_chunks = reranker_model.rerank(query, chunks, top_n=5)
+    #eseguo il reranking tramite il modello BGE-Reranker-v2-m3 sul solo contenuto dei chunk
+    refined_chunks = await run_inference(reranker_model.rerank_records, query, chunks, top_n=5)
     print(f"DEBUG Reranker: Ho selezionato i {len(refined_chunks)} migliori.")
     return {"context_chunks": refined_chunks}
 
-#Nodo finale: uso Llama per la risposta
-def node_generator(state: AgentState):
+#Nodo finale: uso Llama per la risposta. La completion viene letta in streaming e ogni token viene
+#emesso sul canale "custom" di LangGraph (writer), così /chat/stream può inoltrarlo subito al client
+async def node_generator(state: AgentState, writer: StreamWriter):
     chunks = state.get('context_chunks', [])
     print(f"DEBUG - Numero di chunk passati al generatore: {len(chunks)}")
     
-    context = "\n\n".join(chunks)
+    # Unisco i chunk consecutivi della stessa sezione (senza la sovrapposizione del Chunker) e riempio il budget di token in ordine di rank
+    fragments, context_stats = pack_context(chunks)
+    print(f"DEBUG - Context packing: {context_stats['chunks_in']} chunk -> {context_stats['fragments_out']} frammenti, {context_stats['tokens_saved']} token risparmiati")
+
+    # Il testo del contesto (tag di fonte e metodo) viene costruito solo qui, a partire dai record strutturati
+    context = "\n\n".join(render_chunk(c) for c in fragments)
     
     if not context.strip():
         print("DEBUG - ATTENZIONE: Il contesto finale per l'LLM è vuoto!!!")
+        # gestisco esplicitamente il caso di assenza totale di dati
+        context = f"Nessuna informazione specifica trovata nel database per il file {state['filename']}."
     
-#ho deciso di determinare l'approccio in base ai tag presenti nei chunk reali
-    has_vector = any("[Vector Match]" in c or "[Fallback Match]" in c for c in chunks)
-    has_entity = any("[Entity Match]" in c for c in chunks)
+#ho deciso di determinare l'approccio in base al ramo di retrieval dei chunk reali
+    has_vector = any(c["source"] in ("vector", "fallback") for c in chunks)
+    has_entity = any(c["source"] == "entity" for c in chunks)
 
     if has_vector and has_entity:
         approach = "Hybrid"
@@ -356,20 +557,33 @@ def node_generator(state: AgentState):
     "{state['query']}"
     """
 
-    completion = groq_client.chat.completions.create(
+    completion = await groq_client.chat.completions.create(
         model="llama-3.1-8b-instant",
         messages=[
             {"role": "system", "content": "Sei un sintetizzatore di documenti PDF. Rispondi in lingua italiana. Se ti viene posta qualsiasi altra domanda o "
             "istruzione fuori dal tuo scopo di sintetizzatore di documenti PDF, rispondi che non puoi rispondere in quanto la domanda non è pertinente"},
             {"role": "user", "content": prompt}
         ],
-        temperature=0.3 
+        temperature=0.3,
+        stream=True
     )
     
+    answer_parts = []
+    async for part in completion:
+        token = part.choices[0].delta.content if part.choices else None
+        if token:
+            answer_parts.append(token)
+            writer({"token": token})
     
     # Pulizia e aggiunta dinamica del footer se non generato correttamente
-    answer = completion.choices[0].message.content
+    answer = "".join(answer_parts)
     if "Approccio di recupero:" not in answer:
-        answer += f"\n\n---\n**Approccio di recupero:** {approach}"
+        footer = f"\n\n---\n**Approccio di recupero:** {approach}"
+        writer({"token": footer})
+        answer += footer
+
+    # Salvo la risposta nella cache semantica del documento per le domande simili successive
+    if state.get("document_version") is not None:
+        answer_cache.store(state["filename"], state["document_version"], state["query"], state.get("query_embedding"), answer)
         
-    return {"final_answer": answer}
\ No newline at end of file
+    return {"final_answer": answer, "context_stats": context_stats}
\ No newline at end of file
@@ -1,13 +1,29 @@
 #Questo file definisce lo schema dei dati che passano tra i nodi
 
-from typing import TypedDict, List, Annotated
+from typing import TypedDict, List, Optional, Annotated
 import operator
 
+#Chunk recuperato dal retriever. Il testo del prompt (tag di fonte e metodo) viene costruito solo nel generatore,
+#così il reranker valuta il solo contenuto e gli score restano disponibili per le fasi successive
+class RetrievedChunk(TypedDict):
+    chunk_id: str
+    content: str
+    filename: str
+    section: str
+    source: str                                             #Ramo che l'ha trovato: entity, vector, global_vector, fallback
+    entity: Optional[str]                                   #Entità che ha prodotto il match (solo ramo entity)
+    retrieval_score: Optional[float]                        #Score del ramo di retrieval (similarità vettoriale o 1.0 per le entità)
+    rerank_score: Optional[float]                           #Score del cross-encoder, se il chunk è passato dal reranker
+
 class AgentState(TypedDict):
     query: str                                              #Domanda originale utente
     user_id: str
     filename: str                                           
     intent_data: dict                                       #Output di Mistral (route, entities, keywords)
-    context_chunks: list
+    query_embedding: list                                   #Embedding della query riscritta (cache semantica e fallback)
+    cache_hit: bool                                         #True se la risposta proviene dalla cache semantica
+    document_version: Optional[str]                         #Versione del contenuto del documento (None se non disponibile)
+    context_chunks: List[RetrievedChunk]
+    retrieval_stats: dict                                   #Contatori per ramo di retrieval (strategia, sovracampionamento)
+    context_stats: dict                                     #Statistiche del context packing (chunk uniti, token risparmiati)
     final_answer: str
-
@@ -1,9 +1,32 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 from agentLogic.graph import app as rag_app
 from processingPdf.indexer import Indexer
+from processingPdf.modelRegistry import model_registry
+from processingPdf.jobQueue import IngestionJobQueue, IngestionQueueFull
+from processingPdf.embeddingCache import query_embedding_cache
+from agentLogic.answerCache import answer_cache
+from agentLogic.llmCache import llm_cache
+from processingPdf.vectorStore import local_vector_store
+from processingPdf.layoutCache import layout_cache
+from processingPdf.layoutPool import shutdown_layout_pool
+from db.graph_db import GraphDB, close_shared_drivers
 import shutil
+# Parser multipart in streaming (python-multipart, lo stesso usato da FastAPI per i form)
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+    from python_multipart.exceptions import MultipartParseError
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+    from multipart.exceptions import MultipartParseError
 import os
+import re
+import tempfile
+import json
+from collections import Counter
 import logging
 
 port = int(os.environ.get("PORT", 8000))
@@ -16,7 +39,26 @@ if __name__ == "__main__":
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # All'avvio creo il driver Neo4j condiviso ed eseguo una sola volta il bootstrap di indici e vincoli,
+    # così le richieste successive pagano solo le query di retrieval
+    try:
+        GraphDB()
+    except Exception as e:
+        logger.warning(f"Bootstrap Neo4j non riuscito all'avvio, verrà ritentato alla prima richiesta: {e}")
+    # Scaricamento opzionale dei modelli inattivi (MODEL_IDLE_UNLOAD_SECONDS)
+    model_registry.start_idle_reaper()
+    # Salvataggio periodico della cache degli embedding delle query (QUERY_EMBEDDING_CACHE_FLUSH_SECONDS)
+    query_embedding_cache.start_periodic_flush()
+    yield
+    ingestion_queue.shutdown()
+    shutdown_layout_pool()
+    # Persisto la cache degli embedding delle query (se QUERY_EMBEDDING_CACHE_PATH è configurato)
+    query_embedding_cache.save()
+    close_shared_drivers()
+
+app = FastAPI(lifespan=lifespan)
 
 # Middleware CORS per il frontend React
 app.add_middleware(
@@ -27,42 +69,188 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Inizializzazione dell'Indexer 
+# Inizializzazione dell'Indexer (il modello di embedding è condiviso con l'agent tramite il registro dei modelli)
 indexer_worker = Indexer()
 
-@app.post("/upload")
-async def upload_pdf(file: UploadFile = File(...), user_id: str = Form(...)):
+# Coda dei job di indicizzazione: i PDF vengono processati su un pool di worker dedicato (INGESTION_WORKERS).
+# Al termine di ogni indicizzazione le risposte salvate per il documento non sono più valide
+ingestion_queue = IngestionJobQueue(indexer_worker, on_document_indexed=answer_cache.invalidate)
+
+@app.get("/models")
+async def models_status():
+    """
+    Endpoint che riporta i modelli caricati nel processo e la loro occupazione in memoria.
     """
-    Endpoint per caricare un PDF e indicizzarlo in Neo4j.
+    return model_registry.memory_report()
+
+@app.get("/cache/stats")
+async def cache_stats():
     """
-    # Cartella temporanea per processare il file
-    upload_dir = "temp_uploads"
-    os.makedirs(upload_dir, exist_ok=True)
-    file_path = os.path.join(upload_dir, file.filename)
+    Endpoint che riporta dimensione e hit rate delle cache del processo.
+    """
+    return {
+        "query_embeddings": query_embedding_cache.stats(),
+        "answers": answer_cache.stats(),
+        "llm_responses": llm_cache.stats(),
+        "local_vectors": local_vector_store.stats(),
+        "pdf_layout": layout_cache.stats()
+    }
+
+# Limiti dell'upload: dimensione massima del PDF e dimensione del buffer di scrittura su disco
+MAX_UPLOAD_BYTES = int(float(os.getenv("MAX_UPLOAD_MB", "200")) * 1024 ** 2)
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_KB", "1024")) * 1024
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR", "temp_uploads")
+# Margine concesso al corpo multipart oltre al PDF (boundary, intestazioni delle parti, campo user_id)
+UPLOAD_OVERHEAD_BYTES = 1024 ** 2
+
+# Nome del file ricevuto dal client ridotto al solo nome base (niente percorsi) e senza caratteri di controllo
+def _safe_upload_name(filename: str) -> str:
+    name = os.path.basename((filename or "").replace("\\", "/"))
+    name = re.sub(r"[\x00-\x1f]", "", name).strip()
+    return name if name not in ("", ".", "..") else "documento.pdf"
+
+def _too_large() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Il file supera il limite di {MAX_UPLOAD_BYTES // 1024 ** 2} MB.")
+
+# Legge il corpo multipart direttamente da request.stream(): la parte "file" viene scritta su disco mentre arriva
+# e la lettura si interrompe appena si supera MAX_UPLOAD_MB, senza che FastAPI bufferizzi prima l'intero upload.
+# Il parser (e con lui le scritture su disco fatte dalle callback) gira nel threadpool, così il loop non si blocca sull'I/O.
+# Restituisce (nome del file, percorso su disco, user_id)
+async def _receive_upload(request: Request, upload_dir: str):
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Il corpo della richiesta deve essere multipart/form-data.")
+
+    part = {"headers": {}, "field": bytearray(), "value": bytearray(), "kind": None}
+    upload = {"filename": None, "file_path": None, "buffer": None, "size": 0, "user_id": bytearray()}
+
+    def on_part_begin():
+        part.update(headers={}, kind=None)
+
+    def on_header_field(data, start, end):
+        part["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        part["value"] += data[start:end]
+
+    def on_header_end():
+        part["headers"][bytes(part["field"]).lower()] = bytes(part["value"])
+        part["field"].clear()
+        part["value"].clear()
+
+    def on_headers_finished():
+        _, options = parse_options_header(part["headers"].get(b"content-disposition", b""))
+        name = options.get(b"name", b"").decode("utf-8", "replace")
+        # Tengo solo il primo campo "file" e il campo "user_id"; le altre parti vengono ignorate
+        if name == "file" and b"filename" in options and upload["file_path"] is None:
+            upload["filename"] = _safe_upload_name(options[b"filename"].decode("utf-8", "replace"))
+            upload["file_path"] = os.path.join(upload_dir, upload["filename"])
+            upload["buffer"] = open(upload["file_path"], "wb", buffering=UPLOAD_CHUNK_BYTES)
+            part["kind"] = "file"
+        elif name == "user_id":
+            upload["user_id"].clear()
+            part["kind"] = "user_id"
+
+    def on_part_data(data, start, end):
+        if part["kind"] == "file":
+            upload["size"] += end - start
+            if upload["size"] > MAX_UPLOAD_BYTES:
+                raise _too_large()
+            upload["buffer"].write(data[start:end])
+        elif part["kind"] == "user_id":
+            upload["user_id"] += data[start:end]
+
+    def on_part_end():
+        if part["kind"] == "file":
+            upload["buffer"].close()
+            upload["buffer"] = None
+
+    parser = MultipartParser(boundary, {
+        "on_part_begin": on_part_begin,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+    })
+
+    received = 0
+    try:
+        async for block in request.stream():
+            received += len(block)
+            if received > MAX_UPLOAD_BYTES + UPLOAD_OVERHEAD_BYTES:
+                raise _too_large()
+            await run_in_threadpool(parser.write, block)
+        await run_in_threadpool(parser.finalize)
+    except MultipartParseError as e:
+        raise HTTPException(status_code=400, detail=f"Corpo multipart non valido: {e}")
+    finally:
+        if upload["buffer"] is not None:
+            await run_in_threadpool(upload["buffer"].close)
+
+    user_id = upload["user_id"].decode("utf-8", "replace").strip()
+    if upload["file_path"] is None or not user_id:
+        raise HTTPException(status_code=422, detail="Campi 'file' e 'user_id' obbligatori.")
+    return upload["filename"], upload["file_path"], user_id
+
+@app.post("/upload", status_code=202)
+async def upload_pdf(request: Request):
+    """
+    Endpoint per caricare un PDF (multipart/form-data con i campi 'file' e 'user_id') e accodarne l'indicizzazione in Neo4j.
+    Restituisce subito l'id del job, il cui stato è consultabile su /jobs/{job_id}.
+    Il corpo viene letto in streaming (anche senza Content-Length, con chunked encoding) e scritto a blocchi in una
+    cartella temporanea dedicata alla richiesta; oltre MAX_UPLOAD_MB risponde 413 interrompendo la lettura.
+    """
+    # Rifiuto subito le richieste dichiaratamente troppo grandi, senza leggerne il corpo
+    declared_size = request.headers.get("content-length")
+    if declared_size and declared_size.isdigit() and int(declared_size) > MAX_UPLOAD_BYTES + UPLOAD_OVERHEAD_BYTES:
+        raise _too_large()
+
+    # Cartella temporanea per processare il file, una per richiesta: upload con lo stesso nome non si sovrascrivono
+    os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+    upload_dir = tempfile.mkdtemp(prefix="upload_", dir=UPLOAD_TMP_DIR)
     
     try:
-        # 1. Salva il file fisicamente sul server
-        logger.info(f"Ricezione file: {file.filename} per l'utente: {user_id}")
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # 1. Salva il file sul server mentre arriva, controllando la dimensione
+        filename, file_path, user_id = await _receive_upload(request, upload_dir)
+        logger.info(f"Ricevuto file: {filename} per l'utente: {user_id}")
         
-        # 2. Avvia la pipeline di indicizzazione (Extractor -> Chunker -> Neo4j)
-        indexer_worker.index_pdf(file_path, user_id)
+        # 2. Accoda la pipeline di indicizzazione (Extractor -> Chunker -> Neo4j);
+        # il job rimuove la cartella temporanea quando termina
+        job = ingestion_queue.submit(file_path, user_id, filename, cleanup_path=upload_dir)
         
         return {
-            "status": "success",
-            "message": "Indicizzazione completata con successo", 
-            "filename": file.filename
+            "status": "queued",
+            "message": "Indicizzazione avviata",
+            "job_id": job["job_id"],
+            "filename": filename
         }
 
+    except HTTPException:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise
+
+    except IngestionQueueFull as e:
+        logger.warning(str(e))
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        raise HTTPException(status_code=503, detail=str(e))
+
     except Exception as e:
-        logger.error(f"Errore durante l'upload/indicizzazione: {str(e)}")
+        logger.error(f"Errore durante l'upload: {str(e)}")
+        shutil.rmtree(upload_dir, ignore_errors=True)
         raise HTTPException(status_code=500, detail=str(e))
-    
-    finally:
-        # 3. Pulizia file temporaneo
-        if os.path.exists(file_path):
-            os.remove(file_path)
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    """
+    Endpoint per consultare fase, avanzamento ed eventuali errori di un job di indicizzazione.
+    """
+    job = ingestion_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job non trovato.")
+    return job
 
 @app.post("/chat")
 async def chat(query: str, filename: str, user_id: str):
@@ -80,8 +268,8 @@ async def chat(query: str, filename: str, user_id: str):
             "final_answer": ""
         }
         
-        # Esecuzione del workflow
-        result = rag_app.invoke(initial_state)
+        # Esecuzione asincrona del workflow: LLM, Neo4j e inferenza non bloccano il loop di eventi
+        result = await rag_app.ainvoke(initial_state)
         
         return {"answer": result["final_answer"]}
     
@@ -89,6 +277,79 @@ async def chat(query: str, filename: str, user_id: str):
         logger.error(f"Errore nella chat endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail="Errore durante l'elaborazione della domanda.")
 
+#Formatta un evento Server-Sent Events
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+#Riassume l'aggiornamento di stato prodotto da un nodo del grafo per l'evento di avanzamento
+def _summarize_node_update(node_name: str, update: dict) -> dict:
+    summary = {"node": node_name}
+    if node_name == "rewriter":
+        summary["query"] = update.get("query")
+    elif node_name == "cache_lookup":
+        summary["cache_hit"] = bool(update.get("cache_hit"))
+    elif node_name == "router":
+        summary["route"] = update.get("intent_data", {}).get("route")
+    elif node_name in ("retriever", "reranker"):
+        chunks = update.get("context_chunks", [])
+        summary["chunks"] = len(chunks)
+        #quanti chunk per ramo di retrieval (entity, vector, global_vector, fallback)
+        summary["sources"] = dict(Counter(c["source"] for c in chunks))
+        if node_name == "reranker":
+            summary["rerank_scores"] = [round(c["rerank_score"], 3) for c in chunks if c.get("rerank_score") is not None]
+        if "retrieval_stats" in update:
+            summary["retrieval_stats"] = update["retrieval_stats"]
+    return summary
+
+@app.post("/chat/stream")
+async def chat_stream(query: str, filename: str, user_id: str):
+    """
+    Endpoint di chat in streaming (text/event-stream).
+    Emette un evento 'progress' al termine di ogni nodo (rewrite, route, retrieve, rerank),
+    poi i token della risposta man mano che arrivano ('token') e infine 'done' con la risposta completa.
+    """
+    initial_state = {
+        "query": query,
+        "user_id": user_id,
+        "filename": filename,
+        "intent_data": {},
+        "context_chunks": [],
+        "final_answer": ""
+    }
+
+    async def event_stream():
+        final_answer = ""
+        context_stats = None
+        try:
+            async for mode, payload in rag_app.astream(initial_state, stream_mode=["updates", "custom"]):
+                if mode == "custom":
+                    yield _sse_event("token", payload)
+                    continue
+                for node_name, update in payload.items():
+                    if node_name == "generator":
+                        final_answer = (update or {}).get("final_answer", "")
+                        context_stats = (update or {}).get("context_stats")
+                        continue
+                    yield _sse_event("progress", _summarize_node_update(node_name, update or {}))
+                    # Risposta servita dalla cache semantica: la invio come unico blocco di testo
+                    if node_name == "cache_lookup" and (update or {}).get("cache_hit"):
+                        final_answer = update["final_answer"]
+                        yield _sse_event("token", {"token": final_answer})
+            done = {"answer": final_answer}
+            if context_stats:
+                done["context_stats"] = context_stats
+            yield _sse_event("done", done)
+        except Exception as e:
+            logger.error(f"Errore nella chat in streaming: {str(e)}")
+            yield _sse_event("error", {"detail": "Errore durante l'elaborazione della domanda."})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("api:app", host="127.0.0.1", port=8000, reload=True)
\ No newline at end of file
+    uvicorn.run("api:app", host="127.0.0.1", port=8000, reload=True)
@@ -3,13 +3,107 @@
 from neo4j import GraphDatabase, exceptions
 import logging
 import os
-from typing import List, Dict, Any, Optional
+import threading
+from typing import List, Dict, Any, Optional, Callable
 
 logger = logging.getLogger(__name__)
 
 logging.basicConfig(level=logging.INFO)
 
-#Classe per la gestione della connessione e delle operazioni di base con Neo4j
+#Driver condivisi dal processo, uno per coppia (uri, user). Il driver Neo4j è thread-safe e mantiene
+#un pool di connessioni, quindi lo creo (e ne verifico la connettività) una sola volta in modo lazy
+_shared_drivers: Dict[tuple, Any] = {}
+#Database per cui indici e vincoli sono già stati verificati in questo processo
+_schema_ready: set = set()
+#Indici vettoriali già creati/verificati in questo processo
+_vector_indexes_ready: set = set()
+_driver_lock = threading.Lock()
+
+#Restituisce il driver condiviso per le credenziali date, creandolo al primo utilizzo.
+#La dimensione del pool e i timeout sono configurabili da variabili d'ambiente
+def get_shared_driver(uri: str, user: str, password: str):
+    key = (uri, user)
+    with _driver_lock:
+        driver = _shared_drivers.get(key)
+        if driver is None:
+            driver = GraphDatabase.driver(
+                uri,
+                auth=(user, password),
+                max_connection_pool_size=int(os.getenv("NEO4J_MAX_POOL_SIZE", "50")),
+                connection_acquisition_timeout=float(os.getenv("NEO4J_CONNECTION_ACQUISITION_TIMEOUT", "60")),
+                max_connection_lifetime=float(os.getenv("NEO4J_MAX_CONNECTION_LIFETIME", "3600")),
+            )
+            try:
+                driver.verify_connectivity()
+            except Exception:
+                driver.close()
+                raise
+            _shared_drivers[key] = driver
+            logger.info(f"Driver Neo4j condiviso creato per {uri}.")
+    return driver
+
+#Chiude tutti i driver condivisi (da chiamare allo spegnimento del processo)
+def close_shared_drivers():
+    with _driver_lock:
+        for driver in _shared_drivers.values():
+            driver.close()
+        _shared_drivers.clear()
+        _schema_ready.clear()
+        _vector_indexes_ready.clear()
+    logger.info("Driver Neo4j condivisi chiusi.")
+
+#Nome del nodo (:SchemaVersion) che registra le migrazioni dei dati già applicate al database
+SCHEMA_MARKER = "graphrag"
+
+#Query UNWIND di scrittura in blocco: usate sia dai metodi omonimi (una transazione per batch) sia da
+#replace_document_chunks, che le esegue tutte nella stessa transazione (_UNLINK_ENTITIES_QUERY solo da quest'ultimo)
+_ADD_CHUNKS_QUERY = """
+    MATCH (d:Document {filename: $filename})
+    UNWIND $rows AS row
+    MERGE (c:Chunk {chunk_id: row.chunk_id})
+    SET c.content = row.content,
+        c.embedding = row.embedding,
+        c.embedding_q = row.embedding_q,
+        c.embedding_scale = row.embedding_scale,
+        c.embedding_dtype = row.embedding_dtype,
+        c.content_hash = row.content_hash,
+        c.section = COALESCE(row.section, 'unspecified'),
+        c.source = $filename,
+        c.last_updated = datetime()
+    MERGE (d)-[:HAS_CHUNK]->(c)
+    RETURN count(c) AS written
+"""
+_LINK_ENTITIES_QUERY = """
+    UNWIND $rows AS row
+    MERGE (e:Entity {name: row.name, type: row.type})
+    SET e.name_norm = toLower(trim(row.name))
+    WITH e, row
+    MATCH (c:Chunk {chunk_id: row.chunk_id})
+    MERGE (c)-[:CONTAINS_ENTITY]->(e)
+    RETURN count(*) AS written
+"""
+_UNLINK_ENTITIES_QUERY = """
+    UNWIND $rows AS row
+    MATCH (c:Chunk {chunk_id: row.chunk_id})-[r:CONTAINS_ENTITY]->()
+    DELETE r
+    RETURN count(*) AS written
+"""
+_DELETE_CHUNKS_QUERY = """
+    UNWIND $rows AS row
+    MATCH (c:Chunk {chunk_id: row.chunk_id})
+    DETACH DELETE c
+    RETURN count(*) AS written
+"""
+_DELETE_ORPHANS_QUERY = """
+    UNWIND $rows AS row
+    MATCH (e:Entity {name: row.name, type: row.type})
+    WHERE NOT (e)<-[:CONTAINS_ENTITY]-()
+    DELETE e
+    RETURN count(*) AS written
+"""
+
+#Classe per la gestione della connessione e delle operazioni di base con Neo4j.
+#Ogni istanza è un handle leggero sul driver condiviso del processo: crearne una per richiesta non apre nuove connessioni
 class GraphDB:
     def __init__(self, uri: Optional[str] = None, user: Optional[str] = None, password: Optional[str] = None, database: Optional[str] = None):
 
@@ -36,20 +130,28 @@ class GraphDB:
         self.driver = None
 
         try:
-            self.driver = GraphDatabase.driver(self.uri, auth=(self.user, self.password))
-            self.driver.verify_connectivity()
-
-            self.create_indexes_and_constraints()
-            logger.info(f"Connessione a Neo4j (DB: {self.database}) stabilita con successo.")
+            self.driver = get_shared_driver(self.uri, self.user, self.password)
+            self.ensure_schema()
         except Exception as e:
             logger.error(f"Errore durante la connessione a Neo4j su {self.uri}: {e}")
             raise
     
-    #Chiude la connessione al driver Neo4j
+    #Rilascia l'handle. Il driver condiviso resta aperto per le richieste successive e viene
+    #chiuso solo da close_shared_drivers allo spegnimento
     def close(self):
-        if self.driver:
-            self.driver.close()
-            logger.info("Connessione a Neo4j chiusa.")
+        self.driver = None
+
+    #Esegue il bootstrap dello schema una sola volta per processo e database
+    def ensure_schema(self):
+        key = (self.uri, self.database)
+        if key in _schema_ready:
+            return
+        with _driver_lock:
+            if key in _schema_ready:
+                return
+            self.create_indexes_and_constraints()
+            _schema_ready.add(key)
+            logger.info(f"Connessione a Neo4j (DB: {self.database}) stabilita con successo.")
     
     #Crea indici e vincoli essenziali per le performance del RAG
     def create_indexes_and_constraints(self):
@@ -59,6 +161,12 @@ class GraphDB:
             "CREATE CONSTRAINT IF NOT EXISTS FOR (u:User) REQUIRE u.id IS UNIQUE",
             #Indice per la ricerca di Chunk tramite ID (utile per la citazione del chunk)
             "CREATE INDEX IF NOT EXISTS FOR (c:Chunk) ON (c.chunk_id)",
+            #Indice composito per il MERGE delle entità su (name, type) durante l'ingestione
+            "CREATE INDEX IF NOT EXISTS FOR (e:Entity) ON (e.name, e.type)",
+            #Indice sul nome normalizzato (minuscolo, senza spazi esterni) usato dalle ricerche per entità
+            "CREATE INDEX IF NOT EXISTS FOR (e:Entity) ON (e.name_norm)",
+            #Vincolo sul marcatore della versione dello schema dei dati (migrazioni già applicate al database)
+            "CREATE CONSTRAINT IF NOT EXISTS FOR (s:SchemaVersion) REQUIRE s.name IS UNIQUE",
         ]
 
         with self.driver.session(database=self.database) as session:
@@ -75,6 +183,36 @@ class GraphDB:
                     raise
         
         logger.info("Indici e vincoli Neo4j verificati/creati.")
+        self.apply_data_migrations()
+
+    #Applica una sola volta per database le migrazioni dei dati non ancora eseguite, registrando la versione raggiunta
+    #nel nodo (:SchemaVersion {name: "graphrag"}): ai riavvii successivi non viene fatta nessuna scansione
+    def apply_data_migrations(self):
+        records = self.run_query("MATCH (s:SchemaVersion {name: $name}) RETURN s.version AS version", {"name": SCHEMA_MARKER})
+        version = records[0]["version"] if records else 0
+        for target, migration in enumerate(self._data_migrations()[version:], start=version + 1):
+            migration()
+            self.run_query("MERGE (s:SchemaVersion {name: $name}) SET s.version = $version", {"name": SCHEMA_MARKER, "version": target})
+            logger.info(f"Migrazione dei dati {target} applicata al database {self.database}.")
+
+    #Migrazioni dei dati in ordine: la posizione nella lista (da 1) è la versione raggiunta dopo averla applicata
+    def _data_migrations(self) -> List[Callable[[], None]]:
+        return [self._backfill_entity_name_norm]
+
+    #Versione 1: nome normalizzato per le entità create prima dell'introduzione di name_norm.
+    #CALL ... IN TRANSACTIONS richiede una transazione implicita (auto-commit), quindi uso session.run e non execute_write.
+    #La sintassi CALL (e) { ... } è quella di Neo4j 5.23+; sulle versioni precedenti ripiego su CALL { WITH e ... }
+    def _backfill_entity_name_norm(self):
+        body = "SET e.name_norm = toLower(trim(toString(e.name)))"
+        queries = [
+            f"MATCH (e:Entity) WHERE e.name_norm IS NULL CALL (e) {{ {body} }} IN TRANSACTIONS OF 10000 ROWS",
+            f"MATCH (e:Entity) WHERE e.name_norm IS NULL CALL {{ WITH e {body} }} IN TRANSACTIONS OF 10000 ROWS",
+        ]
+        with self.driver.session(database=self.database) as session:
+            try:
+                session.run(queries[0]).consume()
+            except exceptions.CypherSyntaxError:
+                session.run(queries[1]).consume()
 
     
     # --- Operazioni Crud per il RAG ---
@@ -90,6 +228,12 @@ class GraphDB:
         """
         return self.run_query(query, {"filename": filename, "title": title})
     
+    #Versione del contenuto indicizzato del documento (cambia a ogni reindicizzazione che ne modifica i chunk).
+    #Stringa vuota per i documenti indicizzati prima dell'introduzione della versione, None se il documento non esiste
+    def get_document_version(self, filename: str) -> Optional[str]:
+        records = self.run_query("MATCH (d:Document {filename: $filename}) RETURN d.content_version AS version", {"filename": filename})
+        return (records[0]["version"] or "") if records else None
+
     #Crea o aggiorna un nodo User e registra l'attività
     def create_user_node(self, user_id: str):
         query = """
@@ -133,9 +277,22 @@ class GraphDB:
             "section": metadata.get("section", "unspecified")
         }
         return self.run_query(query, parameters)
+
+    #Scrive in blocco i chunk di un documento: ogni batch di righe passa in un unico UNWIND parametrizzato
+    #eseguito in una sola transazione, così evito una sessione e un commit per ogni chunk.
+    #Ogni riga è un dizionario con chunk_id, content, embedding e section; con l'archiviazione compatta degli embedding
+    #embedding è None e la riga porta embedding_q (byte), embedding_scale ed embedding_dtype. Le proprietà a null vengono
+    #rimosse, così cambiare modalità e reindicizzare non lascia il vettore nel vecchio formato
+    def add_chunks_bulk(self, filename: str, rows: List[Dict[str, Any]], batch_size: Optional[int] = None, progress_callback: Optional[Callable[[int], None]] = None) -> int:
+        return self.run_unwind_in_batches(_ADD_CHUNKS_QUERY, rows, {"filename": filename}, batch_size, progress_callback)
     
     #Crea un indice vettoriale per la ricerca di similarità
     def create_vector_index(self, index_name: str, node_label: str, property_name: str, vector_dimensions: int):        
+        #L'indice viene verificato una sola volta per processo, non a ogni upload
+        index_key = (self.uri, self.database, index_name)
+        if index_key in _vector_indexes_ready:
+            return
+
         query = f"""
         CREATE VECTOR INDEX {index_name} IF NOT EXISTS 
         FOR (n:{node_label})
@@ -149,6 +306,7 @@ class GraphDB:
         """
         try:
             self.run_query(query)
+            _vector_indexes_ready.add(index_key)
             logger.info(f"Indice vettoriale '{index_name}' creato con successo per {node_label}.")
         except Exception as e:
             logger.error(f"Errore nella creazione dell'indice vettoriale '{index_name}': {e}")
@@ -194,9 +352,152 @@ class GraphDB:
             logger.error(f"Errore durante la query dell'indice vettoriale: {e}")
             return []
     
+    #Ricerca vettoriale limitata a un documento che garantisce fino a k risultati del file.
+    #Conto prima i chunk del documento: se sono al più k vado subito alla ricerca esatta pre-filtrata (per un documento
+    #piccolo costa poco e l'indice globale non potrebbe comunque dare più risultati). Altrimenti interrogo l'indice, che è
+    #globale, con k * oversample candidati e, se dopo il filtro sul documento ne restano meno di k, ripeto con un
+    #sovracampionamento crescente fino a max_candidates; passo alla ricerca esatta se non basta o se la finestra successiva
+    #supererebbe il numero di chunk del documento. Se viene passato stats, lo riempio con i contatori della query
+    #(strategia, round eseguiti sull'indice, candidati e fattore di sovracampionamento dell'ultima finestra eseguita)
+    def query_document_vector_index(self, index_name: str, query_embedding: List[float], filename: str, k: int = 5,
+                                    oversample: Optional[float] = None, max_candidates: Optional[int] = None,
+                                    stats: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        oversample = oversample or float(os.getenv("VECTOR_OVERSAMPLE_FACTOR", "4"))
+        max_candidates = max_candidates or int(os.getenv("VECTOR_MAX_CANDIDATES", "1000"))
+
+        candidates_query = """
+        CALL db.index.vector.queryNodes($index_name, $candidates, $query_embedding)
+        YIELD node, score
+        MATCH (d:Document {filename: $filename})-[:HAS_CHUNK]->(node)
+        RETURN node.content AS node_content, score, node.chunk_id AS chunk_id, node.section AS section, d.filename AS filename
+        ORDER BY score DESC
+        LIMIT $k
+        """
+        rounds = 0
+        executed = 0
+        results = []
+        strategy = "oversampled"
+        document_chunks = None
+
+        try:
+            document_chunks = self.count_document_chunks(filename)
+            exact = document_chunks <= k
+            candidates = max(k, int(k * oversample))
+            while not exact:
+                rounds += 1
+                executed = candidates
+                parameters = {"index_name": index_name, "candidates": candidates, "query_embedding": query_embedding, "filename": filename, "k": k}
+                results = self._vector_records_to_results(self.run_query(candidates_query, parameters))
+                if len(results) >= k:
+                    break
+                if candidates >= max_candidates:
+                    exact = True
+                    break
+                # La finestra cresce almeno di k a ogni round, anche con un fattore di sovracampionamento <= 1
+                candidates = min(max(candidates + k, int(candidates * oversample)), max_candidates)
+                if document_chunks <= candidates:
+                    exact = True
+
+            if exact:
+                exact_results = self.exact_document_vector_search(query_embedding, filename, k)
+                if exact_results is not None:
+                    results = exact_results
+                    strategy = "exact"
+                elif rounds == 0:
+                    # Ricerca esatta non supportata dal server: per un documento piccolo basta un solo round sull'indice
+                    rounds, executed = 1, max(k, int(k * oversample))
+                    parameters = {"index_name": index_name, "candidates": executed, "query_embedding": query_embedding, "filename": filename, "k": k}
+                    results = self._vector_records_to_results(self.run_query(candidates_query, parameters))
+        except Exception as e:
+            logger.error(f"Errore durante la ricerca vettoriale sul documento '{filename}': {e}")
+
+        if stats is not None:
+            stats.update({
+                "strategy": strategy,
+                "rounds": rounds,
+                "document_chunks": document_chunks,
+                "candidates_requested": executed,
+                "oversample_factor": round(executed / k, 1) if k else 0,
+                "results": len(results),
+            })
+        logger.debug(f"Ricerca vettoriale su '{filename}': {len(results)}/{k} risultati, {rounds} round, {executed} candidati ({strategy}).")
+        return results
+
+    #Numero di chunk indicizzati per il documento
+    def count_document_chunks(self, filename: str) -> int:
+        query = """
+        MATCH (:Document {filename: $filename})-[:HAS_CHUNK]->(c:Chunk)
+        RETURN count(c) AS chunks
+        """
+        records = self.run_query(query, {"filename": filename})
+        return records[0]["chunks"] if records else 0
+
+    #Ricerca esatta (brute force) sui chunk di un solo documento: il filtro avviene prima del calcolo della similarità.
+    #Lo score usa la stessa scala dell'indice vettoriale. Restituisce None se la funzione non è supportata dal server
+    def exact_document_vector_search(self, query_embedding: List[float], filename: str, k: int = 5) -> Optional[List[Dict[str, Any]]]:
+        query = """
+        MATCH (d:Document {filename: $filename})-[:HAS_CHUNK]->(c:Chunk)
+        WHERE c.embedding IS NOT NULL
+        WITH d, c, vector.similarity.cosine(c.embedding, $query_embedding) AS score
+        ORDER BY score DESC
+        LIMIT $k
+        RETURN c.content AS node_content, score, c.chunk_id AS chunk_id, c.section AS section, d.filename AS filename
+        """
+        try:
+            records = self.run_query(query, {"query_embedding": query_embedding, "filename": filename, "k": k})
+            return self._vector_records_to_results(records)
+        except Exception as e:
+            logger.warning(f"Ricerca vettoriale esatta non disponibile per '{filename}': {e}")
+            return None
+
+    #Legge gli embedding dei chunk di un documento nel formato in cui sono salvati (compatti o lista float32), senza il contenuto:
+    #il calcolo della similarità avviene lato applicazione e il testo si recupera solo per i chunk vincenti
+    def get_document_compact_embeddings(self, filename: str) -> List[Dict[str, Any]]:
+        query = """
+        MATCH (d:Document {filename: $filename})-[:HAS_CHUNK]->(c:Chunk)
+        WHERE c.embedding_q IS NOT NULL OR c.embedding IS NOT NULL
+        RETURN c.chunk_id AS chunk_id, c.embedding AS embedding, c.embedding_q AS embedding_q,
+               c.embedding_scale AS embedding_scale, c.embedding_dtype AS embedding_dtype
+        """
+        return self.run_query(query, {"filename": filename})
+
+    #Indica se il documento ha chunk con l'embedding float32 coperto dall'indice vettoriale
+    #(ad esempio perché indicizzato prima del passaggio agli embedding compatti)
+    def document_has_vector_index_embeddings(self, filename: str) -> bool:
+        query = """
+        MATCH (:Document {filename: $filename})-[:HAS_CHUNK]->(c:Chunk)
+        WHERE c.embedding IS NOT NULL
+        RETURN c.chunk_id AS chunk_id
+        LIMIT 1
+        """
+        return bool(self.run_query(query, {"filename": filename}))
+
+    #Recupera contenuto e metadati dei chunk dati, nell'ordine degli id richiesti
+    def get_chunks_by_ids(self, chunk_ids: List[str]) -> List[Dict[str, Any]]:
+        if not chunk_ids:
+            return []
+        query = """
+        UNWIND $chunk_ids AS chunk_id
+        MATCH (d:Document)-[:HAS_CHUNK]->(c:Chunk {chunk_id: chunk_id})
+        RETURN c.chunk_id AS chunk_id, c.content AS node_content, c.section AS section, d.filename AS filename
+        """
+        by_id = {record["chunk_id"]: record for record in self.run_query(query, {"chunk_ids": chunk_ids})}
+        return [by_id[chunk_id] for chunk_id in chunk_ids if chunk_id in by_id]
+
+    @staticmethod
+    def _vector_records_to_results(records) -> List[Dict[str, Any]]:
+        return [{
+            "node_content": record["node_content"],
+            "score": record["score"],
+            "chunk_id": record["chunk_id"],
+            "section": record.get("section", "N/A"),
+            "filename": record.get("filename", "Unknown"),
+        } for record in records]
+    
     def add_entity_to_chunk(self, entity_name, entity_type, chunk_id):
         query = """
         MERGE (e:Entity {name: $name, type: $type})
+        SET e.name_norm = toLower(trim($name))
         WITH e
         MATCH (c:Chunk {chunk_id: $chunk_id})
         MERGE (c)-[:CONTAINS_ENTITY]->(e)
@@ -204,11 +505,114 @@ class GraphDB:
         params = {"name": entity_name, "type": entity_type, "chunk_id": chunk_id}
         self.run_query(query, params)
 
+    #Collega in blocco le entità ai chunk: ogni riga è una tripla (chunk_id, name, type)
+    #e ogni batch viene scritto con un solo UNWIND in un'unica transazione
+    def link_entities_bulk(self, rows: List[Dict[str, Any]], batch_size: Optional[int] = None) -> int:
+        return self.run_unwind_in_batches(_LINK_ENTITIES_QUERY, rows, batch_size=batch_size)
+
+    # --- Reindicizzazione incrementale ---
+    #Restituisce {chunk_id: content_hash} dei chunk già indicizzati per il documento
+    #(hash None per i chunk scritti prima dell'introduzione degli hash, che verranno quindi ricalcolati)
+    def get_document_chunk_hashes(self, filename: str) -> Dict[str, Optional[str]]:
+        query = """
+        MATCH (:Document {filename: $filename})-[:HAS_CHUNK]->(c:Chunk)
+        RETURN c.chunk_id AS chunk_id, c.content_hash AS content_hash
+        """
+        return {record["chunk_id"]: record["content_hash"] for record in self.run_query(query, {"filename": filename})}
+
+    #Legge gli embedding salvati per i chunk dati, nel formato in cui sono nel grafo (lista float32 o byte compatti)
+    def get_chunk_embeddings(self, chunk_ids: List[str]) -> List[Dict[str, Any]]:
+        if not chunk_ids:
+            return []
+        query = """
+        UNWIND $chunk_ids AS chunk_id
+        MATCH (c:Chunk {chunk_id: chunk_id})
+        RETURN c.chunk_id AS chunk_id, c.embedding AS embedding, c.embedding_q AS embedding_q,
+               c.embedding_scale AS embedding_scale, c.embedding_dtype AS embedding_dtype
+        """
+        return self.run_query(query, {"chunk_ids": chunk_ids})
+
+    #Restituisce le entità collegate ai chunk dati come righe (chunk_id, name, type), nel formato di link_entities_bulk
+    def get_chunk_entities(self, chunk_ids: List[str]) -> List[Dict[str, Any]]:
+        if not chunk_ids:
+            return []
+        query = """
+        UNWIND $chunk_ids AS chunk_id
+        MATCH (c:Chunk {chunk_id: chunk_id})-[:CONTAINS_ENTITY]->(e:Entity)
+        RETURN c.chunk_id AS chunk_id, e.name AS name, e.type AS type
+        """
+        return self.run_query(query, {"chunk_ids": chunk_ids})
+
+    #Elimina in blocco i chunk dati con tutte le loro relazioni
+    def delete_chunks_bulk(self, chunk_ids: List[str], batch_size: Optional[int] = None) -> int:
+        return self.run_unwind_in_batches(_DELETE_CHUNKS_QUERY, [{"chunk_id": chunk_id} for chunk_id in chunk_ids], batch_size=batch_size)
+
+    #Tra le entità date (name, type), elimina quelle rimaste senza chunk collegati
+    def delete_orphan_entities(self, entities: List[Dict[str, Any]], batch_size: Optional[int] = None) -> int:
+        return self.run_unwind_in_batches(_DELETE_ORPHANS_QUERY, entities, batch_size=batch_size)
+
+    #Applica la nuova versione di un documento in un'unica transazione: scollega le entità dei chunk riscritti, li riscrive,
+    #collega le nuove entità, elimina i chunk spariti e le entità rimaste orfane, infine registra content_version sul
+    #Document. O passa tutto o non cambia nulla; le query sono idempotenti, quindi il driver può ripetere la transazione
+    #dopo un errore transitorio. Restituisce i conteggi di ogni passo (written, linked, removed, orphans_deleted)
+    def replace_document_chunks(self, filename: str, rows: List[Dict[str, Any]], entity_rows: List[Dict[str, Any]],
+                                removed_ids: List[str], orphan_candidates: List[Dict[str, Any]], content_version: Optional[str] = None,
+                                batch_size: Optional[int] = None) -> Dict[str, int]:
+        if not self.driver:
+            raise RuntimeError("Driver Neo4j non inizializzato.")
+        batch_size = batch_size or int(os.getenv("NEO4J_WRITE_BATCH_SIZE", "500"))
+        steps = [
+            ("unlinked", _UNLINK_ENTITIES_QUERY, [{"chunk_id": row["chunk_id"]} for row in rows]),
+            ("written", _ADD_CHUNKS_QUERY, rows),
+            ("linked", _LINK_ENTITIES_QUERY, entity_rows),
+            ("removed", _DELETE_CHUNKS_QUERY, [{"chunk_id": chunk_id} for chunk_id in removed_ids]),
+            ("orphans_deleted", _DELETE_ORPHANS_QUERY, orphan_candidates),
+        ]
+
+        def _replace(tx):
+            counts = {}
+            for name, query, step_rows in steps:
+                counts[name] = 0
+                for start in range(0, len(step_rows), batch_size):
+                    record = tx.run(query, {"filename": filename, "rows": step_rows[start:start + batch_size]}).single()
+                    counts[name] += record["written"] if record else 0
+            if content_version is not None:
+                tx.run("MATCH (d:Document {filename: $filename}) SET d.content_version = $version", {"filename": filename, "version": content_version})
+            return counts
+
+        with self.driver.session(database=self.database) as session:
+            return session.execute_write(_replace)
+
+    #Normalizza i nomi cercati come name_norm (minuscolo, senza spazi ai bordi) in Python, così valori non stringa
+    #non fanno fallire toLower/trim in Cypher; scarta i nomi vuoti e restituisce righe (nome originale, nome normalizzato)
+    @staticmethod
+    def _entity_name_rows(names: List[Any]) -> List[Dict[str, Any]]:
+        rows = []
+        for name in names or []:
+            if name is None:
+                continue
+            norm = str(name).strip().lower()
+            if norm:
+                rows.append({"name": name, "norm": norm})
+        return rows
+
+    #Restituisce, tra i nomi dati, quelli che corrispondono a entità presenti nei chunk del documento
+    def find_document_entities(self, names: List[str], filename: str) -> List[str]:
+        rows = self._entity_name_rows(names)
+        if not rows:
+            return []
+        query = """
+        UNWIND $rows AS row
+        MATCH (e:Entity {name_norm: row.norm})<-[:CONTAINS_ENTITY]-(:Chunk)<-[:HAS_CHUNK]-(:Document {filename: $filename})
+        RETURN DISTINCT row.name AS name
+        """
+        records = self.run_query(query, {"rows": rows, "filename": filename})
+        return [record["name"] for record in records]
+
     #Esegue una ricerca esatta basata sui nodi Entity
     def entity_search(self, entity_name: str) -> List[Dict[str, Any]]:
         query = """
-        MATCH (e:Entity)
-        WHERE toLower(e.name) = toLower($name)
+        MATCH (e:Entity {name_norm: toLower(trim($name))})
         MATCH (e)<-[:CONTAINS_ENTITY]-(c:Chunk)
         RETURN c.content AS node_content, c.chunk_id AS chunk_id, 1.0 AS score, c.section AS section, c.source AS filename
         LIMIT 5
@@ -228,7 +632,61 @@ class GraphDB:
         except Exception as e:
             logger.error(f"Errore nella ricerca per entità '{entity_name}': {e}")
             return []
+
+    #Ricerca per entità in blocco e limitata al documento: un solo UNWIND sull'intera lista di entità,
+    #lookup tramite l'indice su name_norm e filtro sul documento dentro Cypher, così il limite si applica
+    #ai chunk del file corrente (limit_per_entity risultati per ciascuna entità)
+    def entity_search_bulk(self, entity_names: List[str], filename: str, limit_per_entity: int = 5) -> List[Dict[str, Any]]:
+        rows = self._entity_name_rows(entity_names)
+        if not rows:
+            return []
+        query = """
+        UNWIND $rows AS row
+        MATCH (e:Entity {name_norm: row.norm})<-[:CONTAINS_ENTITY]-(c:Chunk)<-[:HAS_CHUNK]-(:Document {filename: $filename})
+        WITH row.name AS name, c
+        ORDER BY c.chunk_id
+        WITH name, collect(DISTINCT c)[..$limit] AS chunks
+        UNWIND chunks AS c
+        RETURN name AS entity, c.content AS node_content, c.chunk_id AS chunk_id, 1.0 AS score, c.section AS section, $filename AS filename
+        """
+        try:
+            records = self.run_query(query, {"rows": rows, "filename": filename, "limit": limit_per_entity})
+            return [{
+                "entity": record.get("entity"),
+                "node_content": record.get("node_content"),
+                "chunk_id": record.get("chunk_id"),
+                "score": record.get("score"),
+                "section": record.get("section"),
+                "filename": record.get("filename")
+            } for record in records]
+        except Exception as e:
+            logger.error(f"Errore nella ricerca per entità {entity_names} su '{filename}': {e}")
+            return []
     
+    #Esegue una query UNWIND su $rows a blocchi di batch_size righe, una transazione di scrittura per blocco.
+    #La query deve restituire il numero di righe scritte come 'written'
+    def run_unwind_in_batches(self, query: str, rows: List[Dict[str, Any]], parameters: Optional[Dict[str, Any]] = None, batch_size: Optional[int] = None, progress_callback: Optional[Callable[[int], None]] = None) -> int:
+        if not self.driver:
+            raise RuntimeError("Driver Neo4j non inizializzato.")
+        if not rows:
+            return 0
+
+        batch_size = batch_size or int(os.getenv("NEO4J_WRITE_BATCH_SIZE", "500"))
+        written = 0
+
+        def _write_batch(tx, batch):
+            record = tx.run(query, {**(parameters or {}), "rows": batch}).single()
+            return record["written"] if record else 0
+
+        with self.driver.session(database=self.database) as session:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                written += session.execute_write(_write_batch, batch)
+                logger.debug(f"Scritto batch di {len(batch)} righe su Neo4j ({written}/{len(rows)}).")
+                if progress_callback:
+                    progress_callback(start + len(batch))
+        return written
+
     def run_query(self, query: str, parameters: Optional[Dict[str, Any]] = None):
         if not self.driver:
             raise RuntimeError("Driver Neo4j non inizializzato.")
@@ -17,6 +17,8 @@ const App: React.FC = () => {
   const [isTyping, setIsTyping] = useState(false);
   const [showPlusMenu, setShowPlusMenu] = useState(false);
   const chatEndRef = useRef<HTMLDivElement>(null);
+  // Id delle risposte in streaming per cui il messaggio dell'AI è già stato aggiunto alla chat
+  const startedAnswersRef = useRef<Set<string>>(new Set());
 
   const scrollToBottom = () => {
     chatEndRef.current?.scrollIntoView({ behavior: 'smooth' });
@@ -44,34 +46,47 @@ const App: React.FC = () => {
       formData.append('file', file);
       formData.append('user_id', userData.name);
 
-      const progressInterval = setInterval(() => {
-        setProgress(prev => (prev < 90 ? prev + 5 : prev));
-      }, 800);
-
       try {
-        // CORREZIONE: Aggiunto /upload all'URL di Render
+        // L'upload restituisce subito l'id del job: l'indicizzazione prosegue in background sul server
         const response = await fetch(`${BACKEND_URL}/upload`, {
           method: 'POST',
           body: formData,
         });
 
-        clearInterval(progressInterval);
-
-        if (response.ok) {
-          setProgress(100);
-          setTimeout(() => {
-            setStep(AppStep.CHAT);
-            setMessages([{ 
-              role: 'ai', 
-              content: 'PRESET_WELCOME', 
-              timestamp: new Date() 
-            }]);
-          }, 600);
-        } else {
+        if (!response.ok) {
           throw new Error("Errore durante l'elaborazione del server");
         }
+
+        const { job_id } = await response.json();
+
+        // Interrogo /jobs/{id} finché il job non termina, aggiornando la barra con i chunk elaborati
+        while (true) {
+          await new Promise(resolve => setTimeout(resolve, 1500));
+          const jobResponse = await fetch(`${BACKEND_URL}/jobs/${job_id}`);
+          if (!jobResponse.ok) throw new Error("Impossibile recuperare lo stato dell'indicizzazione");
+
+          const job = await jobResponse.json();
+          if (job.status === 'failed') throw new Error(job.error || "Indicizzazione fallita");
+          if (job.status === 'completed') break;
+
+          const { chunks_total, chunks_embedded = 0, chunks_written = 0 } = job.progress || {};
+          if (chunks_total) {
+            setProgress(Math.min(95, 15 + Math.round(((chunks_embedded + chunks_written) / (2 * chunks_total)) * 80)));
+          } else {
+            setProgress(prev => (prev < 15 ? prev + 1 : prev));
+          }
+        }
+
+        setProgress(100);
+        setTimeout(() => {
+          setStep(AppStep.CHAT);
+          setMessages([{ 
+            role: 'ai', 
+            content: 'PRESET_WELCOME', 
+            timestamp: new Date() 
+          }]);
+        }, 600);
       } catch (error) {
-        clearInterval(progressInterval);
         console.error("Errore durante l'ingestione:", error);
         alert("Errore nel caricamento del file. Assicurati che il backend sia attivo.");
         setStep(AppStep.PDF_UPLOAD);
@@ -117,6 +132,7 @@ const App: React.FC = () => {
     setMessages(prev => [...prev, userMsg]);
     setInputValue('');
     setIsTyping(true);
+    const answerId = crypto.randomUUID();
 
     try {
       const queryParams = new URLSearchParams({
@@ -125,21 +141,59 @@ const App: React.FC = () => {
         user_id: userData.name
       });
 
-      // CORREZIONE: Sostituito localhost con l'URL di Render
-      const response = await fetch(`${BACKEND_URL}/chat?${queryParams}`, {
+      // Uso l'endpoint in streaming: i token della risposta arrivano come eventi SSE man mano che vengono generati
+      const response = await fetch(`${BACKEND_URL}/chat/stream?${queryParams}`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' }
+        headers: { 'Accept': 'text/event-stream' }
       });
 
-      if (!response.ok) throw new Error('Errore nella risposta del server');
-
-      const data = await response.json();
+      if (!response.ok || !response.body) throw new Error('Errore nella risposta del server');
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let answer = '';
+
+      // Aggiunge il messaggio dell'AI al primo token e poi lo aggiorna tramite il suo id con il testo ricevuto finora.
+      // Gli updater restano puri: in StrictMode React può eseguirli due volte
+      const renderAnswer = (content: string) => {
+        if (!startedAnswersRef.current.has(answerId)) {
+          startedAnswersRef.current.add(answerId);
+          const timestamp = new Date();
+          setMessages(prev => [...prev, { id: answerId, role: 'ai', content, timestamp }]);
+          return;
+        }
+        setMessages(prev => prev.map(msg => (msg.id === answerId ? { ...msg, content } : msg)));
+      };
+
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        const events = buffer.split('\n\n');
+        buffer = events.pop() || '';
+
+        for (const rawEvent of events) {
+          const eventName = rawEvent.match(/^event: (.*)$/m)?.[1];
+          const data = rawEvent.match(/^data: (.*)$/m)?.[1];
+          if (!eventName || !data) continue;
+
+          const payload = JSON.parse(data);
+          if (eventName === 'token') {
+            answer += payload.token;
+            setIsTyping(false);
+            renderAnswer(answer);
+          } else if (eventName === 'done' && payload.answer) {
+            answer = payload.answer;
+            renderAnswer(answer);
+          } else if (eventName === 'error') {
+            throw new Error(payload.detail);
+          }
+        }
+      }
 
-      setMessages(prev => [...prev, {
-        role: 'ai',
-        content: data.answer,
-        timestamp: new Date()
-      }]);
+      if (!startedAnswersRef.current.has(answerId)) throw new Error('Risposta vuota dal server');
     } catch (error) {
       console.error("Errore chat:", error);
       setMessages(prev => [...prev, {
@@ -148,6 +202,7 @@ const App: React.FC = () => {
         timestamp: new Date()
       }]);
     } finally {
+      startedAnswersRef.current.delete(answerId);
       setIsTyping(false);
     }
   };
@@ -10,6 +10,8 @@ export const AppStep = {
 } as const;
 
 export interface Message {
+  // Identificativo usato per aggiornare la risposta dell'AI mentre arriva in streaming
+  id?: string;
   role: 'user' | 'ai';
   content: string;
   timestamp: Date;
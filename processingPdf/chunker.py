@@ -1,6 +1,7 @@
 # Questa parte si occupa di segmentare il testo delle sezioni in blocchi più piccoli (chunks)
 # adatti alla ricerca vettoriale, utilizzando RecursiveCharacterTextSplitter (RCTS) di LangChain.
 
+import hashlib
 import logging
 from typing import List, Dict
 from langchain_text_splitters import RecursiveCharacterTextSplitter
@@ -22,6 +23,42 @@ class Chunker:
             length_function=len,
         )
 
+    # Divide in chunk una singola sezione (usato anche dalla pipeline di ingestione, che riceve le sezioni una alla volta)
+    def chunk_section(self, section_title: str, section_text: str, filename: str) -> List[Document]:
+        if not section_text.strip():
+            logger.debug(f"Salto sezione vuota: '{section_title}'")
+            return []
+        
+        try:
+            # Normalizzo il testo in lowercase
+            section_text = section_text.lower()
+            
+            # 1. Divide il testo della sezione (lo splitter accetta una lista di testi)
+            chunks_for_section = self.text_splitter.create_documents([section_text])
+            
+            # 2. Aggiunge metadati a ciascun chunk
+            for i, chunk in enumerate(chunks_for_section):
+                # Metadato 'source' per il nome del documento
+                chunk.metadata["source"] = filename
+                
+                # Metadato 'section' per il titolo logico (per il RAG)
+                chunk.metadata["section"] = section_title
+                
+                # ID univoco per il chunk (combinazione di filename, sezione e indice)
+                # Normalizziamo il titolo della sezione per un ID più pulito e sicuro
+                clean_section_id = section_title.lower().replace(' ', '_').replace('/', '_').replace(':', '_')
+                chunk.metadata["chunk_id"] = f"{filename}_{clean_section_id}_{i}"
+
+                # Hash del contenuto: in reindicizzazione permette di riconoscere i chunk invariati (anche se spostati)
+                chunk.metadata["content_hash"] = hashlib.sha256(chunk.page_content.encode("utf-8")).hexdigest()
+            
+            logger.debug(f"Sezione '{section_title}' divisa in {len(chunks_for_section)} chunk.")
+            return chunks_for_section
+        
+        except Exception as e:
+            logger.error(f"Errore durante il chunking della sezione '{section_title}': {e}")
+            return []
+
     # Questa funzione divide le sezioni logiche del documento in chunk di dimensione fissa con sovrapposizione
     # Tra gli args abbiamo:
     # sections: Dizionario con titoli di sezione e relativi testi
@@ -38,36 +75,7 @@ class Chunker:
 
         # Iterazione e Chunking
         for section_title, section_text in sections.items():
-            if not section_text.strip():
-                logger.debug(f"Salto sezione vuota: '{section_title}'")
-                continue
-            
-            try:
-                # Normalizzo il testo in lowercase
-                section_text = section_text.lower()
-                
-                # 1. Divide il testo della sezione (lo splitter accetta una lista di testi)
-                chunks_for_section = self.text_splitter.create_documents([section_text])
-                
-                # 2. Aggiunge metadati a ciascun chunk
-                for i, chunk in enumerate(chunks_for_section):
-                    # Metadato 'source' per il nome del documento
-                    chunk.metadata["source"] = filename
-                    
-                    # Metadato 'section' per il titolo logico (per il RAG)
-                    chunk.metadata["section"] = section_title
-                    
-                    # ID univoco per il chunk (combinazione di filename, sezione e indice)
-                    # Normalizziamo il titolo della sezione per un ID più pulito e sicuro
-                    clean_section_id = section_title.lower().replace(' ', '_').replace('/', '_').replace(':', '_')
-                    chunk.metadata["chunk_id"] = f"{filename}_{clean_section_id}_{i}"
-                    
-                    all_chunks.append(chunk)
-                
-                logger.debug(f"Sezione '{section_title}' divisa in {len(chunks_for_section)} chunk.")
-            
-            except Exception as e:
-                logger.error(f"Errore durante il chunking della sezione '{section_title}': {e}")
+            all_chunks.extend(self.chunk_section(section_title, section_text, filename))
 
         logger.info(f"Totale {len(all_chunks)} chunk generati.")
         return all_chunks
\ No newline at end of file
@@ -0,0 +1,142 @@
+#Questo file implementa una cache LRU/TTL degli embedding delle query, così le domande ripetute
+#non vengono ricodificate dal modello di embedding a ogni richiesta
+
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+#Versione del formato del file salvato: le cache scritte con un formato (o una normalizzazione delle chiavi) diverso vengono ignorate
+CACHE_FILE_VERSION = 2
+
+#Cache degli embedding indicizzata per (nome modello, testo normalizzato). Le voci più vecchie
+#vengono espulse oltre max_entries e quelle più vecchie di ttl_seconds sono considerate scadute (0 = nessuna scadenza).
+#Se persist_path è impostato, la cache viene ricaricata al riavvio e salvata su disco allo spegnimento e, con
+#start_periodic_flush, ogni QUERY_EMBEDDING_CACHE_FLUSH_SECONDS: dopo un crash si perdono solo le voci dell'ultimo intervallo
+class QueryEmbeddingCache:
+    def __init__(self, max_entries: Optional[int] = None, ttl_seconds: Optional[float] = None, persist_path: Optional[str] = None):
+        self.max_entries = max_entries or int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2048"))
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", "86400"))
+        self.persist_path = persist_path if persist_path is not None else os.getenv("QUERY_EMBEDDING_CACHE_PATH")
+
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[np.ndarray, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        #True se ci sono voci non ancora salvate su disco
+        self._dirty = False
+        self._flusher: Optional[threading.Thread] = None
+
+        if self.persist_path:
+            self.load()
+
+    #Normalizza il testo della query compattando gli spazi. Le maiuscole restano: il modello di embedding distingue
+    #"Apple" da "apple", quindi le due query devono avere voci distinte
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split())
+
+    def get(self, model_name: str, text: str) -> Optional[List[float]]:
+        key = (model_name, self.normalize(text))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0].tolist()
+
+    def put(self, model_name: str, text: str, embedding: List[float]):
+        key = (model_name, self.normalize(text))
+        with self._lock:
+            self._entries[key] = (np.asarray(embedding, dtype=np.float32), time.time())
+            self._entries.move_to_end(key)
+            self._dirty = True
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+    #Salva la cache su disco (scrittura atomica tramite file temporaneo)
+    def save(self):
+        if not self.persist_path:
+            return
+        with self._lock:
+            entries = [(key, vector, ts) for key, (vector, ts) in self._entries.items() if not self._is_expired((vector, ts))]
+            self._dirty = False
+        try:
+            directory = os.path.dirname(self.persist_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.persist_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump({"version": CACHE_FILE_VERSION, "entries": entries}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.persist_path)
+            logger.info(f"Cache degli embedding salvata su '{self.persist_path}' ({len(entries)} voci).")
+        except Exception as e:
+            with self._lock:
+                self._dirty = True
+            logger.warning(f"Impossibile salvare la cache degli embedding su '{self.persist_path}': {e}")
+
+    #Ricarica la cache da disco, scartando le voci scadute
+    def load(self):
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, "rb") as f:
+                data = pickle.load(f)
+            if not isinstance(data, dict) or data.get("version") != CACHE_FILE_VERSION:
+                logger.info(f"Cache degli embedding in '{self.persist_path}' in un formato precedente, la ignoro.")
+                return
+            entries = data["entries"]
+            with self._lock:
+                for key, vector, ts in entries[-self.max_entries:]:
+                    if not self._is_expired((vector, ts)):
+                        self._entries[tuple(key)] = (vector, ts)
+            logger.info(f"Cache degli embedding caricata da '{self.persist_path}' ({len(self._entries)} voci).")
+        except Exception as e:
+            logger.warning(f"Impossibile caricare la cache degli embedding da '{self.persist_path}': {e}")
+
+    #Avvia un thread daemon che salva la cache su disco ogni interval_seconds, solo se ci sono voci nuove.
+    #Disattivato senza QUERY_EMBEDDING_CACHE_PATH o se QUERY_EMBEDDING_CACHE_FLUSH_SECONDS è 0
+    def start_periodic_flush(self, interval_seconds: Optional[float] = None):
+        interval_seconds = interval_seconds if interval_seconds is not None else float(os.getenv("QUERY_EMBEDDING_CACHE_FLUSH_SECONDS", "300"))
+        if not self.persist_path or interval_seconds <= 0 or self._flusher is not None:
+            return
+
+        def _flush():
+            while True:
+                time.sleep(interval_seconds)
+                if self._dirty:
+                    self.save()
+
+        self._flusher = threading.Thread(target=_flush, name="query-embedding-cache-flush", daemon=True)
+        self._flusher.start()
+        logger.info(f"Salvataggio periodico della cache degli embedding ogni {interval_seconds:.0f}s attivato.")
+
+    def _is_expired(self, entry: Tuple[np.ndarray, float]) -> bool:
+        return self.ttl_seconds > 0 and time.time() - entry[1] > self.ttl_seconds
+
+
+#Istanza condivisa dal processo
+query_embedding_cache = QueryEmbeddingCache()
@@ -0,0 +1,57 @@
+#Questo file raccoglie la codifica compatta degli embedding: float16, oppure int8 con una scala per vettore
+#(valore = codice * scala). Lo usano l'indicizzazione su Neo4j, la cache locale delle matrici e la ricerca che ricalcola gli score
+
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+
+SUPPORTED_ENCODINGS = ("float32", "float16", "int8")
+
+#Come salvare gli embedding dei chunk nel grafo:
+#float32 = lista di float in c.embedding, coperta dall'indice vettoriale (comportamento storico)
+#float16 / int8 = byte compatti in c.embedding_q (+ c.embedding_scale per int8); candidati e ricalcolo a precisione piena
+#                 passano dalla cache locale (LOCAL_VECTOR_STORE_DIR), che salva anche i vettori float32 fuori dal grafo
+#none = nessun embedding nel grafo, la ricerca usa solo la cache locale (LOCAL_VECTOR_STORE_DIR)
+GRAPH_STORAGE_MODES = SUPPORTED_ENCODINGS + ("none",)
+EMBEDDING_GRAPH_STORAGE = os.getenv("EMBEDDING_GRAPH_STORAGE", "float32").lower()
+if EMBEDDING_GRAPH_STORAGE not in GRAPH_STORAGE_MODES:
+    raise ValueError(f"EMBEDDING_GRAPH_STORAGE non supportato: '{EMBEDDING_GRAPH_STORAGE}'. Valori ammessi: {', '.join(GRAPH_STORAGE_MODES)}")
+#Senza embedding float32 nel grafo non c'è l'indice vettoriale di Neo4j: la selezione dei candidati (e, con i formati compatti,
+#il ricalcolo a precisione piena) passa dalla cache locale, quindi la verifico all'avvio invece che alla prima indicizzazione
+if EMBEDDING_GRAPH_STORAGE != "float32" and not os.getenv("LOCAL_VECTOR_STORE_DIR"):
+    raise ValueError(f"EMBEDDING_GRAPH_STORAGE={EMBEDDING_GRAPH_STORAGE} richiede LOCAL_VECTOR_STORE_DIR: senza l'indice vettoriale del grafo la ricerca usa la matrice locale.")
+
+INT8_MAX = 127
+
+
+#Quantizza una matrice (una riga per vettore). Restituisce i codici e, solo per int8, le scale per riga
+def quantize_matrix(matrix: np.ndarray, encoding: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if encoding == "float32":
+        return matrix, None
+    if encoding == "float16":
+        return matrix.astype(np.float16), None
+    if encoding == "int8":
+        scales = np.abs(matrix).max(axis=1) / INT8_MAX
+        scales = np.where(scales > 0, scales, 1.0).astype(np.float32)
+        codes = np.clip(np.rint(matrix / scales[:, None]), -INT8_MAX, INT8_MAX).astype(np.int8)
+        return codes, scales
+    raise ValueError(f"Codifica degli embedding non supportata: '{encoding}'")
+
+#Ricostruisce la matrice float32 a partire dai codici (e dalle scale per int8)
+def dequantize_matrix(codes: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+    matrix = np.asarray(codes).astype(np.float32)
+    if scales is not None:
+        matrix *= np.asarray(scales, dtype=np.float32)[:, None]
+    return matrix
+
+#Codifica un singolo vettore in byte per il grafo: (byte, scala). La scala è 1.0 per float16
+def encode_vector(vector: np.ndarray, encoding: str) -> Tuple[bytes, float]:
+    codes, scales = quantize_matrix(np.asarray(vector, dtype=np.float32)[None, :], encoding)
+    return codes[0].tobytes(), float(scales[0]) if scales is not None else 1.0
+
+#Decodifica i byte salvati nel grafo in un vettore float32
+def decode_vector(blob: bytes, scale: Optional[float], encoding: str) -> np.ndarray:
+    codes = np.frombuffer(blob, dtype=np.int8 if encoding == "int8" else np.float16)
+    return codes.astype(np.float32) * np.float32(scale if scale is not None else 1.0)
@@ -1,99 +1,171 @@
 #Questo documento incapsula la logica per l'estrazione delle NE e del testo strutturato
 
-from gliner import GLiNER
-import torch
 import logging
-from processingPdf.loader import get_layout_extractor, load_pdf_from_bytes
-from processingPdf.logicSections import extract_logical_sections
+import math
+import os
+from typing import Any, List, Dict, Optional, Tuple
+from processingPdf.loader import get_layout_extractor, count_pdf_pages
+from processingPdf.logicSections import sections_from_spans
+from processingPdf.layoutPool import PDF_LAYOUT_WORKERS, parse_page_range, iter_page_ranges_parallel
+from processingPdf.layoutCache import layout_cache, file_sha256
+from processingPdf.modelRegistry import model_registry
 
 logger = logging.getLogger(__name__)
 
 class PDFExtractor:
-    def __init__(self):
-        self.layout_extractor = get_layout_extractor()
+    def __init__(self, pages_per_range: Optional[int] = None):
+        #spaCyLayout viene inizializzato solo se serve davvero analizzare un PDF (non sui hit della cache del layout)
+        self._layout_extractor = None
+        #Il PDF viene analizzato a intervalli di pagine letti da disco, così il documento intero
+        #(file, Doc spaCy, struttura docling) non è mai in memoria tutto insieme
+        self.pages_per_range = pages_per_range or int(os.getenv("PDF_PAGES_PER_RANGE", "20"))
+
+    @property
+    def layout_extractor(self):
+        if self._layout_extractor is None:
+            self._layout_extractor = get_layout_extractor()
+        return self._layout_extractor
+
+    #Restituisce il layout del PDF come {"spans": [{label, text, page}], "text": testo completo}, oppure None.
+    #Il risultato viene cercato (e salvato) nella cache su disco indicizzata per SHA-256 del file
+    def extract_layout(self, file_path: str) -> Optional[Dict[str, Any]]:
+        digest = file_sha256(file_path) if layout_cache.enabled else None
+        if digest:
+            cached = layout_cache.get(digest)
+            if cached is not None:
+                logger.info(f"Layout di '{os.path.basename(file_path)}' trovato in cache, salto il parsing.")
+                return cached
+
+        # Ricucio gli intervalli nell'ordine delle pagine: il builder delle sezioni riceve un unico flusso di span,
+        # quindi una sezione iniziata in un intervallo continua in quello successivo
+        spans, texts = [], []
+        for result in self.iter_page_ranges(file_path):
+            if result is None:
+                # Un intervallo non analizzabile fa fallire l'estrazione, come il parsing del file intero
+                return None
+            range_spans, range_text = result
+            spans.extend(range_spans)
+            if range_text:
+                texts.append(range_text)
+
+        layout = {"spans": spans, "text": "\n\n".join(texts)}
+        if digest:
+            layout_cache.put(digest, layout["spans"], layout["text"])
+        return layout
+
+    #Analizza il PDF a intervalli di pagine e restituisce man mano (span, testo) di ogni intervallo, in ordine
+    #(None per un intervallo non analizzabile). Di ogni intervallo tengo solo gli span già serializzati e il testo,
+    #il Doc viene liberato subito dopo
+    def iter_page_ranges(self, file_path: str):
+        page_ranges = self.page_ranges(count_pdf_pages(file_path))
+        if PDF_LAYOUT_WORKERS > 1 and len(page_ranges) > 1:
+            # Modalità parallela: gli intervalli vengono analizzati dal pool di processi
+            return iter_page_ranges_parallel(file_path, page_ranges)
+        return (parse_page_range(file_path, self.layout_extractor, first, last) for first, last in page_ranges)
+
+    #Divide le pagine in intervalli [prima, ultima] (numerate da 1). In modalità parallela riduco la dimensione
+    #degli intervalli se serve, così anche un documento corto occupa tutti i processi del pool
+    def page_ranges(self, page_count: int) -> List[Tuple[int, int]]:
+        size = self.pages_per_range
+        if PDF_LAYOUT_WORKERS > 1:
+            size = max(1, min(size, math.ceil(page_count / PDF_LAYOUT_WORKERS)))
+        return [(first, min(first + size - 1, page_count)) for first in range(1, page_count + 1, size)]
 
     def extract_sections(self, file_path: str):
-        # Legge il file in bytes per spaCyLayout
-        with open(file_path, "rb") as f:
-            pdf_bytes = f.read()
-        
-        # Carica il documento ed estrae il layout
-        doc = load_pdf_from_bytes(pdf_bytes, self.layout_extractor)
+        layout = self.extract_layout(file_path)
         
         # Suddivide in sezioni logiche
-        if doc:
-            return extract_logical_sections(doc)
+        if layout:
+            return sections_from_spans(layout["spans"], layout["text"])
         return {}
 
 class EntityExtractor:
-    _model = None
+    #Etichette zero-shot passate a GLiNER, condivise dall'estrazione singola e da quella a batch
+    LABELS = [
+        # --- GENERAL & IDENTIFIERS ---
+        "Person", "Organization", "Location", "Date", "Time", 
+        "Product", "Event", "Nationality", "Language",
+
+        # --- BUROCRATICO, NORMATIVO & BANDI ---
+        "Normative Reference",      # Articoli di legge, decreti, commi
+        "Public Body",              # Enti pubblici (es. Ministero, Commissione Europea)
+        "Deadline",                 # Scadenze per bandi, domande o pagamenti
+        "Requirement",              # Requisiti di partecipazione o criteri di accesso
+        "Amount",                   # Cifre monetarie, borse di studio, tasse
+        "Evaluation Criteria",      # Criteri di punteggio o valutazione
+        "Document Type",            # Es. ISEE, Marca da bollo, Certificato di laurea
+
+        # --- TECNICO & MANUALE DI ISTRUZIONI ---
+        "Component",                # Parti di macchinari o componenti hardware
+        "Technical Specification",   # Es. 220V, 50Hz, risoluzione 4K, velocità rotazione
+        "Error Code",               # Codici errore (es. E04, 404, Fault-01)
+        "Safety Instruction",       # Avvertenze di sicurezza o pericoli
+        "Tool",                     # Strumenti necessari (es. chiave inglese, cacciavite)
+        "Operation Mode",           # Modalità operative (es. Standby, Manuale, Eco)
+
+        # --- SCIENTIFICO, CHIMICO & FISICO ---
+        "Scientific Term",          # Termini tecnici generali
+        "Chemical Compound",        # Formule e nomi di sostanze (es. H2O, Glucosio)
+        "Theory/Law",               # Leggi fisiche o teorie (es. Legge di Ohm, Relatività)
+        "Measurement Unit",         # Unità di misura (es. Joule, Watt, Nanometri)
+        "Phenomenon",               # Fenomeni naturali o reazioni (es. Ossidazione, Gravità)
+
+        # --- MEDICO & CLINICO ---
+        "Clinical Condition",       # Malattie, patologie o sintomi
+        "Medical Parameter",        # Es. Glicemia, Pressione Arteriosa, Frequenza Cardiaca
+        "Anatomical Structure",     # Organi, ossa, muscoli o tessuti
+        "Drug/Medication",          # Nomi di farmaci o principi attivi
+        "Diagnostic Test",          # Es. Risonanza Magnetica, Analisi del sangue
+
+        # --- ACCADEMICO & SCOLASTICO ---
+        "Academic Subject",         # Materie (es. Storia Moderna, Fisica Quantistica)
+        "Exam/Test Name",           # Titoli di esami o test (es. Test TOLC, Prova Scritta)
+        "Degree Course",            # Corsi di laurea o diplomi
+        "Bibliographic Source",     # Citazioni, autori o titoli di testi universitari
+
+        # --- STORICO & NARRATIVO (FANTASCIENZA) ---
+        "Historical Period",        # Ere, secoli o movimenti (es. Illuminismo, Paleolitico)
+        "Fictional Species",        # Es. Androidi, Alieni, Specie di fantasia
+        "Technological Concept",    # Tecnologie immaginarie o concetti futuristici
+
+        # --- QUANTITATIVO ---
+        "Percentage",               # Percentuali e tassi
+        "Quantity",                 # Quantità generiche non monetarie
+        "Distance"                  # Distanze e lunghezze
+    ]
+
+    #GLiNER viene caricato in modo lazy dal registro condiviso dei modelli
     @staticmethod
     def get_model():
-        if EntityExtractor._model is None:
-            logger.info("Caricamento del modello GLiNER...")
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-            EntityExtractor._model = GLiNER.from_pretrained("urchade/gliner_medium-v2.1").to(device)
-        return EntityExtractor._model
+        return model_registry.get_gliner()
     
     @staticmethod
     def extract_ne(text: str):
         model = EntityExtractor.get_model()
+        entities_found = model.predict_entities(text, EntityExtractor.LABELS, threshold=0.5)
+        return EntityExtractor._clean_entities(entities_found)
 
-        labels = [
-    # --- GENERAL & IDENTIFIERS ---
-    "Person", "Organization", "Location", "Date", "Time", 
-    "Product", "Event", "Nationality", "Language",
-
-    # --- BUROCRATICO, NORMATIVO & BANDI ---
-    "Normative Reference",      # Articoli di legge, decreti, commi
-    "Public Body",              # Enti pubblici (es. Ministero, Commissione Europea)
-    "Deadline",                 # Scadenze per bandi, domande o pagamenti
-    "Requirement",              # Requisiti di partecipazione o criteri di accesso
-    "Amount",                   # Cifre monetarie, borse di studio, tasse
-    "Evaluation Criteria",      # Criteri di punteggio o valutazione
-    "Document Type",            # Es. ISEE, Marca da bollo, Certificato di laurea
-
-    # --- TECNICO & MANUALE DI ISTRUZIONI ---
-    "Component",                # Parti di macchinari o componenti hardware
-    "Technical Specification",   # Es. 220V, 50Hz, risoluzione 4K, velocità rotazione
-    "Error Code",               # Codici errore (es. E04, 404, Fault-01)
-    "Safety Instruction",       # Avvertenze di sicurezza o pericoli
-    "Tool",                     # Strumenti necessari (es. chiave inglese, cacciavite)
-    "Operation Mode",           # Modalità operative (es. Standby, Manuale, Eco)
-
-    # --- SCIENTIFICO, CHIMICO & FISICO ---
-    "Scientific Term",          # Termini tecnici generali
-    "Chemical Compound",        # Formule e nomi di sostanze (es. H2O, Glucosio)
-    "Theory/Law",               # Leggi fisiche o teorie (es. Legge di Ohm, Relatività)
-    "Measurement Unit",         # Unità di misura (es. Joule, Watt, Nanometri)
-    "Phenomenon",               # Fenomeni naturali o reazioni (es. Ossidazione, Gravità)
-
-    # --- MEDICO & CLINICO ---
-    "Clinical Condition",       # Malattie, patologie o sintomi
-    "Medical Parameter",        # Es. Glicemia, Pressione Arteriosa, Frequenza Cardiaca
-    "Anatomical Structure",     # Organi, ossa, muscoli o tessuti
-    "Drug/Medication",          # Nomi di farmaci o principi attivi
-    "Diagnostic Test",          # Es. Risonanza Magnetica, Analisi del sangue
-
-    # --- ACCADEMICO & SCOLASTICO ---
-    "Academic Subject",         # Materie (es. Storia Moderna, Fisica Quantistica)
-    "Exam/Test Name",           # Titoli di esami o test (es. Test TOLC, Prova Scritta)
-    "Degree Course",            # Corsi di laurea o diplomi
-    "Bibliographic Source",     # Citazioni, autori o titoli di testi universitari
-
-    # --- STORICO & NARRATIVO (FANTASCIENZA) ---
-    "Historical Period",        # Ere, secoli o movimenti (es. Illuminismo, Paleolitico)
-    "Fictional Species",        # Es. Androidi, Alieni, Specie di fantasia
-    "Technological Concept",    # Tecnologie immaginarie o concetti futuristici
-
-    # --- QUANTITATIVO ---
-    "Percentage",               # Percentuali e tassi
-    "Quantity",                 # Quantità generiche non monetarie
-    "Distance"                  # Distanze e lunghezze
-]
-        
-        entities_found = model.predict_entities(text, labels, threshold=0.5)
+    #Estrae le entità da una lista di testi passando per il percorso di predizione a batch di GLiNER,
+    #così il modello elabora più chunk per forward pass. Restituisce una lista di entità per ogni testo, nello stesso ordine
+    @staticmethod
+    def extract_ne_batch(texts: List[str], batch_size: Optional[int] = None) -> List[List[Dict[str, str]]]:
+        if not texts:
+            return []
 
+        model = EntityExtractor.get_model()
+        batch_size = batch_size or int(os.getenv("NER_BATCH_SIZE", "8"))
+        results = []
+
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            batch_entities = model.batch_predict_entities(batch, EntityExtractor.LABELS, threshold=0.5)
+            results.extend(EntityExtractor._clean_entities(found) for found in batch_entities)
+
+        return results
+
+    #Normalizza testo ed etichetta delle entità ed elimina i duplicati nello stesso chunk
+    @staticmethod
+    def _clean_entities(entities_found) -> List[Dict[str, str]]:
         entities = []
         seen = set() # Per tracciare i duplicati nello stesso chunk
 
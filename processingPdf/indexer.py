@@ -1,12 +1,15 @@
 #Questo file è responsabile di due compiti principali: caricare il modello di embedding 
 #e orchestrare l'indicizzazione completa su Neo4j
 
+import hashlib
 import logging
-import torch
-from typing import List
+import numpy as np
+from typing import Callable, Dict, List, Optional
 from langchain_core.documents import Document as LangchainDocument
-from sentence_transformers import SentenceTransformer
-from processingPdf.extractor import EntityExtractor
+from processingPdf.modelRegistry import model_registry
+from processingPdf.embeddingCache import query_embedding_cache
+from processingPdf.vectorStore import local_vector_store
+from processingPdf.embeddingCodec import EMBEDDING_GRAPH_STORAGE, encode_vector, decode_vector
 from dotenv import load_dotenv
 import os
 
@@ -16,102 +19,151 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-#Gestisce il caricamento del modello di emedding e l'indicizzazione dei chunk in Neo4j
+#Gestisce il modello di emedding e l'indicizzazione dei chunk in Neo4j.
+#Il modello vive nel registro condiviso del processo, quindi più istanze di Indexer non lo duplicano in memoria
 class Indexer:
     def __init__(self):
         try:
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-            logger.info(f"Caricamento del modello di embedding sul dispositivo: {device}")
-            #sentence-transformers gestisce l'ottimizzazione del caricamento
-            self.embedding_model = SentenceTransformer(os.getenv("EMBEDDING_MODEL_NAME"), device=device)
+            self.embedding_model_name = os.getenv("EMBEDDING_MODEL_NAME")
             self.embedding_dimensions = self.embedding_model.get_sentence_embedding_dimension()
-            logger.info(f"Modello di embedding '{os.getenv('EMBEDDING_MODEL_NAME')}' caricato con {self.embedding_dimensions} dimensioni.")
+            #Numero di chunk codificati per ogni forward pass durante l'ingestione
+            self.embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+            logger.info(f"Modello di embedding '{self.embedding_model_name}' pronto con {self.embedding_dimensions} dimensioni.")
         except Exception as e:
             logger.error(f"Errore durante il caricamento del modello di embedding: {e}")
             raise e
 
+    #Il modello viene sempre richiesto al registro: se è stato scaricato perché inattivo, viene ricaricato
+    @property
+    def embedding_model(self):
+        return model_registry.get_embedder(self.embedding_model_name)
+
     #Genera l'embedding vettoriale per un dato testo. Aggiungo un cast a List[float] per compatibilità con Neo4j
     def generate_embeddings(self, text:str) -> List[float]:
         return self.embedding_model.encode(text).tolist()
+
+    #Genera l'embedding di una query passando per la cache LRU/TTL condivisa: le domande ripetute
+    #(anche con maiuscole o spazi diversi) non vengono ricodificate dal modello
+    def embed_query(self, text: str) -> List[float]:
+        cached = query_embedding_cache.get(self.embedding_model_name, text)
+        if cached is not None:
+            return cached
+        embedding = self.generate_embeddings(text)
+        query_embedding_cache.put(self.embedding_model_name, text, embedding)
+        return embedding
+
+    #Genera gli embedding di una lista di testi a batch, invece di un forward pass per ogni chunk.
+    #Ordino i testi per numero di token così ogni batch contiene sequenze di lunghezza simile e il padding si riduce;
+    #la matrice restituita è float32 contigua e rispetta l'ordine originale dei testi
+    def generate_embeddings_batch(self, texts: List[str], batch_size: Optional[int] = None, progress_callback: Optional[Callable[[int], None]] = None) -> np.ndarray:
+        embeddings = np.empty((len(texts), self.embedding_dimensions), dtype=np.float32)
+        if not texts:
+            return embeddings
+
+        batch_size = batch_size or self.embedding_batch_size
+        model = self.embedding_model
+        token_lengths = [len(ids) for ids in model.tokenizer(texts)["input_ids"]]
+        order = np.argsort(token_lengths, kind="stable")
+
+        for start in range(0, len(order), batch_size):
+            batch_idx = order[start:start + batch_size]
+            batch_vectors = model.encode(
+                [texts[i] for i in batch_idx],
+                batch_size=len(batch_idx),
+                convert_to_numpy=True,
+                show_progress_bar=False
+            )
+            embeddings[batch_idx] = batch_vectors
+            if progress_callback:
+                progress_callback(min(start + batch_size, len(texts)))
+
+        logger.debug(f"Generati {len(texts)} embedding in {(len(texts) + batch_size - 1) // batch_size} batch da {batch_size}.")
+        return embeddings
     
-    #Orchestra l'indicizzazione dei chunk in Neo4j, gestendo la creazione del documento, dell'utente, del link e dell'inidice vettoriale
-    def index_chunks_to_neo4j(self, filename: str, chunks: list, user_id: str, lang: str = "it"):
+    #Crea/aggiorna i nodi user e document con il loro collegamento e l'indice vettoriale (se non esiste).
+    #L'indice serve anche con gli embedding compatti: copre i documenti indicizzati in float32 prima del cambio di modalità
+    def prepare_document(self, graph_db: GraphDB, filename: str, user_id: str):
+        graph_db.create_user_node(user_id)
+        graph_db.create_document_node(filename)
+        graph_db.link_user_to_document(user_id, filename)
+
+        graph_db.create_vector_index(
+            index_name="chunk_embeddings_index",
+            node_label="Chunk",
+            property_name="embedding",
+            vector_dimensions=self.embedding_dimensions
+        )
+
+    #Hash del contenuto del chunk (quello del Chunker se presente)
+    @staticmethod
+    def content_hash(chunk) -> str:
+        return chunk.metadata.get("content_hash") or hashlib.sha256(chunk.page_content.encode("utf-8")).hexdigest()
+
+    #Prepara la riga di add_chunks_bulk per un chunk, con l'embedding nel formato configurato per il grafo.
+    #Restituisce None se l'embedding non è valido
+    def chunk_row(self, chunk_id: str, chunk, content_hash: str, embedding: np.ndarray, reuse_from: Optional[str] = None) -> Optional[Dict]:
+        # Ho deciso di implementare un controllo di sicurezza bloccante: 
+        # se l'embedding ha dimensioni errate o valori non finiti, salto l'inserimento per evitare nodi "sporchi"
+        if embedding.shape[0] != self.embedding_dimensions or not np.isfinite(embedding).all():
+            logger.error(f"FALLIMENTO CRITICO: Ho rilevato un embedding non valido per il chunk {chunk_id}. Dimensione: {embedding.shape[0]}")
+            return None
+
+        row = {
+            "chunk_id": chunk_id,
+            "content": chunk.page_content,
+            "embedding": None,
+            "content_hash": content_hash,
+            "section": chunk.metadata.get("section", "unspecified"),
+            "reuse_from": reuse_from
+        }
+        if EMBEDDING_GRAPH_STORAGE == "float32":
+            # Cast a List[float] per compatibilità con Neo4j (e con il suo indice vettoriale)
+            row["embedding"] = embedding.tolist()
+        elif EMBEDDING_GRAPH_STORAGE != "none":
+            # Formato compatto: byte float16 o int8 con scala per vettore (da 4 a 8 volte più piccolo della lista di float, che Neo4j salva come float64)
+            row["embedding_q"], row["embedding_scale"] = encode_vector(embedding, EMBEDDING_GRAPH_STORAGE)
+            row["embedding_dtype"] = EMBEDDING_GRAPH_STORAGE
+        return row
+
+    #Legge gli embedding già salvati per i chunk dati: dalla matrice locale del documento (a precisione piena) e, per quelli
+    #mancanti, dal grafo (float32 o compatti). Restituisce {chunk_id: vettore float32}; se viene passato formats,
+    #lo riempie con il formato dell'embedding di ogni chunk nel grafo (float32, float16, int8 o none)
+    def load_stored_embeddings(self, graph_db: GraphDB, filename: str, chunk_ids: List[str], formats: Optional[Dict[str, str]] = None) -> Dict[str, np.ndarray]:
+        vectors = local_vector_store.get_vectors(filename, chunk_ids) if local_vector_store.enabled else {}
+        for record in graph_db.get_chunk_embeddings(chunk_ids):
+            chunk_id = record["chunk_id"]
+            if record.get("embedding") is not None:
+                stored_format = "float32"
+                vector = np.asarray(record["embedding"], dtype=np.float32)
+            elif record.get("embedding_q") is not None:
+                stored_format = record["embedding_dtype"]
+                vector = decode_vector(record["embedding_q"], record["embedding_scale"], record["embedding_dtype"])
+            else:
+                stored_format, vector = "none", None
+            if formats is not None:
+                formats[chunk_id] = stored_format
+            if vector is not None and chunk_id not in vectors:
+                vectors[chunk_id] = vector
+        return vectors
+
+    #Orchestra l'indicizzazione dei chunk in Neo4j, gestendo la creazione del documento, dell'utente, del link e dell'inidice vettoriale.
+    #Se viene passato progress_callback, lo chiamo come progress_callback(stage, **contatori) a ogni avanzamento.
+    #La reindicizzazione è incrementale (hash del contenuto): restituisce un riepilogo di cosa è stato riusato e ricalcolato.
+    #I chunk attraversano in serie gli stessi stadi della pipeline di ingestione (embedding, entità, scrittura)
+    def index_chunks_to_neo4j(self, filename: str, chunks: list, user_id: str, lang: str = "it", progress_callback: Optional[Callable[..., None]] = None):
+        from processingPdf.pipeline import IngestionPipeline
+
         if not chunks:
             logger.warning("Nessun chunk fornito per l'indicizzazione.")
             return
-        
-        graph_db = None
-        try:
-            # 1. Inizializzo la connessione a Neo4j
-            graph_db = GraphDB()
-
-            # 2. Creazione/Aggiornamento nodi user e document
-            graph_db.create_user_node(user_id)
-            graph_db.create_document_node(filename)
-            graph_db.link_user_to_document(user_id, filename)
-
-            # 3. Creazione indice vettoriale (se non esiste)
-            graph_db.create_vector_index(
-                index_name="chunk_embeddings_index",
-                node_label="Chunk",
-                property_name="embedding",
-                vector_dimensions=self.embedding_dimensions
-            )
-
-            # 4. Inserimento chunk ed embedding
-            for i, chunk in enumerate(chunks):
-                content = chunk.page_content
-                metadata = chunk.metadata
-                
-                # Ho deciso di assicurarmi che esista sempre un chunk_id valido
-                chunk_id = metadata.get("chunk_id") or f"{filename}_{i}"
-
-                # Genero l'embedding per il contenuto corrente
-                embedding = self.generate_embeddings(content)
-
-                # Ho deciso di implementare un controllo di sicurezza bloccante: 
-                # se l'embedding è vuoto o ha dimensioni errate, salto l'inserimento per evitare nodi "sporchi"
-                if not embedding or len(embedding) != self.embedding_dimensions:
-                    logger.error(f"FALLIMENTO CRITICO: Ho rilevato un embedding non valido per il chunk {chunk_id}. Dimensione: {len(embedding) if embedding else 0}")
-                    continue
-
-                # Salvo il chunk, l'embedding e i metadati in Neo4j
-                graph_db.add_chunk_to_document(filename, chunk_id, content, embedding, metadata)
-                logger.debug(f"Ho indicizzato con successo il chunk '{chunk_id}' per il file '{filename}'.")
-
-                # Estrazione e collegamento delle entità tramite GLiNER
-                try:
-                    entities = EntityExtractor.extract_ne(content)
-                    for ent in entities:
-                        graph_db.add_entity_to_chunk(ent["text"], ent["label"], chunk_id)
-                except Exception as ne_e:
-                    # Ho deciso di loggare l'errore delle entità come warning per non bloccare l'intera pipeline
-                    logger.warning(f"Non sono riuscito a estrarre entità per il chunk {chunk_id}: {ne_e}")
+        return IngestionPipeline(self, filename, user_id, progress_callback=progress_callback, concurrent=False).run(chunks=chunks)
             
-            logger.info(f"Ho completato l'indicizzazione di {len(chunks)} chunk per il file '{filename}'.")
-        
-        except Exception as e:
-            logger.error(f"Ho riscontrato un errore fatale durante l'indicizzazione in Neo4j per '{filename}': {e}")
-            raise
-        finally:
-            if graph_db:
-                graph_db.close()
-            
-    # Metodo coordinatore per processare il file fisico
-    def index_pdf(self, file_path: str, user_id: str):
-        # Import locali per gestire la pipeline
-        from processingPdf.extractor import PDFExtractor 
-        from processingPdf.chunker import Chunker
-        
-        filename = os.path.basename(file_path)
-        
-        # 1. Estrazione del testo strutturato dal PDF
-        extractor = PDFExtractor() 
-        sections = extractor.extract_sections(file_path) 
-        
-        # 2. Suddivisione delle sezioni in chunk
-        chunker = Chunker()
-        chunks = chunker.create_chunks(sections, filename)
-        
-        # 3. Indicizzazione finale su Neo4j 
-        self.index_chunks_to_neo4j(filename, chunks, user_id)
\ No newline at end of file
+    # Metodo coordinatore per processare il file fisico: layout, sezioni, chunk, embedding, entità e scrittura su Neo4j.
+    # Con INGESTION_PIPELINE=1 (default) gli stadi girano in parallelo come pipeline in streaming (processingPdf/pipeline.py),
+    # con INGESTION_PIPELINE=0 gli stessi stadi vengono eseguiti in serie nel thread corrente
+    def index_pdf(self, file_path: str, user_id: str, progress_callback: Optional[Callable[..., None]] = None):
+        # Import locale: la pipeline usa a sua volta l'Indexer
+        from processingPdf.pipeline import IngestionPipeline
+
+        concurrent = os.getenv("INGESTION_PIPELINE", "1") == "1"
+        return IngestionPipeline(self, file_path, user_id, progress_callback=progress_callback, concurrent=concurrent).run()
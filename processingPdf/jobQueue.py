@@ -0,0 +1,125 @@
+#Questo file gestisce l'indicizzazione dei PDF come job in background su un pool di worker limitato,
+#così l'endpoint /upload risponde subito e il loop di FastAPI resta libero per le richieste di chat
+
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+#Sollevata quando i job in coda o in esecuzione hanno raggiunto il limite configurato
+class IngestionQueueFull(RuntimeError):
+    pass
+
+#on_document_indexed(filename) viene chiamato dopo ogni indicizzazione riuscita: chi crea la coda lo usa per invalidare
+#ciò che dipende dal contenuto del documento (ad esempio la cache delle risposte dell'agent)
+class IngestionJobQueue:
+    def __init__(self, indexer, max_workers: Optional[int] = None, max_pending: Optional[int] = None, retention_seconds: Optional[float] = None,
+                 on_document_indexed: Optional[Callable[[str], None]] = None):
+        self.indexer = indexer
+        self.on_document_indexed = on_document_indexed
+        self.max_workers = max_workers or int(os.getenv("INGESTION_WORKERS", "1"))
+        #Numero massimo di job non ancora conclusi (in coda + in esecuzione)
+        self.max_pending = max_pending or int(os.getenv("INGESTION_MAX_PENDING", "8"))
+        #Per quanto tempo conservo lo stato dei job conclusi
+        self.retention_seconds = retention_seconds or float(os.getenv("INGESTION_JOB_RETENTION_SECONDS", "3600"))
+
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ingestion")
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    #Accoda l'indicizzazione di un file già salvato su disco e restituisce lo stato iniziale del job.
+    #cleanup_path (file o cartella) viene rimosso al termine del job, sia in caso di successo che di errore
+    def submit(self, file_path: str, user_id: str, filename: str, cleanup_path: Optional[str] = None) -> Dict[str, Any]:
+        with self._lock:
+            self._purge_finished()
+            pending = sum(1 for job in self._jobs.values() if job["status"] in ("queued", "running"))
+            if pending >= self.max_pending:
+                raise IngestionQueueFull(f"Coda di indicizzazione piena ({pending} job in attesa).")
+
+            job_id = uuid.uuid4().hex
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "filename": filename,
+                "user_id": user_id,
+                "status": "queued",
+                "stage": "queued",
+                "progress": {},
+                "error": None,
+                "result": None,
+                "created_at": time.time(),
+                "started_at": None,
+                "finished_at": None,
+            }
+            snapshot = self._snapshot(job_id)
+
+        self._executor.submit(self._run, job_id, file_path, user_id, cleanup_path)
+        logger.info(f"Job di indicizzazione {job_id} accodato per il file '{filename}'.")
+        return snapshot
+
+    #Restituisce una copia dello stato del job, o None se sconosciuto/scaduto
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if job_id not in self._jobs:
+                return None
+            return self._snapshot(job_id)
+
+    def shutdown(self, wait: bool = False):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _run(self, job_id: str, file_path: str, user_id: str, cleanup_path: Optional[str]):
+        self._update(job_id, status="running", stage="starting", started_at=time.time())
+        try:
+            summary = self.indexer.index_pdf(
+                file_path, user_id,
+                progress_callback=lambda stage, **counters: self._update(job_id, stage=stage, **counters)
+            )
+            if self.on_document_indexed:
+                self.on_document_indexed(os.path.basename(file_path))
+            self._update(job_id, status="completed", stage="completed", result=summary, finished_at=time.time())
+            logger.info(f"Job di indicizzazione {job_id} completato.")
+        except Exception as e:
+            logger.error(f"Errore durante il job di indicizzazione {job_id}: {e}")
+            self._update(job_id, status="failed", error=str(e), finished_at=time.time())
+        finally:
+            self._cleanup(cleanup_path or file_path)
+
+    #Aggiorna i campi di stato del job; i parametri non riconosciuti finiscono tra i contatori di avanzamento
+    def _update(self, job_id: str, **fields):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return
+            for key, value in fields.items():
+                if key in job and key != "progress":
+                    job[key] = value
+                else:
+                    job["progress"][key] = value
+
+    def _snapshot(self, job_id: str) -> Dict[str, Any]:
+        job = self._jobs[job_id]
+        return {**job, "progress": dict(job["progress"])}
+
+    def _purge_finished(self):
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job["finished_at"] and now - job["finished_at"] > self.retention_seconds
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    @staticmethod
+    def _cleanup(path: str):
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+        except OSError as e:
+            logger.warning(f"Impossibile rimuovere il file temporaneo '{path}': {e}")
@@ -0,0 +1,128 @@
+#Questo file implementa una cache su disco del layout estratto da spaCyLayout, indicizzata per SHA-256 del PDF:
+#se lo stesso file viene ricaricato (anche da un altro utente o per un nuovo chunking) il parsing viene saltato.
+#Ogni voce è un JSON compresso con gzip che contiene gli span di layout ({label, text, page}) e il testo completo
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+#Versione del formato delle voci: va incrementata se cambia ciò che salvo (le voci vecchie vengono ignorate)
+LAYOUT_CACHE_VERSION = 2
+
+#Calcola lo SHA-256 del file leggendolo a blocchi, senza caricarlo interamente in memoria
+def file_sha256(file_path: str, block_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+#La cache è attiva solo se è configurata una cartella (LAYOUT_CACHE_DIR). Oltre LAYOUT_CACHE_MAX_MB
+#vengono eliminate le voci usate meno di recente (l'ultimo utilizzo è il mtime del file, aggiornato a ogni hit)
+class LayoutCache:
+    def __init__(self, base_dir: Optional[str] = None, max_mb: Optional[float] = None):
+        self.base_dir = base_dir if base_dir is not None else os.getenv("LAYOUT_CACHE_DIR")
+        self.max_bytes = int((max_mb if max_mb is not None else float(os.getenv("LAYOUT_CACHE_MAX_MB", "1024"))) * 1024 ** 2)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.base_dir:
+            os.makedirs(self.base_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.base_dir)
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.base_dir, f"{digest}.json.gz")
+
+    #Restituisce il layout salvato per l'hash dato ({"spans": [...], "text": ...}) oppure None
+    def get(self, digest: str) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        path = self._path(digest)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                record = json.load(f)
+            if record.get("version") != LAYOUT_CACHE_VERSION:
+                raise ValueError(f"versione {record.get('version')} non compatibile")
+            os.utime(path)
+        except FileNotFoundError:
+            record = None
+        except Exception as e:
+            logger.warning(f"Voce della cache del layout '{digest}' non leggibile, la ignoro: {e}")
+            record = None
+
+        with self._lock:
+            if record is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return record
+
+    #Salva il layout di un PDF (scrittura atomica) e applica il limite di dimensione della cache
+    def put(self, digest: str, spans: list, text: str):
+        if not self.enabled:
+            return
+        path = self._path(digest)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as f:
+                json.dump({"version": LAYOUT_CACHE_VERSION, "spans": spans, "text": text}, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, path)
+            logger.info(f"Layout del PDF {digest[:12]} salvato in cache ({len(spans)} span, {os.path.getsize(path) / 1024:.0f} KB).")
+        except Exception as e:
+            logger.warning(f"Impossibile salvare il layout {digest[:12]} in cache: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+
+    #Elimina le voci con l'utilizzo meno recente finché la cache non rientra nel limite
+    def _evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.base_dir):
+                if not name.endswith(".json.gz"):
+                    continue
+                path = os.path.join(self.base_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    self.evictions += 1
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "max_mb": round(self.max_bytes / 1024 ** 2, 1),
+            }
+
+
+#Istanza condivisa dal processo
+layout_cache = LayoutCache()
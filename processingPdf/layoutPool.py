@@ -0,0 +1,103 @@
+#Questo file implementa l'estrazione del layout in parallelo su più core: il PDF viene diviso in intervalli di pagine
+#analizzati da un pool di processi, ognuno con il proprio estrattore spaCyLayout creato una sola volta all'avvio del worker.
+#Ogni intervallo restituisce gli span già serializzati, che il chiamante ricuce nell'ordine delle pagine
+
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from processingPdf.loader import get_layout_extractor, load_pdf_page_range
+from processingPdf.logicSections import PAGE_TEXT_LABEL, layout_span_records
+
+logger = logging.getLogger(__name__)
+
+#Numero di processi per il parsing (1 = parsing seriale nel processo corrente, come prima)
+PDF_LAYOUT_WORKERS = int(os.getenv("PDF_LAYOUT_WORKERS", "1"))
+
+#Estrattore del processo worker, creato dall'initializer del pool
+_worker_extractor = None
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+#Analizza un intervallo di pagine e restituisce (span, testo), oppure None se il parsing fallisce
+def parse_page_range(file_path: str, layout_extractor: Any, first_page: int, last_page: int) -> Optional[Tuple[List[Dict[str, Any]], str]]:
+    doc = load_pdf_page_range(file_path, layout_extractor, first_page, last_page)
+    if doc is None:
+        return None
+    text = doc.text if hasattr(doc, 'text') and doc.text.strip() else ""
+    spans = layout_span_records(doc, page_offset=first_page - 1)
+    if not spans and text:
+        # Intervallo con testo ma senza span di layout: lo passo comunque al builder delle sezioni, altrimenti
+        # con più intervalli il suo testo andrebbe perso (il testo completo è usato solo se manca il layout di tutto il documento)
+        spans = [{"label": PAGE_TEXT_LABEL, "text": text, "page": first_page}]
+    return spans, text
+
+
+def _init_worker():
+    global _worker_extractor
+    logging.basicConfig(level=logging.INFO)
+    _worker_extractor = get_layout_extractor()
+
+
+def _parse_in_worker(file_path: str, first_page: int, last_page: int):
+    return parse_page_range(file_path, _worker_extractor, first_page, last_page)
+
+
+#Restituisce il pool condiviso, creandolo al primo utilizzo. Uso "spawn" perché il processo principale
+#ha già thread attivi e modelli torch caricati, che un fork duplicherebbe in uno stato non sicuro
+def get_layout_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=PDF_LAYOUT_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker
+            )
+            logger.info(f"Pool di estrazione del layout avviato con {PDF_LAYOUT_WORKERS} processi.")
+        return _pool
+
+
+def shutdown_layout_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+#Scarta il pool dato se è ancora quello condiviso: il prossimo get_layout_pool ne crea uno nuovo.
+#Serve quando un worker muore (ad esempio per memoria esaurita) e l'executor resta inutilizzabile
+def _discard_pool(pool: ProcessPoolExecutor):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+#Analizza gli intervalli di pagine dati in parallelo e ne restituisce i risultati man mano, nello stesso ordine
+#degli intervalli (None al posto degli intervalli non analizzabili): un intervallo viene restituito appena
+#sono pronti lui e tutti i precedenti, mentre i successivi continuano a essere analizzati
+def iter_page_ranges_parallel(file_path: str, page_ranges: List[Tuple[int, int]]) -> Iterator[Optional[Tuple[List[Dict[str, Any]], str]]]:
+    pool = get_layout_pool()
+    futures = []
+    try:
+        for first_page, last_page in page_ranges:
+            futures.append(pool.submit(_parse_in_worker, file_path, first_page, last_page))
+        for future in futures:
+            yield future.result()
+    except BrokenProcessPool:
+        # Un worker è morto: il pool non è più utilizzabile, lo ricreo al prossimo documento e fallisce solo questo
+        logger.error(f"Un processo del pool di estrazione è terminato durante il parsing di '{file_path}', ricreo il pool.")
+        _discard_pool(pool)
+        raise
+    finally:
+        for future in futures:
+            future.cancel()
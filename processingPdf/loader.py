@@ -1,6 +1,7 @@
 #Questa parte è responsabile dell'estrazione del testo e delle informazioni sul
 #layout utilizzando spaCyLayout
 
+import io
 import spacy
 from typing import Any
 from spacy_layout import spaCyLayout
@@ -22,13 +23,37 @@ def get_layout_extractor():
     logger.info("Estrattore spaCyLayout per PDF inizializzato")
     return layout_extractor
 
-#Funzione per caricare il documento da bytes
-def load_pdf_from_bytes(pdf_bytes: bytes, layout_extractor: Any):
+#Conta le pagine del PDF senza caricarne il contenuto (pypdfium2 è già una dipendenza di docling)
+def count_pdf_pages(file_path: str) -> int:
+    import pypdfium2 as pdfium
+    pdf = pdfium.PdfDocument(file_path)
     try:
-        #Chiama l'estrattore sui bytes del PDF
-        doc = layout_extractor(pdf_bytes)
-        logger.info("Estrazione del layout del PDF completata")
+        return len(pdf)
+    finally:
+        pdf.close()
+
+#Copia le pagine [first_page, last_page] (numerate da 1, estremi inclusi) del PDF in un nuovo PDF in memoria
+def extract_pdf_pages(file_path: str, first_page: int, last_page: int) -> bytes:
+    import pypdfium2 as pdfium
+    source = pdfium.PdfDocument(file_path)
+    target = pdfium.PdfDocument.new()
+    try:
+        target.import_pages(source, pages=list(range(first_page - 1, last_page)))
+        buffer = io.BytesIO()
+        target.save(buffer)
+        return buffer.getvalue()
+    finally:
+        target.close()
+        source.close()
+
+#Analizza solo le pagine [first_page, last_page] (numerate da 1, estremi inclusi) del PDF letto da disco.
+#Le pagine vengono copiate in un PDF a parte e passate a spaCyLayout tramite la sua API pubblica (chiamata sui bytes),
+#quindi nel Doc risultante sono numerate da 1: chi legge il numero di pagina deve aggiungere first_page - 1
+def load_pdf_page_range(file_path: str, layout_extractor: Any, first_page: int, last_page: int):
+    try:
+        doc = layout_extractor(extract_pdf_pages(file_path, first_page, last_page))
+        logger.info(f"Estrazione del layout delle pagine {first_page}-{last_page} completata")
         return doc
     except Exception as e:
-        logger.error(f"Errore durante il caricamento o l'estrazione del PDF: {e}")
-        return None
\ No newline at end of file
+        logger.error(f"Errore durante l'estrazione del layout delle pagine {first_page}-{last_page}: {e}")
+        return None
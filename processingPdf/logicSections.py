@@ -2,84 +2,143 @@
 #(capitoli, sottosezioni, etc.) sfruttando le etichette di layout.
 
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, Iterable, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
-#Suddivide il documneto spaCy in sezioni logiche basandosi sulle etichette di layout. Il "doc" è il documento spaCy processato da load_pdf_from_bytes
-#Ritorna un dizionario dove la chiave è il titolo della sezione e il valore è il testo associato
-def extract_logical_sections(doc: Any) -> Dict[str, Any]:
-    sections = {}
-    #Questo è un titolo segnaposto per eventuale contenuto iniziale non etichettato da un header
-    current_title = "preambolo_documento"
-    sections[current_title] = ""
+#Etichette che indicano l'inizio di una NUOVA SEZIONE LOGICA
+SECTION_LABELS = ("SECTION_HEADER", "TITLE", "BOLD", "BOLD_CAPTION")
 
-    #Etichette che indicano l'inizio di una NUOVA SEZIONE LOGICA
-    SECTION_LABELS = ("SECTION_HEADER", "TITLE", "BOLD", "BOLD_CAPTION")
+#Etichette di Contenuto (da trattare come corpo testuale)
+CONTENT_LABELS = ("TEXT", "LIST", "PARAGRAPH")
 
-    #Etichette di Contenuto (da trattare come corpo testuale)
-    CONTENT_LABELS = ("TEXT", "LIST", "PARAGRAPH")
+#Prefissi delle sezioni che possono tornare a essere la sezione corrente (stessa caption o blocco generico ripetuto):
+#non sono mai definitive finché il documento non è finito
+REOPENABLE_PREFIXES = ("tabella: ", "figura: ", "blocco_generico_")
 
-    if not hasattr(doc, 'spans') or not doc.spans.get ("layout"):
-        if hasattr(doc, 'text') and doc.text.strip():
-            logger.warning("Nessun layout distinto trovato, restituisco il documento completo come sezione unica.")
-            return {"documento_completo": doc.text.strip()}
-        return {}
-    
-    #Itera su tutti gli span etichettati
-    for span in doc.spans.get("layout", []):
-        label = span.label_.upper()
-        span_text = span.text.strip()
+#Etichetta degli span sintetici con il testo di un intervallo di pagine per cui il layout non ha prodotto span,
+#e sezione in cui finisce quel testo
+PAGE_TEXT_LABEL = "PAGE_TEXT"
+PAGE_TEXT_SECTION = "blocco_generico_testo"
+
+#Costruisce le sezioni logiche consumando gli span di layout uno alla volta (etichetta + testo), nell'ordine del documento.
+#Non dipende da spaCy: gli span possono arrivare da un documento appena analizzato o dalla cache del layout
+class LogicalSectionBuilder:
+    def __init__(self):
+        self.sections = {}
+        #Questo è un titolo segnaposto per eventuale contenuto iniziale non etichettato da un header
+        self.current_title = "preambolo_documento"
+        self.sections[self.current_title] = ""
+        #Sezioni chiuse (non riceveranno altro testo) non ancora restituite da pop_closed_sections
+        self._closed = []
+
+    def add_span(self, label: str, text: str):
+        previous_title = self.current_title
+        self._add_span(label, text)
+        #Una sezione di titolo normale lasciata dal cursore non può più ricevere testo: i titoli nuovi devono
+        #essere unici, quindi il cursore non ci torna mai
+        if self.current_title != previous_title and not previous_title.startswith(REOPENABLE_PREFIXES):
+            self._closed.append(previous_title)
+
+    #Restituisce (titolo, testo) delle sezioni non vuote già definitive, ognuna una sola volta
+    def pop_closed_sections(self) -> List[Tuple[str, str]]:
+        closed = [(title, self.sections[title].strip()) for title in self._closed if self.sections[title].strip()]
+        self._closed = []
+        return closed
+
+    def _add_span(self, label: str, text: str):
+        sections = self.sections
+        label = label.upper()
+        span_text = text.strip()
 
         if not span_text:
-            continue
+            return
         
         #1. Identificazione e cambio di sezione
         if label in SECTION_LABELS:
             potential_title = span_text.lower()
             #Assicuriamo l'unicità e un minimo di lunghezza
             if len(potential_title) > 3 and potential_title not in sections:
-                current_title = potential_title
-                sections[current_title] = ""
-            elif current_title in sections:
+                self.current_title = potential_title
+                sections[self.current_title] = ""
+            elif self.current_title in sections:
                 #Se il titolo non cambia, aggiungiamo il testo (utile per titoli multi-linea)
-                sections[current_title] += span_text + "\n"
+                sections[self.current_title] += span_text + "\n"
         
         #2. Gestione Esplicita di informazioni tabulari e immagini
         elif label == "TABLE_CAPTION":
             #Usiamo la caption come nuovo titolo di sezione temporaneo
-            current_title = f"tabella: {span_text.lower()[:100]}"
-            if current_title not in sections:
-                sections[current_title] = span_text + "\n"
+            self.current_title = f"tabella: {span_text.lower()[:100]}"
+            if self.current_title not in sections:
+                sections[self.current_title] = span_text + "\n"
 
         elif label == "FIGURE_CAPTION":
             #Usiamo la caption come nuovo titolo di sezione temporaneo (per immagini ora)
-            current_title = f"figura: {span_text.lower()[:100]}"
-            if current_title not in sections:
-                sections[current_title] = span_text + "\n"
+            self.current_title = f"figura: {span_text.lower()[:100]}"
+            if self.current_title not in sections:
+                sections[self.current_title] = span_text + "\n"
         
         #3. Gestione del Testo del Corpo/Contenuto
         elif label in CONTENT_LABELS:
             #Aggiunge il testo sotto la sezione corrente o preambolo
-            sections[current_title] += span_text + "\n"
+            sections[self.current_title] += span_text + "\n"
         
-        #4. Blocchi di contenuto generici (Es. Table o Figure senza caption)
+        #4. Testo di pagine senza layout: va in una sezione a parte, senza spostare la sezione corrente
+        elif label == PAGE_TEXT_LABEL:
+            sections[PAGE_TEXT_SECTION] = sections.get(PAGE_TEXT_SECTION, "") + span_text + "\n"
+
+        #5. Blocchi di contenuto generici (Es. Table o Figure senza caption)
         elif label in ("TABLE", "FIGURE"):
             # Se la label è TABLE o FIGURE e non abbiamo ancora una caption, 
             # usiamo un titolo generico per non perdere il testo.
-            if "tabella:" not in current_title and "figura:" not in current_title:
-                 current_title = f"blocco_generico_{label.lower()}"
-                 if current_title not in sections:
-                     sections[current_title] = ""
-            sections[current_title] += span_text + "\n"
-        
-    #Pulisce le sezioni vuote e rimuove spazi iniziali/finali
-    cleaned_sections = {k: v.strip() for k, v in sections.items() if v.strip()}
+            if "tabella:" not in self.current_title and "figura:" not in self.current_title:
+                 self.current_title = f"blocco_generico_{label.lower()}"
+                 if self.current_title not in sections:
+                     sections[self.current_title] = ""
+            sections[self.current_title] += span_text + "\n"
 
-    #Gestisce il caso di documenti con molto rumore o layout non convenzionale
-    if not cleaned_sections and hasattr(doc, 'text') and doc.text.strip():
-        logger.warning("Suddivisione per layout fallita, ritorno il documento completo come sezione unica.")
-        return {"documento_completo": doc.text.strip()}
-        
-    logger.info(f"Documento suddiviso in {len(cleaned_sections)} sezioni logiche.")
-    return cleaned_sections
\ No newline at end of file
+    #Chiude la costruzione: pulisce le sezioni vuote e, se non resta nulla, ripiega sul testo completo del documento
+    def finish(self, fallback_text: str = "") -> Dict[str, Any]:
+        #Pulisce le sezioni vuote e rimuove spazi iniziali/finali
+        cleaned_sections = {k: v.strip() for k, v in self.sections.items() if v.strip()}
+
+        #Gestisce il caso di documenti con molto rumore o layout non convenzionale
+        if not cleaned_sections and fallback_text and fallback_text.strip():
+            logger.warning("Suddivisione per layout fallita, ritorno il documento completo come sezione unica.")
+            return {"documento_completo": fallback_text.strip()}
+        #Se nessuna pagina aveva layout, il testo delle pagine è il documento completo
+        if list(cleaned_sections) == [PAGE_TEXT_SECTION]:
+            logger.warning("Nessun layout distinto trovato, restituisco il documento completo come sezione unica.")
+            return {"documento_completo": cleaned_sections[PAGE_TEXT_SECTION]}
+            
+        logger.info(f"Documento suddiviso in {len(cleaned_sections)} sezioni logiche.")
+        return cleaned_sections
+
+#Converte gli span di layout del documento spaCy in record serializzabili {label, text, page}.
+#page_offset viene sommato al numero di pagina (per i Doc di un intervallo di pagine, che partono da 1)
+def layout_span_records(doc: Any, page_offset: int = 0) -> List[Dict[str, Any]]:
+    if not hasattr(doc, 'spans') or not doc.spans.get("layout"):
+        return []
+    records = []
+    for span in doc.spans.get("layout", []):
+        try:
+            page = span._.layout.page_no + page_offset
+        except Exception:
+            page = None
+        records.append({"label": span.label_, "text": span.text, "page": page})
+    return records
+
+#Suddivide in sezioni logiche una sequenza di span di layout ({label, text}); fallback_text è il testo completo
+#del documento, usato se il layout manca o non produce sezioni
+def sections_from_spans(spans: Iterable[Dict[str, Any]], fallback_text: Optional[str] = "") -> Dict[str, Any]:
+    spans = list(spans)
+    if not spans:
+        if fallback_text and fallback_text.strip():
+            logger.warning("Nessun layout distinto trovato, restituisco il documento completo come sezione unica.")
+            return {"documento_completo": fallback_text.strip()}
+        return {}
+
+    builder = LogicalSectionBuilder()
+    for span in spans:
+        builder.add_span(span["label"], span["text"])
+    return builder.finish(fallback_text)
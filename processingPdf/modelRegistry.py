@@ -0,0 +1,274 @@
+#Questo file centralizza il caricamento dei modelli pesanti (embedding, reranker e GLiNER):
+#ogni modello viene caricato una sola volta per processo e condiviso da API, agent e indicizzazione
+
+import asyncio
+import functools
+import gc
+import logging
+import os
+import threading
+import time
+import weakref
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RERANKER_MODEL = "BAAI/bge-reranker-v2-m3"
+DEFAULT_GLINER_MODEL = "urchade/gliner_medium-v2.1"
+
+#Precisione di inferenza applicata ai modelli al caricamento:
+#fp32 (default), int8 (quantizzazione dinamica dei Linear, solo CPU) oppure bf16 (dove l'hardware lo supporta).
+#INFERENCE_PRECISION vale per tutti i modelli, INFERENCE_PRECISION_EMBEDDER / _RERANKER / _GLINER lo sovrascrivono per tipo
+SUPPORTED_PRECISIONS = ("fp32", "int8", "bf16")
+
+
+def _get_device() -> str:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+#Trova il modulo torch che contiene i pesi (SentenceTransformer e GLiNER lo sono direttamente,
+#il CrossEncoder nelle versioni meno recenti espone il modello HuggingFace in .model)
+def _torch_module(model: Any) -> Optional[torch.nn.Module]:
+    if isinstance(model, torch.nn.Module):
+        return model
+    inner = getattr(model, "model", None)
+    if isinstance(inner, torch.nn.Module):
+        return inner
+    return None
+
+
+#Stima l'occupazione in memoria di un modello sommando parametri e buffer.
+#I Linear quantizzati in int8 tengono i pesi in _packed_params (né parametri né buffer), quindi li conto a parte
+def _model_size_bytes(model: Any) -> int:
+    module = _torch_module(model)
+    if module is None:
+        return 0
+    size = sum(p.numel() * p.element_size() for p in module.parameters())
+    size += sum(b.numel() * b.element_size() for b in module.buffers())
+    for sub in module.modules():
+        if getattr(sub, "_packed_params", None) is not None and callable(getattr(sub, "weight", None)):
+            weight = sub.weight()
+            size += weight.numel() * weight.element_size()
+    return size
+
+
+#Precisione configurata per un tipo di modello
+def get_precision(kind: str) -> str:
+    precision = os.getenv(f"INFERENCE_PRECISION_{kind.upper()}", os.getenv("INFERENCE_PRECISION", "fp32")).lower()
+    if precision not in SUPPORTED_PRECISIONS:
+        raise ValueError(f"Precisione di inferenza non supportata per {kind}: '{precision}'. Valori ammessi: {', '.join(SUPPORTED_PRECISIONS)}")
+    return precision
+
+
+def _bf16_supported(device: str) -> bool:
+    if device == "cuda":
+        return torch.cuda.is_bf16_supported()
+    #Su CPU il bf16 conviene solo con le istruzioni dedicate (AVX512-BF16 / AMX), altrimenti è emulato e più lento
+    check = getattr(torch.cpu, "_is_avx512_bf16_supported", None)
+    return bool(check and check())
+
+
+#Converte i pesi del modello nella precisione richiesta. Se la modalità non è applicabile
+#(int8 su GPU, bf16 senza supporto hardware) lascio il modello in fp32 e lo segnalo nei log
+def _apply_precision(model: Any, precision: str) -> Any:
+    if precision == "fp32":
+        return model
+    module = _torch_module(model)
+    device = _get_device()
+    if module is None:
+        logger.warning(f"Precisione '{precision}' non applicabile a {type(model).__name__}: resta in fp32.")
+        return model
+
+    if precision == "int8":
+        if device != "cpu":
+            logger.warning("La quantizzazione dinamica int8 è supportata solo su CPU: il modello resta in fp32.")
+            return model
+        #Quantizzazione dinamica: i pesi dei Linear diventano int8, le attivazioni vengono quantizzate al volo.
+        #inplace=True sostituisce i sottomoduli, così anche i wrapper (SentenceTransformer, CrossEncoder, GLiNER) la vedono
+        torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif precision == "bf16":
+        if not _bf16_supported(device):
+            logger.warning(f"bf16 non supportato in modo nativo su {device}: il modello resta in fp32.")
+            return model
+        module.to(torch.bfloat16)
+    return model
+
+
+def _load_embedder(model_name: str, precision: str = "fp32"):
+    from sentence_transformers import SentenceTransformer
+    return _apply_precision(SentenceTransformer(model_name, device=_get_device()), precision)
+
+
+def _load_reranker(model_name: str, precision: str = "fp32"):
+    from sentence_transformers import CrossEncoder
+    #il CrossEncoder riceve coppie (domanda, chunk) e restituisce un punteggio
+    return _apply_precision(CrossEncoder(model_name, device=_get_device()), precision)
+
+
+def _load_gliner(model_name: str, precision: str = "fp32"):
+    from gliner import GLiNER
+    return _apply_precision(GLiNER.from_pretrained(model_name).to(_get_device()), precision)
+
+
+#Registro dei modelli del processo. Le voci sono indicizzate per "tipo:nome_modello" e tengono
+#traccia di dimensione e ultimo utilizzo, così i modelli inattivi possono essere scaricati e ricaricati su richiesta
+class ModelRegistry:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        #Un lock per voce, usato solo durante il caricamento del modello
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self._loaders: Dict[str, Callable[[str, str], Any]] = {
+            "embedder": _load_embedder,
+            "reranker": _load_reranker,
+            "gliner": _load_gliner,
+        }
+        self._reaper: Optional[threading.Thread] = None
+        #Modelli tolti dal registro ma ancora referenziati altrove (chiave -> (weakref, byte)): la memoria torna libera
+        #solo quando l'ultimo utilizzatore li rilascia, quindi li riporto a parte in memory_report
+        self._released: Dict[str, Any] = {}
+
+    #Restituisce il modello richiesto, caricandolo al primo utilizzo (o dopo uno scaricamento).
+    #Senza precision uso quella configurata per il tipo; precisioni diverse dello stesso modello sono voci distinte.
+    #Il caricamento avviene fuori dal lock del registro, sotto un lock della sola voce: chi chiede un modello già
+    #caricato non aspetta il caricamento (anche lungo) di un altro, chi chiede lo stesso modello attende e lo riusa
+    def get(self, kind: str, model_name: str, precision: Optional[str] = None):
+        precision = precision or get_precision(kind)
+        key = f"{kind}:{model_name}" if precision == "fp32" else f"{kind}:{model_name}:{precision}"
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["last_used"] = time.time()
+                return entry["model"]
+            key_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is None:
+                logger.info(f"Caricamento del modello {kind} '{model_name}' ({precision})...")
+                start = time.perf_counter()
+                model = self._loaders[kind](model_name, precision)
+                entry = {
+                    "kind": kind,
+                    "model_name": model_name,
+                    "precision": precision,
+                    "model": model,
+                    "size_bytes": _model_size_bytes(model),
+                    "loaded_at": time.time(),
+                    "load_seconds": time.perf_counter() - start,
+                }
+                logger.info(f"Modello {kind} '{model_name}' caricato in {entry['load_seconds']:.1f}s ({entry['size_bytes'] / 1024 ** 2:.0f} MB).")
+            with self._lock:
+                entry["last_used"] = time.time()
+                self._entries[key] = entry
+            return entry["model"]
+
+    def get_embedder(self, model_name: Optional[str] = None, precision: Optional[str] = None):
+        return self.get("embedder", model_name or os.getenv("EMBEDDING_MODEL_NAME"), precision)
+
+    def get_reranker(self, model_name: Optional[str] = None, precision: Optional[str] = None):
+        return self.get("reranker", model_name or os.getenv("RERANKER_MODEL_NAME", DEFAULT_RERANKER_MODEL), precision)
+
+    def get_gliner(self, model_name: Optional[str] = None, precision: Optional[str] = None):
+        return self.get("gliner", model_name or os.getenv("GLINER_MODEL_NAME", DEFAULT_GLINER_MODEL), precision)
+
+    #Riporta per ogni modello caricato l'occupazione in memoria e i tempi di caricamento/utilizzo,
+    #più i modelli scaricati dal registro ma non ancora liberati perché qualcuno li sta ancora usando
+    def memory_report(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            self._prune_released()
+            pending = {key: round(size / 1024 ** 2, 1) for key, (_, size) in self._released.items()}
+            models = {
+                key: {
+                    "kind": entry["kind"],
+                    "model_name": entry["model_name"],
+                    "precision": entry["precision"],
+                    "size_mb": round(entry["size_bytes"] / 1024 ** 2, 1),
+                    "load_seconds": round(entry["load_seconds"], 2),
+                    "idle_seconds": round(now - entry["last_used"], 1),
+                }
+                for key, entry in self._entries.items()
+            }
+        return {
+            "models": models,
+            "total_mb": round(sum(m["size_mb"] for m in models.values()), 1),
+            "pending_release": pending,
+            "pending_release_mb": round(sum(pending.values()), 1),
+        }
+
+    #Toglie un modello dal registro; verrà ricaricato al prossimo get(). La memoria viene liberata solo quando nessuno
+    #lo usa più: chi ha ottenuto il modello prima (ad esempio un'inferenza in corso) lo tiene vivo finché non lo rilascia.
+    #Controllo con un weakref se il modello è stato davvero liberato e, se no, lo segnalo e lo riporto in memory_report
+    def unload(self, key: str) -> bool:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        try:
+            model_ref = weakref.ref(entry["model"])
+        except TypeError:
+            model_ref = None
+        size_bytes = entry["size_bytes"]
+        del entry
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        if model_ref is not None and model_ref() is not None:
+            with self._lock:
+                self._released[key] = (model_ref, size_bytes)
+            logger.info(f"Modello '{key}' tolto dal registro: {size_bytes / 1024 ** 2:.0f} MB verranno liberati quando l'ultimo utilizzatore lo rilascia.")
+        else:
+            logger.info(f"Modello '{key}' scaricato dalla memoria.")
+        return True
+
+    #Dimentica i modelli scaricati che nel frattempo sono stati liberati (da chiamare con il lock del registro)
+    def _prune_released(self):
+        for key in [key for key, (ref, _) in self._released.items() if ref() is None]:
+            del self._released[key]
+
+    #Scarica i modelli non utilizzati da almeno max_idle_seconds e restituisce le chiavi scaricate
+    def unload_idle(self, max_idle_seconds: float) -> List[str]:
+        now = time.time()
+        with self._lock:
+            idle_keys = [key for key, entry in self._entries.items() if now - entry["last_used"] >= max_idle_seconds]
+        return [key for key in idle_keys if self.unload(key)]
+
+    #Avvia un thread daemon che scarica periodicamente i modelli inattivi.
+    #Disattivato se MODEL_IDLE_UNLOAD_SECONDS non è impostato (o è 0)
+    def start_idle_reaper(self, max_idle_seconds: Optional[float] = None, interval_seconds: float = 60.0):
+        max_idle_seconds = max_idle_seconds if max_idle_seconds is not None else float(os.getenv("MODEL_IDLE_UNLOAD_SECONDS", "0"))
+        if max_idle_seconds <= 0 or self._reaper is not None:
+            return
+
+        def _reap():
+            while True:
+                time.sleep(interval_seconds)
+                try:
+                    self.unload_idle(max_idle_seconds)
+                except Exception as e:
+                    logger.warning(f"Errore durante lo scaricamento dei modelli inattivi: {e}")
+
+        self._reaper = threading.Thread(target=_reap, name="model-idle-reaper", daemon=True)
+        self._reaper.start()
+        logger.info(f"Scaricamento automatico dei modelli inattivi da più di {max_idle_seconds:.0f}s attivato.")
+
+
+#Istanza unica condivisa dal processo
+model_registry = ModelRegistry()
+
+
+#Executor dedicato all'inferenza dei modelli (embedding, reranking, NER): i percorsi async
+#vi delegano il lavoro CPU-bound così il loop di FastAPI resta libero di servire le altre richieste
+_inference_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("INFERENCE_WORKERS", "2")),
+    thread_name_prefix="inference"
+)
+
+#Esegue fn(*args, **kwargs) sull'executor di inferenza e ne attende il risultato senza bloccare il loop
+async def run_inference(fn: Callable, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_inference_executor, functools.partial(fn, *args, **kwargs))
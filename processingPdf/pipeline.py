@@ -0,0 +1,543 @@
+#Questo file implementa l'ingestione di un PDF come pipeline in streaming: layout -> sezioni -> chunk -> embedding -> NER -> scrittura su Neo4j.
+#Ogni stadio è un generatore che gira nel proprio thread e comunica con il successivo tramite una coda limitata (backpressure):
+#mentre il modello calcola gli embedding di un batch, il batch precedente viene scritto su Neo4j e le pagine successive
+#vengono ancora analizzate, così il tempo totale si avvicina a quello dello stadio più lento invece che alla somma degli stadi.
+#Gli stessi stadi possono anche essere concatenati in serie nel thread chiamante (INGESTION_PIPELINE=0 e index_chunks_to_neo4j),
+#così la logica della reindicizzazione incrementale esiste in un solo punto
+
+import hashlib
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from processingPdf.chunker import Chunker
+from processingPdf.embeddingCodec import EMBEDDING_GRAPH_STORAGE
+from processingPdf.extractor import EntityExtractor, PDFExtractor
+from processingPdf.layoutCache import layout_cache, file_sha256
+from processingPdf.logicSections import LogicalSectionBuilder
+from processingPdf.vectorStore import local_vector_store
+from db.graph_db import GraphDB
+
+logger = logging.getLogger(__name__)
+
+#Numero massimo di elementi (batch) in attesa tra due stadi: limita la memoria e rallenta gli stadi a monte se quelli a valle non tengono il passo
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "4"))
+#Numero di span di layout per batch quando il layout arriva già completo dalla cache
+LAYOUT_SPAN_BATCH = 500
+
+#Marcatore di fine flusso tra due stadi
+_DONE = object()
+
+
+#Sollevata dentro uno stadio quando un altro stadio è fallito, per farlo terminare senza restare bloccato su una coda
+class PipelineAborted(Exception):
+    pass
+
+
+def _put(q: queue.Queue, item: Any, failed: threading.Event):
+    while True:
+        if failed.is_set():
+            raise PipelineAborted()
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _get(q: queue.Queue, failed: threading.Event) -> Any:
+    while True:
+        if failed.is_set():
+            raise PipelineAborted()
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+
+#Uno stadio della pipeline: esegue il generatore func sul flusso in ingresso. In modalità concorrente gira in un thread
+#e legge/scrive su code limitate, in modalità seriale viene concatenato come generatore allo stadio precedente.
+#Misura il tempo passato ad aspettare l'ingresso (stadio affamato) e l'uscita (stadio frenato da quello dopo):
+#il resto è il tempo di lavoro effettivo, da cui ricavo il throughput
+class PipelineStage:
+    def __init__(self, name: str, func: Callable[[Optional[Iterator[Any]]], Iterable[Any]], item_size: Callable[[Any], int] = lambda item: 1):
+        self.name = name
+        self.func = func
+        self.item_size = item_size
+        self.inbox: Optional[queue.Queue] = None
+        self.outbox: Optional[queue.Queue] = None
+        self.failed: Optional[threading.Event] = None
+        self.thread: Optional[threading.Thread] = None
+        self.items = 0
+        self.wait_input_seconds = 0.0
+        self.wait_output_seconds = 0.0
+        self.wall_seconds = 0.0
+        self.error: Optional[BaseException] = None
+
+    #Collega lo stadio alle code e prepara il suo thread (modalità concorrente)
+    def connect(self, inbox: Optional[queue.Queue], outbox: Optional[queue.Queue], failed: threading.Event):
+        self.inbox = inbox
+        self.outbox = outbox
+        self.failed = failed
+        self.thread = threading.Thread(target=self._run, name=f"ingestion-{self.name}", daemon=True)
+
+    #Flusso in ingresso: dalla coda in modalità concorrente, dal generatore dello stadio precedente in modalità seriale
+    def _input(self, upstream: Optional[Iterator[Any]] = None) -> Iterator[Any]:
+        while True:
+            start = time.perf_counter()
+            item = next(upstream, _DONE) if upstream is not None else _get(self.inbox, self.failed)
+            self.wait_input_seconds += time.perf_counter() - start
+            if item is _DONE:
+                return
+            yield item
+
+    #Modalità seriale: restituisce il generatore dei risultati dello stadio, alimentato da upstream
+    def iterate(self, upstream: Optional[Iterator[Any]]) -> Iterator[Any]:
+        start = time.perf_counter()
+        try:
+            for output in self.func(self._input(upstream) if upstream is not None else None):
+                self.items += self.item_size(output)
+                yield_start = time.perf_counter()
+                yield output
+                self.wait_output_seconds += time.perf_counter() - yield_start
+        finally:
+            self.wall_seconds = time.perf_counter() - start
+
+    def _run(self):
+        start = time.perf_counter()
+        outputs = iter(self.func(self._input() if self.inbox is not None else None))
+        try:
+            for output in outputs:
+                self.items += self.item_size(output)
+                if self.outbox is not None:
+                    put_start = time.perf_counter()
+                    _put(self.outbox, output, self.failed)
+                    self.wait_output_seconds += time.perf_counter() - put_start
+            if self.outbox is not None:
+                _put(self.outbox, _DONE, self.failed)
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            logger.error(f"Stadio '{self.name}' della pipeline di ingestione fallito: {e}")
+            self.error = e
+            self.failed.set()
+        finally:
+            # Chiudo il generatore così libera le sue risorse (ad esempio gli intervalli di pagine ancora in coda nel pool)
+            if hasattr(outputs, "close"):
+                outputs.close()
+            self.wall_seconds = time.perf_counter() - start
+
+    def metrics(self) -> Dict[str, Any]:
+        busy = max(0.0, self.wall_seconds - self.wait_input_seconds - self.wait_output_seconds)
+        return {
+            "items": self.items,
+            "busy_seconds": round(busy, 3),
+            "wait_input_seconds": round(self.wait_input_seconds, 3),
+            "wait_output_seconds": round(self.wait_output_seconds, 3),
+            "wall_seconds": round(self.wall_seconds, 3),
+            "items_per_second": round(self.items / busy, 2) if busy > 0 else None,
+        }
+
+
+#Ingestione di un singolo PDF: un'istanza per documento, gli stadi condividono lo stato della reindicizzazione incrementale.
+#Il risultato è il riepilogo della reindicizzazione (chunk invariati, riusati, ricalcolati...), più le metriche degli stadi in "pipeline".
+#Durante il flusso vengono scritti solo i chunk con un chunk_id nuovo: quelli che sovrascrivono un chunk esistente e la rimozione
+#dei chunk spariti vengono applicati a flusso completato in un'unica transazione, poi viene salvata la matrice locale.
+#Se il flusso o quella transazione falliscono, i chunk nuovi già scritti vengono eliminati e la versione precedente resta intatta
+class IngestionPipeline:
+    def __init__(self, indexer, file_path: str, user_id: str, progress_callback: Optional[Callable[..., None]] = None,
+                 queue_size: Optional[int] = None, concurrent: bool = True):
+        self.indexer = indexer
+        self.concurrent = concurrent
+        self.file_path = file_path
+        self.user_id = user_id
+        self.filename = os.path.basename(file_path)
+        self.report = progress_callback or (lambda stage, **counters: None)
+        self.queue_size = queue_size or PIPELINE_QUEUE_SIZE
+        self.batch_size = indexer.embedding_batch_size
+        self.ner_batch_size = int(os.getenv("NER_BATCH_SIZE", "8"))
+        self.incremental = os.getenv("INCREMENTAL_INDEXING", "1") == "1"
+
+        self.extractor = PDFExtractor()
+        self.chunker = Chunker()
+        self.graph_db: Optional[GraphDB] = None
+        self.document_ready = False
+        # Diventa True quando la nuova versione è stata applicata al grafo: da lì in poi non c'è più nulla da annullare
+        self.committed = False
+        self.fallback_text = ""
+
+        # Stato della versione già indicizzata, letto all'avvio dello stadio di embedding
+        self.old_hashes: Dict[str, Optional[str]] = {}
+        self.old_entities: Dict[str, List[Dict[str, Any]]] = {}
+        self.old_formats: Dict[str, str] = {}
+
+        # Contatori e risultati raccolti dagli stadi
+        self.sections_total = 0
+        # chunk_id dei chunk della nuova versione che finiscono davvero nel grafo (invariati o con una riga scritta):
+        # un chunk scartato per un embedding non valido non ne fa parte, quindi il suo vecchio chunk viene rimosso
+        self.chunk_ids: List[str] = []
+        #content_hash dei chunk della nuova versione, da cui ricavo la versione del contenuto del documento
+        self.content_hashes: Dict[str, str] = {}
+        self.chunks_seen = 0
+        self.skipped = 0
+        self.unchanged = 0
+        self.reused = 0
+        self.recomputed = 0
+        self.written = 0
+        self.linked = 0
+        # Chunk scritti durante il flusso (da eliminare se il flusso fallisce) e righe rimandate al termine del flusso
+        self.created_ids: List[str] = []
+        self.created_entities = set()
+        self.deferred_rows: List[Dict[str, Any]] = []
+        self.deferred_entity_rows: List[Dict[str, Any]] = []
+        self.local_ids: List[str] = []
+        self.local_vectors: List[np.ndarray] = []
+
+    #Esegue l'ingestione del PDF; se viene passata una lista di chunk già pronti, parte direttamente dallo stadio di embedding
+    def run(self, chunks: Optional[list] = None) -> Optional[Dict[str, Any]]:
+        self.report("indexing", chunks_total=0)
+
+        start = time.perf_counter()
+        try:
+            self.graph_db = GraphDB()
+            stages = self._build_stages(chunks)
+            if self.concurrent:
+                self._run_concurrently(stages)
+            else:
+                self._run_serially(stages)
+
+            # Lo stadio con più tempo di lavoro effettivo è quello che limita il throughput dell'intera pipeline
+            metrics = {stage.name: stage.metrics() for stage in stages}
+            bottleneck = max(stages, key=lambda stage: metrics[stage.name]["busy_seconds"]).name
+            metrics["bottleneck"] = bottleneck
+            metrics["mode"] = "concurrent" if self.concurrent else "serial"
+            metrics["total_seconds"] = round(time.perf_counter() - start, 3)
+
+            if not self.chunk_ids:
+                logger.warning(f"Nessun chunk estratto da '{self.filename}', il documento non viene indicizzato.")
+                return None
+            summary = self._finalize()
+            summary["pipeline"] = metrics
+
+            logger.info(f"Ho completato l'indicizzazione in pipeline di {len(self.chunk_ids)} chunk per il file '{self.filename}': {summary}")
+            return summary
+
+        except Exception as e:
+            logger.error(f"Ho riscontrato un errore fatale durante l'ingestione in pipeline di '{self.filename}': {e}")
+            # Un errore durante il flusso non deve lasciare il documento a metà tra la vecchia e la nuova versione
+            if self.graph_db and not self.committed:
+                self._rollback()
+            raise
+        finally:
+            if self.graph_db:
+                self.graph_db.close()
+
+    def _build_stages(self, chunks: Optional[list] = None) -> List[PipelineStage]:
+        if chunks is None:
+            source = [
+                PipelineStage("layout", self._layout_stage, item_size=len),
+                PipelineStage("sections", self._sections_stage),
+                PipelineStage("chunks", self._chunks_stage, item_size=len),
+            ]
+        else:
+            source = [PipelineStage("chunks", lambda _: self._batched(chunks), item_size=len)]
+        return source + [
+            PipelineStage("embedding", self._embedding_stage, item_size=len),
+            PipelineStage("entities", self._entities_stage, item_size=lambda batch: len(batch[0])),
+            PipelineStage("writing", self._writing_stage, item_size=lambda written: written),
+        ]
+
+    #Ogni stadio nel proprio thread, collegato al successivo da una coda limitata
+    def _run_concurrently(self, stages: List[PipelineStage]):
+        failed = threading.Event()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(stages) - 1)]
+        for i, stage in enumerate(stages):
+            stage.connect(queues[i - 1] if i > 0 else None, queues[i] if i < len(queues) else None, failed)
+        for stage in stages:
+            stage.thread.start()
+        for stage in stages:
+            stage.thread.join()
+        errors = [stage.error for stage in stages if stage.error is not None]
+        if errors:
+            raise errors[0]
+
+    #Gli stadi concatenati come generatori nel thread chiamante: ogni batch attraversa tutta la catena prima del successivo
+    def _run_serially(self, stages: List[PipelineStage]):
+        stream = None
+        for stage in stages:
+            stream = stage.iterate(stream)
+        for _ in stream:
+            pass
+
+    def _batched(self, items: list) -> Iterator[list]:
+        for start in range(0, len(items), self.batch_size):
+            yield items[start:start + self.batch_size]
+
+    #Stadio 1: span di layout, dalla cache se il PDF è già stato analizzato, altrimenti intervallo di pagine per intervallo
+    def _layout_stage(self, _) -> Iterator[List[Dict[str, Any]]]:
+        digest = file_sha256(self.file_path) if layout_cache.enabled else None
+        cached = layout_cache.get(digest) if digest else None
+        if cached is not None:
+            logger.info(f"Layout di '{self.filename}' trovato in cache, salto il parsing.")
+            self.fallback_text = cached["text"]
+            for start in range(0, len(cached["spans"]), LAYOUT_SPAN_BATCH):
+                yield cached["spans"][start:start + LAYOUT_SPAN_BATCH]
+            return
+
+        spans, texts = [], []
+        for result in self.extractor.iter_page_ranges(self.file_path):
+            if result is None:
+                raise RuntimeError(f"Non sono riuscito ad analizzare un intervallo di pagine di '{self.filename}'.")
+            range_spans, range_text = result
+            if digest:
+                spans.extend(range_spans)
+            if range_text:
+                texts.append(range_text)
+            yield range_spans
+
+        self.fallback_text = "\n\n".join(texts)
+        if digest:
+            layout_cache.put(digest, spans, self.fallback_text)
+
+    #Stadio 2: sezioni logiche, emesse appena diventano definitive. Le sezioni di tabelle, figure e blocchi generici
+    #possono ricevere testo fino alla fine del documento, quindi arrivano con finish()
+    def _sections_stage(self, span_batches: Iterator[List[Dict[str, Any]]]) -> Iterator[tuple]:
+        builder = LogicalSectionBuilder()
+        emitted = set()
+        for spans in span_batches:
+            for span in spans:
+                builder.add_span(span["label"], span["text"])
+            for title, text in builder.pop_closed_sections():
+                emitted.add(title)
+                yield title, text
+
+        # Il testo completo è pronto: lo stadio del layout lo imposta prima di chiudere il flusso
+        for title, text in builder.finish(self.fallback_text).items():
+            if title not in emitted:
+                yield title, text
+
+    #Stadio 3: chunk delle sezioni, raggruppati in batch della dimensione usata per gli embedding
+    def _chunks_stage(self, sections: Iterator[tuple]) -> Iterator[list]:
+        batch = []
+        for title, text in sections:
+            self.sections_total += 1
+            self.report("indexing", sections_total=self.sections_total)
+            batch.extend(self.chunker.chunk_section(title, text, self.filename))
+            if len(batch) >= self.batch_size:
+                full = len(batch) - len(batch) % self.batch_size
+                yield from self._batched(batch[:full])
+                batch = batch[full:]
+        if batch:
+            yield batch
+
+    #Legge dalla versione già indicizzata hash, entità ed embedding di tutti i chunk. Va fatto prima di qualsiasi scrittura:
+    #un chunk_id può essere riscritto con un nuovo contenuto mentre un altro chunk sta ancora per riusarne embedding ed entità
+    def _load_previous_version(self) -> Dict[str, np.ndarray]:
+        self.old_hashes = self.graph_db.get_document_chunk_hashes(self.filename)
+        for record in self.graph_db.get_chunk_entities(list(self.old_hashes)):
+            self.old_entities.setdefault(record["chunk_id"], []).append(record)
+        # Con INCREMENTAL_INDEXING=0 tutti i chunk vengono ricalcolati, quindi non serve nessun embedding salvato
+        if not self.incremental:
+            return {}
+        return self.indexer.load_stored_embeddings(self.graph_db, self.filename, list(self.old_hashes), formats=self.old_formats)
+
+    #Stadio 4: confronto con la versione già indicizzata (hash del contenuto) ed embedding a batch dei soli chunk nuovi o modificati.
+    #Emette le righe da scrivere: i chunk invariati non vengono riscritti, a meno che nel grafo il loro embedding sia in un formato
+    #diverso da EMBEDDING_GRAPH_STORAGE (cambio di modalità): in quel caso vengono riscritti riusando l'embedding salvato
+    def _embedding_stage(self, chunk_batches: Iterator[list]) -> Iterator[List[Dict[str, Any]]]:
+        stored = self._load_previous_version()
+        old_by_hash = {content_hash: chunk_id for chunk_id, content_hash in self.old_hashes.items() if content_hash} if self.incremental else {}
+        dimensions = self.indexer.embedding_dimensions
+
+        for chunks in chunk_batches:
+            vectors = np.zeros((len(chunks), dimensions), dtype=np.float32)
+            keep = [False] * len(chunks)
+            rows = [None] * len(chunks)
+            batch_ids = []
+            fresh = []
+            for j, chunk in enumerate(chunks):
+                # Ho deciso di assicurarmi che esista sempre un chunk_id valido
+                chunk_id = chunk.metadata.get("chunk_id") or f"{self.filename}_{self.chunks_seen}"
+                content_hash = self.indexer.content_hash(chunk)
+                self.chunks_seen += 1
+                batch_ids.append(chunk_id)
+
+                if (self.incremental and self.old_hashes.get(chunk_id) == content_hash and self.old_formats.get(chunk_id) == EMBEDDING_GRAPH_STORAGE
+                        and (not local_vector_store.enabled or chunk_id in stored)):
+                    self.unchanged += 1
+                    self.chunk_ids.append(chunk_id)
+                    self.content_hashes[chunk_id] = content_hash
+                    if local_vector_store.enabled:
+                        vectors[j], keep[j] = stored[chunk_id], True
+                    continue
+
+                source_id = old_by_hash.get(content_hash)
+                if source_id is not None and source_id in stored:
+                    self.reused += 1
+                    vectors[j] = stored[source_id]
+                    rows[j] = (chunk_id, chunk, content_hash, source_id)
+                else:
+                    self.recomputed += 1
+                    fresh.append(j)
+                    rows[j] = (chunk_id, chunk, content_hash, None)
+
+            if fresh:
+                vectors[fresh] = self.indexer.generate_embeddings_batch([chunks[j].page_content for j in fresh])
+
+            chunk_rows = []
+            for j, args in enumerate(rows):
+                if args is None:
+                    continue
+                chunk_id, chunk, content_hash, source_id = args
+                row = self.indexer.chunk_row(chunk_id, chunk, content_hash, vectors[j], source_id)
+                if row is None:
+                    self.skipped += 1
+                    continue
+                keep[j] = True
+                self.chunk_ids.append(chunk_id)
+                self.content_hashes[chunk_id] = content_hash
+                chunk_rows.append(row)
+
+            if local_vector_store.enabled:
+                for j, chunk_id in enumerate(batch_ids):
+                    if keep[j]:
+                        self.local_ids.append(chunk_id)
+                        self.local_vectors.append(vectors[j])
+
+            self.report("indexing", chunks_total=self.chunks_seen, chunks_embedded=self.chunks_seen)
+            if chunk_rows:
+                yield chunk_rows
+
+    #Stadio 5: entità dei chunk. Quelle dei chunk riusati vengono copiate dal vecchio chunk, le altre estratte con GLiNER a batch
+    def _entities_stage(self, row_batches: Iterator[List[Dict[str, Any]]]) -> Iterator[tuple]:
+        tagged = 0
+        for rows in row_batches:
+            entity_rows = []
+            for row in rows:
+                if row["reuse_from"]:
+                    entity_rows.extend(
+                        {"chunk_id": row["chunk_id"], "name": ent["name"], "type": ent["type"]}
+                        for ent in self.old_entities.get(row["reuse_from"], [])
+                    )
+            ner_rows = [row for row in rows if not row["reuse_from"]]
+            for start in range(0, len(ner_rows), self.ner_batch_size):
+                batch = ner_rows[start:start + self.ner_batch_size]
+                try:
+                    batch_entities = EntityExtractor.extract_ne_batch([row["content"] for row in batch], batch_size=self.ner_batch_size)
+                    for row, entities in zip(batch, batch_entities):
+                        entity_rows.extend(
+                            {"chunk_id": row["chunk_id"], "name": ent["text"], "type": ent["label"]}
+                            for ent in entities
+                        )
+                except Exception as ne_e:
+                    # Ho deciso di loggare l'errore delle entità come warning per non bloccare l'intera pipeline
+                    logger.warning(f"Non sono riuscito a estrarre entità per i chunk {batch[0]['chunk_id']}..{batch[-1]['chunk_id']}: {ne_e}")
+            tagged += len(rows)
+            self.report("indexing", chunks_tagged=tagged)
+            yield rows, entity_rows
+
+    #Stadio 6: scrittura su Neo4j di ogni batch (chunk ed entità) appena è pronto. Solo i chunk con un chunk_id nuovo vengono scritti
+    #subito: quelli che sovrascriverebbero un chunk della versione precedente vengono rimandati alla fine del flusso
+    def _writing_stage(self, batches: Iterator[tuple]) -> Iterator[int]:
+        for rows, entity_rows in batches:
+            new_rows = [row for row in rows if row["chunk_id"] not in self.old_hashes]
+            new_ids = {row["chunk_id"] for row in new_rows}
+            self.deferred_rows.extend(row for row in rows if row["chunk_id"] in self.old_hashes)
+            self.deferred_entity_rows.extend(row for row in entity_rows if row["chunk_id"] not in new_ids)
+            if not new_rows:
+                yield 0
+                continue
+
+            if not self.document_ready:
+                self.indexer.prepare_document(self.graph_db, self.filename, self.user_id)
+                self.document_ready = True
+
+            new_entity_rows = [row for row in entity_rows if row["chunk_id"] in new_ids]
+            self.created_ids.extend(new_ids)
+            self.created_entities.update((row["name"], row["type"]) for row in new_entity_rows)
+            written = self.graph_db.add_chunks_bulk(self.filename, new_rows)
+            self.written += written
+            self.linked += self.graph_db.link_entities_bulk(new_entity_rows)
+            self.report("indexing", chunks_written=self.unchanged + self.written)
+            yield written
+
+    #A flusso terminato: riscrive i chunk rimandati, rimuove i chunk spariti e le entità rimaste orfane, salva la matrice locale
+    #e compone il riepilogo
+    def _finalize(self) -> Dict[str, Any]:
+        # Anche se nessun chunk è cambiato, il documento va collegato all'utente che lo ha caricato
+        if not self.document_ready:
+            self.indexer.prepare_document(self.graph_db, self.filename, self.user_id)
+            self.document_ready = True
+
+        # Riscrittura dei chunk rimandati e rimozione dei chunk spariti in un'unica transazione: se fallisce il grafo resta
+        # alla versione precedente (a parte i chunk nuovi, che _rollback elimina), senza chunk scollegati dalle loro entità
+        rewritten_ids = [row["chunk_id"] for row in self.deferred_rows]
+        new_ids = set(self.chunk_ids)
+        removed_ids = [chunk_id for chunk_id in self.old_hashes if chunk_id not in new_ids]
+        orphan_candidates = {
+            (record["name"], record["type"])
+            for chunk_id in removed_ids + rewritten_ids
+            for record in self.old_entities.get(chunk_id, [])
+        }
+        counts = self.graph_db.replace_document_chunks(
+            self.filename, self.deferred_rows, self.deferred_entity_rows, removed_ids,
+            [{"name": name, "type": label} for name, label in orphan_candidates],
+            content_version=self._content_version(),
+        )
+        self.written += counts["written"]
+        self.linked += counts["linked"]
+        removed = counts["removed"]
+        orphans_deleted = counts["orphans_deleted"]
+        self.committed = True
+        self.report("indexing", chunks_written=self.unchanged + self.written)
+
+        # Se la cache locale è attiva, salvo anche la matrice memory-mapped degli embedding del documento
+        if local_vector_store.enabled and self.local_ids:
+            self._write_local_store()
+
+        return {
+            "chunks_total": self.chunks_seen,
+            "chunks_unchanged": self.unchanged,
+            "chunks_reused": self.reused,
+            "chunks_recomputed": self.recomputed,
+            "chunks_written": self.written,
+            "chunks_skipped": self.skipped,
+            "chunks_removed": removed,
+            "entities_linked": self.linked,
+            "orphan_entities_deleted": orphans_deleted,
+        }
+
+    #Versione del contenuto: hash dei (chunk_id, content_hash) della nuova versione. Resta uguale se la reindicizzazione
+    #non cambia nulla, così le risposte salvate per il documento (scoped per versione) restano valide
+    def _content_version(self) -> str:
+        digest = hashlib.sha256()
+        for chunk_id in sorted(self.content_hashes):
+            digest.update(f"{chunk_id}:{self.content_hashes[chunk_id]}\n".encode("utf-8"))
+        return digest.hexdigest()[:16]
+
+    #Salva la matrice locale del documento dopo il commit sul grafo. Se la scrittura fallisce non posso lasciare la matrice
+    #della versione precedente (chunk_id e vettori non più validi): la elimino, così la ricerca passa dal grafo finché
+    #il documento non viene reindicizzato. Se non riesco neanche a eliminarla sollevo l'errore
+    def _write_local_store(self):
+        try:
+            local_vector_store.write(self.filename, self.local_ids, np.vstack(self.local_vectors))
+        except Exception as e:
+            logger.error(f"Non sono riuscito a salvare la matrice locale di '{self.filename}', rimuovo quella della versione precedente: {e}")
+            local_vector_store.delete(self.filename)
+
+    #Elimina i chunk nuovi scritti durante un flusso fallito e le entità rimaste orfane: i chunk della versione precedente
+    #non sono ancora stati toccati, quindi il documento torna com'era prima dell'ingestione
+    def _rollback(self):
+        if not self.created_ids:
+            return
+        try:
+            deleted = self.graph_db.delete_chunks_bulk(self.created_ids)
+            self.graph_db.delete_orphan_entities([{"name": name, "type": label} for name, label in self.created_entities])
+            logger.warning(f"Ingestione di '{self.filename}' annullata: ho eliminato {deleted} chunk scritti prima dell'errore.")
+        except Exception as e:
+            logger.error(f"Non sono riuscito ad annullare l'ingestione parziale di '{self.filename}': {e}")
@@ -0,0 +1,164 @@
+#Questo script confronta la precisione di inferenza configurabile (int8 / bf16) con il fp32 sui tre modelli
+#della pipeline: misura i tempi di embedding, reranking e NER su un PDF reale e quanto i risultati restano
+#d'accordo con il fp32 (overlap del top-k di retrieval e reranking, F1 delle entità GLiNER).
+#Uso: python -m processingPdf.precisionBenchmark documento.pdf --precision int8 [--queries domande.txt]
+
+import argparse
+import json
+import logging
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from dotenv import load_dotenv
+
+from processingPdf.chunker import Chunker
+from processingPdf.extractor import EntityExtractor, PDFExtractor
+from processingPdf.modelRegistry import model_registry, SUPPORTED_PRECISIONS
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+RETRIEVAL_K = 15
+RERANK_TOP_N = 5
+
+
+#Estrae i chunk del PDF con la stessa pipeline dell'ingestione
+def load_chunks(pdf_path: str, max_chunks: int) -> List[str]:
+    sections = PDFExtractor().extract_sections(pdf_path)
+    chunks = Chunker().create_chunks(sections, os.path.basename(pdf_path))
+    return [chunk.page_content for chunk in chunks[:max_chunks]]
+
+
+#Se non vengono fornite domande, uso la prima frase di alcuni chunk distribuiti nel documento
+def sample_queries(texts: List[str], count: int) -> List[str]:
+    step = max(1, len(texts) // count)
+    queries = []
+    for text in texts[::step][:count]:
+        sentence = re.split(r"(?<=[.!?])\s", text.strip(), maxsplit=1)[0]
+        queries.append(sentence[:200])
+    return queries
+
+
+#Esegue embedding, retrieval, reranking e NER con una precisione e restituisce tempi e risultati.
+#Per il reranking uso i candidati del fp32 (reference_candidates), così entrambe le precisioni ordinano lo stesso insieme
+def run_precision(precision: str, texts: List[str], queries: List[str], ner_texts: List[str],
+                  reference_candidates: Optional[List[List[int]]] = None) -> Dict[str, Any]:
+    timings = {}
+
+    embedder = model_registry.get_embedder(precision=precision)
+    embedder.encode(texts[:2], convert_to_numpy=True, show_progress_bar=False)  # warm-up
+    start = time.perf_counter()
+    chunk_vectors = embedder.encode(texts, batch_size=32, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
+    query_vectors = embedder.encode(queries, batch_size=32, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
+    timings["embedding_seconds"] = time.perf_counter() - start
+
+    similarities = np.asarray(query_vectors, dtype=np.float32) @ np.asarray(chunk_vectors, dtype=np.float32).T
+    retrieved = [list(np.argsort(-row)[:RETRIEVAL_K]) for row in similarities]
+
+    candidates = reference_candidates or retrieved
+    reranker = model_registry.get_reranker(precision=precision)
+    reranker.predict([[queries[0], texts[0]]])  # warm-up
+    start = time.perf_counter()
+    reranked = []
+    for query, indices in zip(queries, candidates):
+        scores = reranker.predict([[query, texts[i]] for i in indices])
+        order = np.argsort(-np.asarray(scores, dtype=np.float32))[:RERANK_TOP_N]
+        reranked.append([indices[i] for i in order])
+    timings["rerank_seconds"] = time.perf_counter() - start
+
+    gliner = model_registry.get_gliner(precision=precision)
+    gliner.predict_entities(ner_texts[0], EntityExtractor.LABELS, threshold=0.5)  # warm-up
+    start = time.perf_counter()
+    entities = []
+    for batch_start in range(0, len(ner_texts), 8):
+        batch = gliner.batch_predict_entities(ner_texts[batch_start:batch_start + 8], EntityExtractor.LABELS, threshold=0.5)
+        entities.extend({(e["text"], e["label"]) for e in EntityExtractor._clean_entities(found)} for found in batch)
+    timings["ner_seconds"] = time.perf_counter() - start
+
+    report = model_registry.memory_report()
+    # Scarico i modelli prima di passare all'altra precisione, così le misure non si contendono la memoria
+    model_registry.unload_idle(0)
+
+    return {
+        "timings": timings,
+        "model_mb": report["total_mb"],
+        "retrieved": retrieved,
+        "reranked": reranked,
+        "entities": entities,
+    }
+
+
+def _mean_overlap(reference: List[List[int]], candidate: List[List[int]]) -> float:
+    overlaps = [len(set(r) & set(c)) / len(r) for r, c in zip(reference, candidate) if r]
+    return round(float(np.mean(overlaps)), 4) if overlaps else 0.0
+
+
+#F1 micro delle entità (testo, etichetta) rispetto al fp32
+def _entity_f1(reference: List[set], candidate: List[set]) -> float:
+    true_positive = sum(len(r & c) for r, c in zip(reference, candidate))
+    predicted = sum(len(c) for c in candidate)
+    expected = sum(len(r) for r in reference)
+    if not predicted and not expected:
+        return 1.0
+    precision = true_positive / predicted if predicted else 0.0
+    recall = true_positive / expected if expected else 0.0
+    return round(2 * precision * recall / (precision + recall), 4) if precision + recall else 0.0
+
+
+def compare(baseline: Dict[str, Any], candidate: Dict[str, Any]) -> Dict[str, Any]:
+    speedup = {
+        stage.replace("_seconds", ""): round(baseline["timings"][stage] / candidate["timings"][stage], 2) if candidate["timings"][stage] else None
+        for stage in baseline["timings"]
+    }
+    return {
+        "speedup": speedup,
+        "total_speedup": round(sum(baseline["timings"].values()) / sum(candidate["timings"].values()), 2),
+        "model_mb": {"fp32": baseline["model_mb"], "candidate": candidate["model_mb"]},
+        f"retrieval_overlap_at_{RETRIEVAL_K}": _mean_overlap(baseline["retrieved"], candidate["retrieved"]),
+        f"rerank_overlap_at_{RERANK_TOP_N}": _mean_overlap(baseline["reranked"], candidate["reranked"]),
+        "ner_f1_vs_fp32": _entity_f1(baseline["entities"], candidate["entities"]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confronto velocità/accordo tra fp32 e una precisione ridotta")
+    parser.add_argument("pdf", help="PDF da usare come corpus")
+    parser.add_argument("--precision", default="int8", choices=[p for p in SUPPORTED_PRECISIONS if p != "fp32"])
+    parser.add_argument("--queries", help="File con una domanda per riga (default: frasi campionate dai chunk)")
+    parser.add_argument("--max-chunks", type=int, default=200)
+    parser.add_argument("--num-queries", type=int, default=20)
+    parser.add_argument("--ner-chunks", type=int, default=64)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    texts = load_chunks(args.pdf, args.max_chunks)
+    if not texts:
+        raise SystemExit(f"Nessun chunk estratto da '{args.pdf}'.")
+    if args.queries:
+        with open(args.queries, "r", encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    else:
+        queries = sample_queries(texts, args.num_queries)
+    ner_texts = texts[:args.ner_chunks]
+
+    logger.info(f"Benchmark su {len(texts)} chunk, {len(queries)} domande, {len(ner_texts)} chunk per la NER.")
+    baseline = run_precision("fp32", texts, queries, ner_texts)
+    candidate = run_precision(args.precision, texts, queries, ner_texts, reference_candidates=baseline["retrieved"])
+
+    result = {
+        "precision": args.precision,
+        "chunks": len(texts),
+        "queries": len(queries),
+        "timings_fp32": {k: round(v, 3) for k, v in baseline["timings"].items()},
+        f"timings_{args.precision}": {k: round(v, 3) for k, v in candidate["timings"].items()},
+        **compare(baseline, candidate),
+    }
+    print(json.dumps(result, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,23 @@
-import torch
 import logging
-from sentence_transformers import CrossEncoder
+from processingPdf.modelRegistry import model_registry, DEFAULT_RERANKER_MODEL
 
 logger = logging.getLogger(__name__)
 
 class Reranker:
-    def __init__(self, model_name="BAAI/bge-reranker-v2-m3"):
+    def __init__(self, model_name=DEFAULT_RERANKER_MODEL):
         try:
-            device = "cuda" if torch.cuda.is_available() else "cpu"
-            #il CrossEncoder riceve coppie (domanda, chunk) e restituisce un punteggio
-            self.model = CrossEncoder(model_name, device=device)
+            self.model_name = model_name
+            #il modello viene caricato (una sola volta per processo) dal registro condiviso
+            model_registry.get_reranker(self.model_name)
             logger.info(f"Re-ranker '{model_name}' caricato con successo.")
         except Exception as e:
             logger.error(f"Errore nel caricamento del Re-ranker: {e}")
             raise
+
+    #il CrossEncoder riceve coppie (domanda, chunk) e restituisce un punteggio
+    @property
+    def model(self):
+        return model_registry.get_reranker(self.model_name)
     
     #riceve la query e la lista di chunks restituendo i top 5 (in questo caso) più rilevanti
     def rerank(self, query: str, documents: list, top_n: int = 5):
@@ -25,4 +29,13 @@ class Reranker:
         scores = self.model.predict(pairs)
         #unisco i chunks ai loro score e li ordino
         scored_docs= sorted(zip(scores, documents), key=lambda x: x[0], reverse=True)
-        return [doc for score, doc in scored_docs[:top_n]]
\ No newline at end of file
+        return [doc for score, doc in scored_docs[:top_n]]
+
+    #variante per i chunk strutturati del retriever: al cross-encoder passo solo il contenuto (niente tag di fonte),
+    #e restituisco i top_n record con il loro rerank_score, ordinati per pertinenza
+    def rerank_records(self, query: str, records: list, top_n: int = 5):
+        if not records:
+            return []
+        scores = self.model.predict([[query, record["content"]] for record in records])
+        scored_records = sorted(zip(scores, records), key=lambda x: x[0], reverse=True)
+        return [{**record, "rerank_score": float(score)} for score, record in scored_records[:top_n]]
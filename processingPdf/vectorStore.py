@@ -0,0 +1,367 @@
+#Questo file implementa una cache locale degli embedding per documento: a indicizzazione avvenuta
+#salvo la matrice dei vettori dei chunk su disco (file .npy aperto in memory-map) con un sidecar dei chunk_id,
+#così la ricerca sul documento attivo diventa un top-k esatto con NumPy e i worker condividono la page cache.
+#Con LOCAL_VECTOR_STORE_DTYPE=int8 la matrice è quantizzata (codici int8 + una scala per riga in un secondo .npy).
+#Con una matrice compatta (float16/int8) salvo anche i vettori float32 originali: la matrice compatta seleziona i candidati
+#e i migliori vengono ricalcolati a precisione piena, leggendo dal memory-map solo le righe dei candidati.
+#Per la ricerca su tutti i documenti ogni versione salva anche i centroidi di partizioni di righe consecutive
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from processingPdf.embeddingCodec import quantize_matrix, SUPPORTED_ENCODINGS
+
+logger = logging.getLogger(__name__)
+
+SUPPORTED_DTYPES = SUPPORTED_ENCODINGS
+
+#Righe convertite in float32 per volta quando la matrice è int8, così la ricerca non copia l'intera matrice
+SCORE_BLOCK_ROWS = 4096
+#Con una matrice compatta, candidati per ogni risultato richiesto da ricalcolare a precisione piena
+VECTOR_RESCORE_FACTOR = int(os.getenv("VECTOR_RESCORE_FACTOR", "4"))
+#Ricerca globale: ogni matrice è divisa in partizioni di righe consecutive (chunk vicini nel documento), riassunte dal loro
+#centroide. La query viene confrontata con i centroidi di tutti i documenti e solo le VECTOR_GLOBAL_PROBES partizioni
+#più vicine vengono scansionate, così il costo non cresce con il numero totale di chunk
+VECTOR_GLOBAL_PARTITION_ROWS = int(os.getenv("VECTOR_GLOBAL_PARTITION_ROWS", "64"))
+VECTOR_GLOBAL_PROBES = int(os.getenv("VECTOR_GLOBAL_PROBES", "16"))
+
+class LocalVectorStore:
+    def __init__(self, base_dir: Optional[str] = None, dtype: Optional[str] = None):
+        #La cache è attiva solo se è configurata una cartella (LOCAL_VECTOR_STORE_DIR)
+        self.base_dir = base_dir if base_dir is not None else os.getenv("LOCAL_VECTOR_STORE_DIR")
+        self.dtype = (dtype or os.getenv("LOCAL_VECTOR_STORE_DTYPE", "float32")).lower()
+        if self.dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"LOCAL_VECTOR_STORE_DTYPE non supportato: '{self.dtype}'. Valori ammessi: {', '.join(SUPPORTED_DTYPES)}")
+
+        #Matrici già aperte in memory-map, indicizzate per filename e invalidate quando cambia la versione attiva
+        self._open: Dict[str, Tuple[str, np.ndarray, Optional[np.ndarray], Optional[np.ndarray], List[str]]] = {}
+        #filename di ogni documento salvato (dal prefisso dei file), per la ricerca su tutti i documenti
+        self._filenames: Dict[str, str] = {}
+        #Centroidi delle partizioni per (stem, versione) e indice globale dei centroidi, ricostruito quando cambia
+        #il contenuto della cartella (anche per scritture di altri processi)
+        self._centroids: Dict[Tuple[str, str], np.ndarray] = {}
+        self._global: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+
+        if self.base_dir:
+            os.makedirs(self.base_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.base_dir)
+
+    #Nomi derivati dall'hash del filename, per non dipendere da caratteri arbitrari nel nome del PDF.
+    #Ogni scrittura crea una nuova cartella di versione ({stem}.{versione}) con matrice, scale e chunk_id;
+    #il file puntatore {stem}.current indica la versione attiva
+    def _stem(self, filename: str) -> str:
+        return hashlib.sha256(filename.encode("utf-8")).hexdigest()[:32]
+
+    def _pointer_path(self, filename: str) -> str:
+        return os.path.join(self.base_dir, f"{self._stem(filename)}.current")
+
+    def _current_version(self, filename: str) -> Optional[str]:
+        try:
+            with open(self._pointer_path(filename), "r", encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def has(self, filename: str) -> bool:
+        return self.enabled and os.path.exists(self._pointer_path(filename))
+
+    #Scrive (o sostituisce) la matrice del documento. I vettori vengono normalizzati così il prodotto scalare è il coseno.
+    #I file vengono scritti in una cartella di versione nuova e resi visibili sostituendo il puntatore con os.replace:
+    #un lettore vede sempre matrice, scale e chunk_id della stessa scrittura, mai un misto di due versioni
+    def write(self, filename: str, chunk_ids: List[str], embeddings: np.ndarray):
+        if not self.enabled:
+            return
+        if len(chunk_ids) != len(embeddings):
+            raise ValueError(f"Numero di chunk_id ({len(chunk_ids)}) diverso dal numero di embedding ({len(embeddings)}).")
+
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix, scales = quantize_matrix(matrix / np.where(norms > 0, norms, 1.0), self.dtype)
+
+        stem = self._stem(filename)
+        version = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}"
+        version_dir = os.path.join(self.base_dir, f"{stem}.{version}")
+        os.makedirs(version_dir)
+        np.save(os.path.join(version_dir, "matrix.npy"), matrix)
+        if scales is not None:
+            np.save(os.path.join(version_dir, "scales.npy"), scales)
+        normalized = np.asarray(embeddings, dtype=np.float32) / np.where(norms > 0, norms, 1.0)
+        if self.dtype != "float32":
+            np.save(os.path.join(version_dir, "full.npy"), normalized)
+        np.save(os.path.join(version_dir, "centroids.npy"), self._partition_centroids(normalized))
+        with open(os.path.join(version_dir, "ids.json"), "w", encoding="utf-8") as f:
+            json.dump({"filename": filename, "dtype": self.dtype, "chunk_ids": list(chunk_ids)}, f, ensure_ascii=False)
+
+        previous = self._current_version(filename)
+        pointer_path = self._pointer_path(filename)
+        with open(f"{pointer_path}.{version}.tmp", "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(f"{pointer_path}.{version}.tmp", pointer_path)
+        # Tengo anche la versione precedente, che un lettore potrebbe aver appena aperto
+        self._purge_versions(stem, keep={version, previous})
+
+        with self._lock:
+            self._open.pop(filename, None)
+            self._filenames[stem] = filename
+            self._global = None
+        logger.info(f"Matrice locale degli embedding salvata per '{filename}' ({matrix.shape[0]} x {matrix.shape[1]}, {self.dtype}).")
+
+    def _purge_versions(self, stem: str, keep: set):
+        for name in os.listdir(self.base_dir):
+            if name.startswith(f"{stem}.") and not name.endswith((".current", ".tmp")) and name[len(stem) + 1:] not in keep:
+                shutil.rmtree(os.path.join(self.base_dir, name), ignore_errors=True)
+
+    def delete(self, filename: str):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._open.pop(filename, None)
+            self._global = None
+        pointer_path = self._pointer_path(filename)
+        if os.path.exists(pointer_path):
+            os.remove(pointer_path)
+        self._purge_versions(self._stem(filename), keep=set())
+
+    #Top-k per similarità coseno sul documento. Restituisce coppie (chunk_id, score) con lo score
+    #nella stessa scala dell'indice vettoriale di Neo4j ((1 + coseno) / 2), oppure None se il documento non è in cache.
+    #Con una matrice compatta i k * VECTOR_RESCORE_FACTOR candidati migliori vengono ricalcolati sui vettori float32
+    def search(self, filename: str, query_embedding: List[float], k: int = 5) -> Optional[List[Tuple[str, float]]]:
+        loaded = self._load(filename)
+        if loaded is None:
+            return None
+        return self._search_rows(loaded, self._normalize_query(query_embedding), k, 0, loaded[0].shape[0])
+
+    #Top-k sulle righe [start, end) di una matrice caricata
+    def _search_rows(self, loaded, query: np.ndarray, k: int, start: int, end: int) -> List[Tuple[str, float]]:
+        matrix, scales, full, chunk_ids = loaded
+        if end <= start:
+            return []
+        scores = self._scores(matrix[start:end], scales[start:end] if scales is not None else None, query)
+        if full is not None:
+            # Righe lette in ordine crescente, così il memory-map tocca le pagine in sequenza
+            candidates = np.sort(self._top(scores, k * VECTOR_RESCORE_FACTOR)) + start
+            exact = np.asarray(full[candidates], dtype=np.float32).dot(query)
+            order = self._top(exact, k)
+            return [(chunk_ids[candidates[i]], float((1.0 + exact[i]) / 2.0)) for i in order]
+        top = self._top(scores, k)
+        return [(chunk_ids[start + i], float((1.0 + scores[i]) / 2.0)) for i in top]
+
+    @staticmethod
+    def _normalize_query(query_embedding: List[float]) -> np.ndarray:
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        return query / norm if norm > 0 else query
+
+    #Top-k approssimato su tutti i documenti della cache (ricerca globale): restituisce (filename, chunk_id, score)
+    #ordinati per score. Scansiona solo le partizioni i cui centroidi sono più vicini alla query
+    def search_all(self, query_embedding: List[float], k: int = 5, probes: Optional[int] = None) -> List[Tuple[str, str, float]]:
+        if not self.enabled:
+            return []
+        summary = self._global_summary()
+        if not summary["partitions"]:
+            return []
+        query = self._normalize_query(query_embedding)
+        nearest = self._top(summary["centroids"].dot(query), probes or VECTOR_GLOBAL_PROBES)
+
+        hits = []
+        for i in nearest:
+            filename, start, end = summary["partitions"][i]
+            loaded = self._load(filename)
+            if loaded is None:
+                continue
+            end = min(end, loaded[0].shape[0])
+            hits.extend((filename, chunk_id, score) for chunk_id, score in self._search_rows(loaded, query, k, start, end))
+        hits.sort(key=lambda hit: -hit[2])
+        return hits[:k]
+
+    #Centroidi normalizzati delle partizioni di VECTOR_GLOBAL_PARTITION_ROWS righe consecutive
+    @staticmethod
+    def _partition_centroids(normalized: np.ndarray) -> np.ndarray:
+        centroids = [
+            normalized[start:start + VECTOR_GLOBAL_PARTITION_ROWS].mean(axis=0)
+            for start in range(0, normalized.shape[0], VECTOR_GLOBAL_PARTITION_ROWS)
+        ]
+        if not centroids:
+            return np.zeros((0, normalized.shape[1]), dtype=np.float32)
+        centroids = np.asarray(centroids, dtype=np.float32)
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        return centroids / np.where(norms > 0, norms, 1.0)
+
+    #Indice globale dei centroidi di tutti i documenti: {"centroids": matrice, "partitions": [(filename, inizio, fine)]}.
+    #Viene ricostruito solo quando cambia la cartella (os.replace del puntatore ne aggiorna la data di modifica),
+    #rileggendo i centroidi delle sole versioni nuove
+    def _global_summary(self) -> Dict[str, Any]:
+        generation = os.stat(self.base_dir).st_mtime_ns
+        with self._lock:
+            if self._global is not None and self._global["generation"] == generation:
+                return self._global
+
+        blocks, partitions, live = [], [], set()
+        for name in os.listdir(self.base_dir):
+            if not name.endswith(".current"):
+                continue
+            stem = name[:-len(".current")]
+            filename = self._filename_for_stem(stem)
+            version = self._current_version(filename) if filename else None
+            if version is None:
+                continue
+            live.add((stem, version))
+            centroids = self._version_centroids(filename, stem, version)
+            if centroids is None or centroids.shape[0] == 0:
+                continue
+            blocks.append(centroids)
+            partitions.extend(
+                (filename, i * VECTOR_GLOBAL_PARTITION_ROWS, (i + 1) * VECTOR_GLOBAL_PARTITION_ROWS)
+                for i in range(centroids.shape[0])
+            )
+
+        summary = {
+            "generation": generation,
+            "centroids": np.vstack(blocks) if blocks else np.zeros((0, 0), dtype=np.float32),
+            "partitions": partitions,
+        }
+        with self._lock:
+            self._centroids = {key: value for key, value in self._centroids.items() if key in live}
+            self._global = summary
+        return summary
+
+    #Centroidi di una versione: dal file salvato con la matrice o, per le versioni scritte prima dei centroidi, calcolati una volta
+    def _version_centroids(self, filename: str, stem: str, version: str) -> Optional[np.ndarray]:
+        with self._lock:
+            if (stem, version) in self._centroids:
+                return self._centroids[(stem, version)]
+        path = os.path.join(self.base_dir, f"{stem}.{version}", "centroids.npy")
+        try:
+            centroids = np.load(path) if os.path.exists(path) else None
+        except Exception as e:
+            logger.warning(f"Impossibile leggere i centroidi della matrice locale per '{filename}': {e}")
+            centroids = None
+        if centroids is None:
+            loaded = self._load(filename)
+            if loaded is None or loaded[0].shape[0] == 0:
+                return None
+            matrix, scales, full, _ = loaded
+            if full is not None:
+                normalized = np.asarray(full, dtype=np.float32)
+            else:
+                normalized = np.asarray(matrix, dtype=np.float32) * (scales[:, None] if scales is not None else 1.0)
+            centroids = self._partition_centroids(normalized)
+        with self._lock:
+            self._centroids[(stem, version)] = centroids
+        return centroids
+
+    def _filename_for_stem(self, stem: str) -> Optional[str]:
+        with self._lock:
+            if stem in self._filenames:
+                return self._filenames[stem]
+        try:
+            with open(os.path.join(self.base_dir, f"{stem}.current"), "r", encoding="utf-8") as f:
+                version = f.read().strip()
+            with open(os.path.join(self.base_dir, f"{stem}.{version}", "ids.json"), "r", encoding="utf-8") as f:
+                filename = json.load(f)["filename"]
+        except Exception:
+            return None
+        with self._lock:
+            self._filenames[stem] = filename
+        return filename
+
+    #Indici dei k score più alti, in ordine decrescente
+    @staticmethod
+    def _top(scores: np.ndarray, k: int) -> np.ndarray:
+        k = min(k, scores.shape[0])
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    #Prodotto scalare della query con tutte le righe senza copiare la matrice in float32: con float16 uso direttamente
+    #il dot a mezza precisione di NumPy (che accumula in float32), con int8 converto un blocco di righe alla volta
+    @staticmethod
+    def _scores(matrix: np.ndarray, scales: Optional[np.ndarray], query: np.ndarray) -> np.ndarray:
+        if matrix.dtype == np.float32:
+            scores = matrix.dot(query)
+        elif matrix.dtype == np.float16:
+            scores = matrix.dot(query.astype(np.float16)).astype(np.float32)
+        else:
+            scores = np.empty(matrix.shape[0], dtype=np.float32)
+            for start in range(0, matrix.shape[0], SCORE_BLOCK_ROWS):
+                block = matrix[start:start + SCORE_BLOCK_ROWS]
+                scores[start:start + block.shape[0]] = block.astype(np.float32).dot(query)
+        if scales is not None:
+            scores *= scales
+        return scores
+
+    #Restituisce i vettori (float32, normalizzati) dei chunk dati presenti nella matrice del documento,
+    #a precisione piena se la matrice è compatta
+    def get_vectors(self, filename: str, chunk_ids: List[str]) -> Dict[str, np.ndarray]:
+        loaded = self._load(filename)
+        if loaded is None:
+            return {}
+        matrix, scales, full, stored_ids = loaded
+        positions = {chunk_id: i for i, chunk_id in enumerate(stored_ids)}
+        vectors = {}
+        for chunk_id in chunk_ids:
+            i = positions.get(chunk_id)
+            if i is not None and full is not None:
+                vectors[chunk_id] = np.array(full[i], dtype=np.float32)
+            elif i is not None:
+                vector = np.asarray(matrix[i], dtype=np.float32)
+                vectors[chunk_id] = vector * scales[i] if scales is not None else vector
+        return vectors
+
+    def _load(self, filename: str) -> Optional[Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray], List[str]]]:
+        if not self.enabled:
+            return None
+        version = self._current_version(filename)
+        if version is None:
+            return None
+
+        with self._lock:
+            cached = self._open.get(filename)
+            if cached is not None and cached[0] == version:
+                return cached[1:]
+
+        version_dir = os.path.join(self.base_dir, f"{self._stem(filename)}.{version}")
+        try:
+            matrix = np.load(os.path.join(version_dir, "matrix.npy"), mmap_mode="r")
+            scales = None
+            if matrix.dtype == np.int8:
+                scales = np.load(os.path.join(version_dir, "scales.npy"))
+            full_path = os.path.join(version_dir, "full.npy")
+            full = np.load(full_path, mmap_mode="r") if os.path.exists(full_path) else None
+            with open(os.path.join(version_dir, "ids.json"), "r", encoding="utf-8") as f:
+                chunk_ids = json.load(f)["chunk_ids"]
+        except Exception as e:
+            logger.warning(f"Impossibile aprire la matrice locale degli embedding per '{filename}': {e}")
+            return None
+        if matrix.shape[0] != len(chunk_ids) or any(extra is not None and extra.shape[0] != len(chunk_ids) for extra in (scales, full)):
+            logger.warning(f"Matrice locale e sidecar non allineati per '{filename}', la ignoro.")
+            return None
+
+        with self._lock:
+            self._open[filename] = (version, matrix, scales, full, chunk_ids)
+        return matrix, scales, full, chunk_ids
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "dtype": self.dtype,
+                "open_documents": len(self._open),
+                "global_partitions": len(self._global["partitions"]) if self._global else 0,
+            }
+
+
+#Istanza condivisa dal processo
+local_vector_store = LocalVectorStore()